@@ -3,16 +3,32 @@ import json
 import threading
 import time
 import random
+import bisect
+import csv
+import gzip
+import io
 import requests
 import telebot
 from telebot import types
-from queue import Queue
+from queue import Queue, Full
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from threading import Lock
 from datetime import datetime, timedelta
+from decimal import Decimal
+from contextlib import contextmanager
+from tempfile import SpooledTemporaryFile
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
 from urllib.parse import urlparse
 import logging
+import socket
+import select
+import uuid
+from requests.adapters import HTTPAdapter
 
 # تكوين التسجيل
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -27,6 +43,25 @@ USERNAME = os.getenv('ICHANCY_USERNAME')
 PASSWORD = os.getenv('ICHANCY_PASSWORD')
 BASE_URL = os.getenv('ICHANCY_BASE_URL', 'https://agents.55bets.net/')
 
+# مجمع اتصالات الوكيل المشترك بين العمال، وعدد المحاولات وتأخيرها
+AGENT_MAX_CONNECTIONS = int(os.getenv('AGENT_MAX_CONNECTIONS', '20'))
+AGENT_REQUEST_RETRIES = int(os.getenv('AGENT_REQUEST_RETRIES', '3'))
+AGENT_RETRY_BASE_DELAY = float(os.getenv('AGENT_RETRY_BASE_DELAY', '0.5'))
+# مهلة كل نقطة نهاية بالثواني، العمليات المالية تنتظر أطول من الاستعلامات
+AGENT_ENDPOINT_TIMEOUTS = {
+    '/global/api/User/signIn': 15,
+    '/global/api/Player/getPlayersForCurrentAgent': 20,
+    '/global/api/Player/getPlayerBalanceById': 10,
+    '/global/api/Player/depositToPlayer': 30,
+    '/global/api/Player/withdrawFromPlayer': 30,
+    '/global/api/Player/registerPlayer': 30,
+    '/global/api/Agent/getAgentAllWallets': 10,
+}
+AGENT_DEFAULT_TIMEOUT = 30
+# الجلسة تجدد قبل انتهائها بهامش، والمدة الافتراضية عند عدم معرفة الانتهاء من استجابة الدخول
+AGENT_SESSION_DEFAULT_TTL = int(os.getenv('AGENT_SESSION_DEFAULT_TTL', '300'))
+AGENT_SESSION_RENEW_MARGIN = int(os.getenv('AGENT_SESSION_RENEW_MARGIN', '30'))
+
 # إعدادات البوت
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 ADMIN_CHAT_ID = os.getenv('ADMIN_CHAT_ID')
@@ -42,9 +77,76 @@ CHANNEL_LINK = os.getenv('CHANNEL_LINK')
 
 # إعدادات PostgreSQL
 DATABASE_URL = os.getenv('DATABASE_URL')
-
-# الطابور العام للمهام
-account_operations_queue = Queue()
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '2'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+DB_POOL_HEALTHCHECK_IDLE = int(os.getenv('DB_POOL_HEALTHCHECK_IDLE', '30'))  # ثواني الخمول قبل فحص الاتصال
+SCHEMA_MIGRATION_LOCK_ID = 5501  # معرف القفل الاستشاري لترحيلات المخطط
+DB_TRANSACTION_RETRIES = int(os.getenv('DB_TRANSACTION_RETRIES', '3'))
+# أخطاء التسلسل والجمود التي يعاد فيها تنفيذ المعاملة بالكامل
+TRANSACTION_RETRY_PGCODES = {'40001', '40P01'}
+
+# عدد عمال معالجة عمليات الحسابات (إنشاء، شحن، سحب)
+ACCOUNT_OPERATION_WORKERS = int(os.getenv('ACCOUNT_OPERATION_WORKERS', '4'))
+ACCOUNT_JOB_VISIBILITY_TIMEOUT = int(os.getenv('ACCOUNT_JOB_VISIBILITY_TIMEOUT', '300'))  # ثواني قبل اعتبار العامل منقطعاً
+ACCOUNT_JOB_MAX_ATTEMPTS = int(os.getenv('ACCOUNT_JOB_MAX_ATTEMPTS', '5'))
+ACCOUNT_JOB_RETRY_BASE_DELAY = float(os.getenv('ACCOUNT_JOB_RETRY_BASE_DELAY', '5'))
+ACCOUNT_JOB_POLL_INTERVAL = float(os.getenv('ACCOUNT_JOB_POLL_INTERVAL', '2'))
+CASHIER_BALANCE_TTL = float(os.getenv('CASHIER_BALANCE_TTL', '60'))  # ثواني صلاحية رصيد الكاشير المخزن
+# ترتيب قائمة لاعبي الوكيل غير مضمون، لذا يعاد المسح الكامل للدليل دورياً (ثواني)
+AGENT_PLAYERS_FULL_SYNC_INTERVAL = int(os.getenv('AGENT_PLAYERS_FULL_SYNC_INTERVAL', '21600'))
+AGENT_PLAYERS_CACHE_MAX_ENTRIES = int(os.getenv('AGENT_PLAYERS_CACHE_MAX_ENTRIES', '20000'))
+
+# الإرسال الجماعي: حد تيليجرام العام ~30 رسالة/ثانية، نترك هامشاً لردود البوت العادية
+BROADCAST_RATE_PER_SECOND = float(os.getenv('BROADCAST_RATE_PER_SECOND', '25'))
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', '8'))
+BROADCAST_BATCH_SIZE = int(os.getenv('BROADCAST_BATCH_SIZE', '500'))
+BROADCAST_MAX_RETRIES = 3
+# مهلة حجز الإرسال الجماعي لنسخة واحدة من البوت، تجدد مع كل نقطة استئناف (ثواني)
+BROADCAST_LEASE_SECONDS = int(os.getenv('BROADCAST_LEASE_SECONDS', '300'))
+
+# ذاكرة الإعدادات: تحدث عند الحفظ عبر LISTEN/NOTIFY ومهلة صلاحية احتياطية
+SETTINGS_CACHE_TTL = int(os.getenv('SETTINGS_CACHE_TTL', '300'))
+SETTINGS_NOTIFY_CHANNEL = 'settings_changed'
+
+# مهلة المحادثات المتروكة (ثواني) قبل إلغاء حالة المستخدم
+CONVERSATION_STATE_TIMEOUT = int(os.getenv('CONVERSATION_STATE_TIMEOUT', '900'))
+# مخزن حالات المحادثة: memory (افتراضي) أو postgres للمشاركة بين النسخ والبقاء بعد إعادة التشغيل
+CONVERSATION_STORE_BACKEND = os.getenv('CONVERSATION_STORE_BACKEND', 'memory')
+CONVERSATION_STORE_MAX_ENTRIES = int(os.getenv('CONVERSATION_STORE_MAX_ENTRIES', '10000'))
+CONVERSATION_STORE_TTL = int(os.getenv('CONVERSATION_STORE_TTL', '3600'))
+
+# وضع Webhook: يعمل عند تحديد WEBHOOK_URL وإلا يبقى الاستطلاع (polling)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = '/telegram-webhook'
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_PORT = int(os.getenv('PORT', '8080'))
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '8'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '100'))  # حد كل قسم قبل رفض التحديثات
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv('WEBHOOK_ENQUEUE_TIMEOUT', '2'))
+
+# ذاكرة التحقق من الاشتراك في القناة: المشتركون لفترة أطول وغير المشتركين لفترة قصيرة
+SUBSCRIPTION_POSITIVE_TTL = int(os.getenv('SUBSCRIPTION_POSITIVE_TTL', '3600'))
+SUBSCRIPTION_NEGATIVE_TTL = int(os.getenv('SUBSCRIPTION_NEGATIVE_TTL', '30'))
+SUBSCRIPTION_CACHE_MAX_ENTRIES = 50000
+SUBSCRIBED_STATUSES = ('member', 'administrator', 'creator')
+
+# ذاكرة ملف المستخدم للقائمة الرئيسية
+USER_PROFILE_CACHE_TTL = int(os.getenv('USER_PROFILE_CACHE_TTL', '15'))
+USER_PROFILE_CACHE_MAX_ENTRIES = 20000
+
+# ذاكرة حسابات 55BETS حسب المستخدم
+ACCOUNT_CACHE_MAX_ENTRIES = int(os.getenv('ACCOUNT_CACHE_MAX_ENTRIES', '10000'))
+
+# إعادة بناء ترتيب النقاط من قاعدة البيانات دورياً لالتقاط تغييرات النسخ الأخرى
+LEADERBOARD_RELOAD_INTERVAL = int(os.getenv('LEADERBOARD_RELOAD_INTERVAL', '300'))
+
+# فترة إعادة حساب لقطات إحصائيات لوحات الإدارة
+STATS_COMPACTION_INTERVAL = int(os.getenv('STATS_COMPACTION_INTERVAL', '300'))
+
+# تصدير CSV: حجم الذاكرة قبل النقل لملف مؤقت، وعدد الصفوف في كل دفعة من المؤشر، والضغط الافتراضي
+EXPORT_SPOOL_MAX_SIZE = int(os.getenv('EXPORT_SPOOL_MAX_SIZE', str(5 * 1024 * 1024)))
+EXPORT_FETCH_SIZE = int(os.getenv('EXPORT_FETCH_SIZE', '2000'))
+EXPORT_GZIP = os.getenv('EXPORT_GZIP', 'false').lower() == 'true'
 
 # الأقفال
 user_locks = {}
@@ -52,7 +154,6 @@ system_lock = Lock()
 
 # الوسيط
 bot = telebot.TeleBot(TELEGRAM_TOKEN)
-user_data = {}
 
 
 MIN_DEPOSIT_TO_ACCOUNT = 10000 
@@ -63,21 +164,91 @@ MIN_WITHDRAW_FROM_BOT = 50000
 # فئة الوسيط المحسنة (Agent)
 # ===============================================================
 
+class AgentSessionCoordinator:
+    """تنسيق جلسة الوكيل: تسجيل دخول واحد في كل مرة وتجديد قبل انتهاء الصلاحية مع مقاييس الدخول"""
+    def __init__(self):
+        self.expires_at = 0
+        self.generation = 0
+        self.login_count = 0
+        self.failed_logins = 0
+        self.total_latency = 0.0
+        self.last_latency = 0.0
+        self.last_login_at = None
+        self.lock = Lock()
+
+    def is_valid(self):
+        return time.time() < self.expires_at - AGENT_SESSION_RENEW_MARGIN
+
+    def record_login(self, success, latency, expires_at=None):
+        with self.lock:
+            self.last_latency = latency
+            self.total_latency += latency
+            if not success:
+                self.failed_logins += 1
+                return
+            self.login_count += 1
+            self.generation += 1
+            self.last_login_at = time.time()
+            self.expires_at = expires_at or self.last_login_at + AGENT_SESSION_DEFAULT_TTL
+        logger.info(f"🔑 جلسة الوكيل صالحة حتى {datetime.fromtimestamp(self.expires_at).strftime('%H:%M:%S')} (زمن الدخول {latency:.2f}ث)")
+
+    def invalidate(self, generation):
+        """إبطال الجلسة بعد 401 فقط إن لم يجددها طلب آخر في الأثناء"""
+        with self.lock:
+            if generation == self.generation:
+                self.expires_at = 0
+
+    def read_expiry(self, response_data, cookies):
+        """قراءة وقت انتهاء الجلسة من استجابة الدخول أو من الكوكيز"""
+        result = response_data.get("result")
+        if isinstance(result, dict):
+            for key in ("expiresIn", "expires_in", "tokenExpiresIn"):
+                try:
+                    if result.get(key):
+                        return time.time() + float(result[key])
+                except (TypeError, ValueError):
+                    pass
+            for key in ("expiresAt", "expires_at", "tokenExpiration"):
+                try:
+                    if result.get(key):
+                        value = float(result[key])
+                        # بعض الخوادم ترسل الوقت بالمللي ثانية
+                        return value / 1000 if value > 1e12 else value
+                except (TypeError, ValueError):
+                    pass
+        expiries = [cookie.expires for cookie in cookies if cookie.expires]
+        return min(expiries) if expiries else None
+
+    def get_stats(self):
+        with self.lock:
+            attempts = self.login_count + self.failed_logins
+            return {
+                'login_count': self.login_count,
+                'failed_logins': self.failed_logins,
+                'avg_latency': self.total_latency / attempts if attempts else 0.0,
+                'last_latency': self.last_latency,
+                'expires_in': max(int(self.expires_at - time.time()), 0),
+            }
+
+agent_session = AgentSessionCoordinator()
+
 class IChancyAgent:
     def __init__(self):
         self.BASE_URL = BASE_URL
         self.USERNAME = USERNAME
         self.PASSWORD = PASSWORD
         self.session = requests.Session()
-        self.logged_in = False
+        # مجمع اتصالات محدود يعاد استخدامه بين العمال، والعامل ينتظر اتصالاً حراً بدلاً من فتح اتصال جديد
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=AGENT_MAX_CONNECTIONS, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.login_lock = Lock()
         self.user_agents = [
             'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
             'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36',
             'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/118.0.0.0 Safari/537.36'
         ]
         self.setup_headers()
-        renew_thread = threading.Thread(target=self.auto_renew_session, daemon=True)
-        renew_thread.start()
 
     def setup_headers(self):
         self.headers = {
@@ -101,79 +272,74 @@ class IChancyAgent:
                 "password": self.PASSWORD
             }
             
+            started = time.time()
             response = self.session.post(
                 f"{self.BASE_URL}/global/api/User/signIn",
                 json=login_payload,
                 headers=self.headers,
-                timeout=30
+                timeout=AGENT_ENDPOINT_TIMEOUTS.get('/global/api/User/signIn', AGENT_DEFAULT_TIMEOUT)
             )
             
             if response.status_code == 200:
                 response_data = response.json()
                 if response_data.get("status") and response_data.get("result", {}).get("message") == "dashboard":
-                    self.logged_in = True
+                    agent_session.record_login(True, time.time() - started,
+                                               agent_session.read_expiry(response_data, self.session.cookies))
                     logger.info("✅ تم تسجيل الدخول بنجاح باستخدام API المباشر")
                     return True
+            agent_session.record_login(False, time.time() - started)
             return False
         except Exception as e:
+            agent_session.record_login(False, 0.0)
             logger.error(f"Direct API login error: {str(e)}")
             return False
 
     def ensure_login(self):
-        if self.logged_in:
-            return True
-        if self.direct_api_login():
+        """تسجيل الدخول فقط عند اقتراب انتهاء الجلسة، وباقي الخيوط تنتظر نفس المحاولة"""
+        if agent_session.is_valid():
             return True
-        return False
-
-    def auto_renew_session(self):
-        while True:
-            time.sleep(250)  
-            try:
-                if self.logged_in:
-                    print("🔄 جاري تجديد الجلسة تلقائيًا...")
-                    self.logged_in = False
-                    if self.ensure_login():
-                        print("✅ تم تجديد الجلسة بنجاح")
-                    else:
-                        print("❌ فشل في تجديد الجلسة")
-            except Exception as e:
-                print(f"خطأ في تجديد الجلسة: {str(e)}")
+        with self.login_lock:
+            if agent_session.is_valid():
+                return True
+            return self.direct_api_login()
 
-    def make_request(self, endpoint, payload=None, method="POST", retries=3):
+    def make_request(self, endpoint, payload=None, method="POST", retries=AGENT_REQUEST_RETRIES):
         for attempt in range(retries):
             try:
                 if not self.ensure_login():
                     return {"error": "Login failed", "status": "error"}
+                generation = agent_session.generation
                 
                 url = f"{self.BASE_URL}{endpoint}"
                 self.rotate_user_agent()
                 
+                timeout = AGENT_ENDPOINT_TIMEOUTS.get(endpoint, AGENT_DEFAULT_TIMEOUT)
                 if method == "POST":
-                    response = self.session.post(url, json=payload, headers=self.headers, timeout=30)
+                    response = self.session.post(url, json=payload, headers=self.headers, timeout=timeout)
                 else:
-                    response = self.session.get(url, headers=self.headers, timeout=30)
+                    response = self.session.get(url, headers=self.headers, timeout=timeout)
                 
                 if response.status_code == 200:
                     return response.json()
                 elif response.status_code == 401:
-                    self.logged_in = False
-                    time.sleep(2)
+                    agent_session.invalidate(generation)
                     continue
                     
             except Exception as e:
                 logger.error(f"Request error: {str(e)}")
-                time.sleep(2)
+            
+            if attempt < retries - 1:
+                time.sleep(agent_retry_delay(attempt))
         
         return {"error": "Request failed after retries", "status": "error"}
 
-    def get_players(self, start=0, limit=100):
+    def get_players(self, start=0, limit=100, search=""):
         payload = {
             "start": start,
             "limit": limit,
             "filter": {},
             "isNextPage": False,
-            "searchBy": {"getPlayersFromChildrenLists": ""}
+            "searchBy": {"getPlayersFromChildrenLists": search}
         }
         return self.make_request("/global/api/Player/getPlayersForCurrentAgent", payload)
 
@@ -219,6 +385,10 @@ class IChancyAgent:
     def get_cashier_balance(self):
         return self.make_request("/global/api/Agent/getAgentAllWallets", method="GET")
 
+def agent_retry_delay(attempt):
+    """تأخير أسي مع تشويش عشوائي بين محاولات طلبات الوكيل"""
+    return AGENT_RETRY_BASE_DELAY * (2 ** attempt) * random.uniform(0.5, 1.5)
+
 # إنشاء كائن الوسيط
 agent = IChancyAgent()
 
@@ -226,9 +396,41 @@ agent = IChancyAgent()
 # نظام إدارة البيانات مع PostgreSQL - الإصدار المحسن
 # ===============================================================
 
+# الفهارس الثانوية المدارة لكل عمليات البحث المتكررة: (اسم الفهرس، الجدول، الأعمدة)
+DATABASE_INDEXES = [
+    ('idx_transactions_user_type_created', 'transactions', 'user_id, type, created_at'),
+    ('idx_payment_requests_group_message', 'payment_requests', 'group_chat_id, group_message_id, status'),
+    ('idx_payment_requests_user_transaction', 'payment_requests', 'user_id, transaction_id'),
+    ('idx_payment_requests_user_status', 'payment_requests', 'user_id, status'),
+    ('idx_pending_withdrawals_user_status', 'pending_withdrawals', 'user_id, status'),
+    ('idx_pending_withdrawals_user_created', 'pending_withdrawals', 'user_id, created_at DESC'),
+    ('idx_pending_withdrawals_group_message', 'pending_withdrawals', 'group_chat_id, group_message_id, status'),
+    ('idx_referrals_referred', 'referrals', 'referred_id'),
+    ('idx_referral_commissions_referrer_status', 'referral_commissions', 'referrer_id, status'),
+    ('idx_gift_code_usage_user_used', 'gift_code_usage', 'user_id, used_at'),
+    ('idx_gift_code_usage_code_user', 'gift_code_usage', 'code, user_id'),
+    ('idx_gift_transactions_from_created', 'gift_transactions', 'from_user_id, created_at DESC'),
+    ('idx_gift_transactions_to_created', 'gift_transactions', 'to_user_id, created_at DESC'),
+    ('idx_loyalty_points_history_user_created', 'loyalty_points_history', 'user_id, created_at DESC'),
+    ('idx_dice_plays_user', 'dice_plays', 'user_id'),
+    ('idx_compensation_requests_user_status', 'compensation_requests', 'user_id, status'),
+    ('idx_compensation_requests_group_message', 'compensation_requests', 'group_chat_id, group_message_id, status'),
+]
+
 class DatabaseManager:
     def __init__(self):
-        self.connection = None
+        self.pool = None
+        self.min_connections = DB_POOL_MIN_SIZE
+        self.max_connections = max(DB_POOL_MAX_SIZE, DB_POOL_MIN_SIZE, 1)
+        self.healthcheck_idle = DB_POOL_HEALTHCHECK_IDLE
+        # حد أقصى للاتصالات المستعارة بالتوازي حتى ينتظر الخيط بدلاً من PoolError
+        self.pool_slots = threading.BoundedSemaphore(self.max_connections)
+        self.pool_lock = Lock()
+        self.last_used = {}
+        self.schema_version = 0
+        # المعاملة الجارية لكل خيط حتى تنضم إليها استعلامات execute_query
+        self.local = threading.local()
+        self.transaction_retries = max(DB_TRANSACTION_RETRIES, 1)
         self.max_retries = 3
         self.retry_delay = 5
         self.connect_with_retry()
@@ -247,7 +449,9 @@ class DatabaseManager:
             if database_url.startswith('postgres://'):
                 database_url = database_url.replace('postgres://', 'postgresql://', 1)
             
-            self.connection = psycopg2.connect(
+            self.pool = ThreadedConnectionPool(
+                self.min_connections,
+                self.max_connections,
                 database_url,
                 connect_timeout=30,
                 keepalives=1,
@@ -255,11 +459,10 @@ class DatabaseManager:
                 keepalives_interval=10,
                 keepalives_count=5
             )
-            self.connection.autocommit = False
-            logger.info("✅ تم الاتصال بقاعدة البيانات PostgreSQL بنجاح")
+            logger.info(f"✅ تم الاتصال بقاعدة البيانات PostgreSQL بنجاح (مجمع اتصالات {self.min_connections}-{self.max_connections})")
             
-            # إعادة إنشاء جميع الجداول بهيكل صحيح
-            self.recreate_all_tables()
+            # تطبيق ترحيلات المخطط غير المطبقة فقط
+            self.run_migrations()
             
         except Exception as e:
             logger.error(f"❌ خطأ في الاتصال بقاعدة البيانات (المحاولة {retry_count + 1}): {str(e)}")
@@ -270,555 +473,945 @@ class DatabaseManager:
             else:
                 logger.error("❌ فشل جميع محاولات الاتصال بقاعدة البيانات")
 
-    def recreate_all_tables(self):
-        """إعادة إنشاء جميع الجداول بهيكل صحيح"""
+    def is_connection_healthy(self, conn):
+        """فحص صلاحية الاتصال قبل إعارته"""
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        # فحص فعلي فقط للاتصالات الخاملة لفترة طويلة لتجنب رحلة إضافية لكل استعلام
+        if time.time() - self.last_used.get(id(conn), 0) > self.healthcheck_idle:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                conn.rollback()
+            except Exception:
+                return False
+        return True
+
+    @contextmanager
+    def get_connection(self):
+        """استعارة اتصال من المجمع وإعادته بعد الانتهاء"""
+        if self.pool is None or self.pool.closed:
+            self.reconnect()
+            if self.pool is None:
+                raise psycopg2.InterfaceError("Database pool is not available")
+        
+        self.pool_slots.acquire()
+        pool = self.pool
+        conn = None
+        discard = False
         try:
-            with self.connection.cursor() as cursor:
-                # حذف جميع الجداول القديمة بشكل منفصل لتجنب deadlock
-                tables_to_drop = [
-                    'referral_commissions', 'referral_earnings', 'referral_settings', 'referrals',
-                    'accounts', 'wallets', 'transactions', 'payment_methods',
-                    'withdraw_methods', 'banned_users', 'system_settings',
-                    'pending_withdrawals', 'payment_requests', 'maintenance',
-                    'loyalty_points', 'loyalty_points_history', 'loyalty_rewards',
-                    'loyalty_redemptions', 'loyalty_settings',
-                    'compensation_requests', 'compensation_settings', 'first_deposit_tracking','support_requests','gift_transactions','gift_codes','gift_code_usage','dice_settings','dice_cooldown','dice_plays','dice_rewards','dice_settings'
-            ]
-                for table in tables_to_drop:
-                    try:
-                        cursor.execute(f"DROP TABLE IF EXISTS {table} CASCADE")
-                    except Exception as e:
-                        logger.error(f"❌ خطأ في حذف الجدول {table}: {str(e)}")
+            for _ in range(self.max_connections + 1):
+                conn = pool.getconn()
+                if self.is_connection_healthy(conn):
+                    break
+                logger.warning("🔄 استبدال اتصال تالف في مجمع الاتصالات")
+                self.last_used.pop(id(conn), None)
+                pool.putconn(conn, close=True)
+                conn = None
+            if conn is None:
+                raise psycopg2.InterfaceError("No healthy database connection available")
+            conn.autocommit = False
+            yield conn
+        except (psycopg2.InterfaceError, psycopg2.OperationalError):
+            discard = True
+            raise
+        finally:
+            if conn is not None:
+                try:
+                    if not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                        conn.rollback()
+                except Exception:
+                    discard = True
+                discard = discard or bool(conn.closed)
+                if discard:
+                    self.last_used.pop(id(conn), None)
+                else:
+                    self.last_used[id(conn)] = time.time()
+                try:
+                    pool.putconn(conn, close=discard)
+                except Exception as e:
+                    logger.error(f"❌ خطأ في إعادة الاتصال للمجمع: {str(e)}")
+            self.pool_slots.release()
+
+    def get_migrations(self):
+        """قائمة ترحيلات المخطط المرتبة حسب رقم الإصدار"""
+        return [
+            (1, 'الهيكل الأساسي للجداول والبيانات الافتراضية', self.migration_001_base_schema),
+            (2, 'الفهارس الثانوية لعمليات البحث المتكررة', self.migration_002_secondary_indexes),
+            (3, 'الطابور الدائم لعمليات الحسابات', self.migration_003_account_jobs),
+            (4, 'دليل معرفات لاعبي الوكيل', self.migration_004_agent_players),
+            (5, 'نقاط استئناف الإرسال الجماعي', self.migration_005_broadcast_checkpoints),
+            (6, 'مخزن حالات المحادثة', self.migration_006_conversation_state),
+            (7, 'مجاميع الإيداع والسحب بالساعة', self.migration_007_transaction_hourly_totals),
+            (8, 'فهرس ترتيب نقاط الامتياز', self.migration_008_loyalty_points_rank),
+            (9, 'لقطات إحصائيات الإدارة', self.migration_009_stats_rollups),
+            (10, 'حذف فهرس النقاط المكرر', self.migration_010_drop_duplicate_loyalty_index),
+            (11, 'حجز الإرسال الجماعي لنسخة واحدة', self.migration_011_broadcast_lease),
+        ]
 
-                # إنشاء الجداول بهيكل موحد وصحيح
-            
-                # ==================== الجداول الأساسية ====================
-            
-                # جدول الحسابات
-                cursor.execute('''
-                    CREATE TABLE accounts (
-                        chat_id TEXT PRIMARY KEY,
-                        username TEXT NOT NULL,
-                        password TEXT NOT NULL,
-                        player_id TEXT,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-            
-                # جدول المحافظ
-                cursor.execute('''
-                    CREATE TABLE wallets (
-                        chat_id TEXT PRIMARY KEY,
-                        balance DECIMAL(15, 2) DEFAULT 0.0,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-            
-                # جدول المعاملات
-                cursor.execute('''
-                    CREATE TABLE transactions (
-                        transaction_id TEXT PRIMARY KEY,
-                        user_id TEXT NOT NULL,
-                        type TEXT NOT NULL,
-                        amount DECIMAL(15, 2) NOT NULL,
-                        description TEXT,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-            
-                # جدول طرق الدفع
-                cursor.execute('''
-                    CREATE TABLE payment_methods (
-                        method_id TEXT PRIMARY KEY,
-                        name TEXT NOT NULL,
-                        address TEXT NOT NULL,
-                        min_amount DECIMAL(15, 2) NOT NULL,
-                        exchange_rate DECIMAL(10, 4) DEFAULT 1.0,
-                        active BOOLEAN DEFAULT TRUE,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-            
-                # جدول طرق السحب
-                cursor.execute('''
-                    CREATE TABLE withdraw_methods (
-                        method_id TEXT PRIMARY KEY,
-                        name TEXT NOT NULL,
-                        commission_rate DECIMAL(5, 4) NOT NULL,
-                        active BOOLEAN DEFAULT TRUE,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-            
-                # جدول المستخدمين المحظورين
-                cursor.execute('''
-                    CREATE TABLE banned_users (
-                        user_id TEXT PRIMARY KEY,
-                        banned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        banned_by TEXT NOT NULL
-                    )
-                ''')
-            
-                # جدول إعدادات النظام
-                cursor.execute('''
-                    CREATE TABLE system_settings (
-                        setting_key TEXT PRIMARY KEY,
-                        setting_value TEXT NOT NULL,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-            
-                # جدول طلبات السحب المعلقة
-                cursor.execute('''
-                    CREATE TABLE pending_withdrawals (
-                        withdrawal_id TEXT PRIMARY KEY,
-                        user_id TEXT NOT NULL,
-                        amount DECIMAL(15, 2) NOT NULL,
-                        method_id TEXT NOT NULL,
-                        address TEXT NOT NULL,
-                        status TEXT DEFAULT 'pending',
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        completed_at TIMESTAMP,
-                        group_message_id TEXT,
-                        group_chat_id TEXT
-                    )
-                ''')
-            
-                # جدول طلبات الدفع
-                cursor.execute('''
-                    CREATE TABLE payment_requests (
-                        request_id TEXT PRIMARY KEY,
-                        user_id TEXT NOT NULL,
-                        amount DECIMAL(15, 2) NOT NULL,
-                        method_id TEXT NOT NULL,
-                        transaction_id TEXT NOT NULL,
-                        status TEXT DEFAULT 'pending',
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        approved_at TIMESTAMP,
-                        rejected_at TIMESTAMP,
-                        group_message_id TEXT,
-                        group_chat_id TEXT
-                    )
-                ''')
-            
-                # جدول الصيانة
-                cursor.execute('''
-                    CREATE TABLE maintenance (
-                        maintenance_key TEXT PRIMARY KEY,
-                        active BOOLEAN DEFAULT FALSE,
-                        message TEXT,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-            
-                # ==================== نظام الإحالات ====================
-            
-                # جدول الإحالات
-                cursor.execute('''
-                    CREATE TABLE referrals (
-                        referrer_id TEXT NOT NULL,
-                        referred_id TEXT NOT NULL,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        PRIMARY KEY (referrer_id, referred_id)
-                    )
-                ''')
-            
-                # جدول نسب الإحالات
-                cursor.execute('''
-                    CREATE TABLE referral_commissions (
-                        referral_id SERIAL PRIMARY KEY,
-                        referrer_id TEXT NOT NULL,
-                        referred_id TEXT NOT NULL,
-                        transaction_type TEXT NOT NULL,
-                        amount DECIMAL(15, 2) NOT NULL,
-                        net_loss DECIMAL(15, 2) DEFAULT 0,
-                        commission_rate DECIMAL(5, 4) DEFAULT 0.1,
-                        commission_amount DECIMAL(15, 2) DEFAULT 0,
-                        status TEXT DEFAULT 'pending',
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        processed_at TIMESTAMP
-                    )
-                ''')
-            
-                # جدول إعدادات الإحالات
-                cursor.execute('''
-                    CREATE TABLE referral_settings (
-                        setting_key TEXT PRIMARY KEY,
-                        setting_value TEXT NOT NULL,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-            
-                # جدول مستحقات الإحالات
-                cursor.execute('''
-                    CREATE TABLE referral_earnings (
-                        referrer_id TEXT PRIMARY KEY,
-                        pending_commission DECIMAL(15, 2) DEFAULT 0,
-                        total_commission DECIMAL(15, 2) DEFAULT 0,
-                        last_payout TIMESTAMP,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-            
-                # ==================== نظام نقاط الامتياز ====================
-            
-                # جدول نقاط الامتياز
-                cursor.execute('''
-                    CREATE TABLE loyalty_points (
-                        user_id TEXT PRIMARY KEY,
-                        points INTEGER DEFAULT 0,
-                        last_reset TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-            
-                # جدول سجل نقاط الامتياز
-                cursor.execute('''
-                    CREATE TABLE loyalty_points_history (
-                        history_id SERIAL PRIMARY KEY,
-                        user_id TEXT NOT NULL,
-                        points_change INTEGER NOT NULL,
-                        reason TEXT NOT NULL,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-            
-                # جدول الجوائز
-                cursor.execute('''
-                    CREATE TABLE loyalty_rewards (
-                        reward_id TEXT PRIMARY KEY,
-                        name TEXT NOT NULL,
-                        description TEXT,
-                        points_cost INTEGER NOT NULL,
-                        discount_rate DECIMAL(5,2) DEFAULT 0,
-                        active BOOLEAN DEFAULT TRUE,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-            
-                # جدول طلبات استبدال النقاط
-                cursor.execute('''
-                    CREATE TABLE loyalty_redemptions (
-                        redemption_id TEXT PRIMARY KEY,
-                        user_id TEXT NOT NULL,
-                        reward_id TEXT NOT NULL,
-                        points_cost INTEGER NOT NULL,
-                        status TEXT DEFAULT 'pending',
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        processed_at TIMESTAMP,
-                        admin_notes TEXT
-                    )
-                ''')
-            
-                # جدول إعدادات نظام النقاط
-                cursor.execute('''
-                    CREATE TABLE loyalty_settings (
-                        setting_key TEXT PRIMARY KEY,
-                        setting_value TEXT NOT NULL,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-            
-                # ==================== نظام التعويض ====================
-            
-                # جدول طلبات التعويض
-                cursor.execute('''
-                    CREATE TABLE compensation_requests (
-                        request_id TEXT PRIMARY KEY,
-                        user_id TEXT NOT NULL,
-                        amount DECIMAL(15, 2) NOT NULL,
-                        net_loss DECIMAL(15, 2) NOT NULL,
-                        status TEXT DEFAULT 'pending',
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        approved_at TIMESTAMP,
-                        rejected_at TIMESTAMP,
-                        group_message_id TEXT,
-                        group_chat_id TEXT
-                    )
-                ''')
-            
-                # جدول إعدادات نظام التعويض
-                cursor.execute('''
-                    CREATE TABLE compensation_settings (
-                        setting_key TEXT PRIMARY KEY,
-                        setting_value TEXT NOT NULL,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-            
-                # ==================== جداول إضافية ====================
-            
-                # جدول تتبع أول إيداع
-                cursor.execute('''
-                    CREATE TABLE first_deposit_tracking (
-                        user_id TEXT PRIMARY KEY,
-                        referrer_id TEXT NOT NULL,
-                        bonus_awarded BOOLEAN DEFAULT FALSE,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-            
-                # ==================== إدخال البيانات الافتراضية ====================
-            
-                # إدخال إعدادات الصيانة الافتراضية
-                cursor.execute('''
-                    INSERT INTO maintenance (maintenance_key, active, message) 
-                    VALUES ('main', FALSE, 'البوت في حالة صيانة مؤقتة، يرجى التحلي بالصبر.')
-                    ON CONFLICT (maintenance_key) DO NOTHING
-                ''')
-            
-                # إدخال إعدادات الإحالات الافتراضية
-                next_payout = datetime.now() + timedelta(days=10)
-                cursor.execute('''
-                    INSERT INTO referral_settings (setting_key, setting_value) 
-                    VALUES 
-                        ('commission_rate', '0.1'),
-                        ('payout_days', '10'),
-                        ('last_payout_date', %s),
-                        ('next_payout_date', %s)
-                    ON CONFLICT (setting_key) DO NOTHING
-                ''', (datetime.now().isoformat(), next_payout.isoformat()))
-            
-                # إدخال إعدادات نقاط الامتياز الافتراضية
-                cursor.execute('''
-                    INSERT INTO loyalty_settings (setting_key, setting_value) VALUES 
-                        ('points_per_10000', '1'),
-                        ('min_redemption_points', '100'),
-                        ('reset_days', '30'),
-                        ('redemption_enabled', 'false'),
-                        ('referral_points', '1'),
-                        ('first_deposit_bonus', '3')
-                ON CONFLICT (setting_key) DO NOTHING
-                ''')
-            
-                # إدخال إعدادات التعويض الافتراضية
-                cursor.execute('''
-                    INSERT INTO compensation_settings (setting_key, setting_value) VALUES 
-                        ('compensation_rate', '0.1'),
-                        ('min_loss_amount', '10000'),
-                        ('compensation_enabled', 'true')
-                    ON CONFLICT (setting_key) DO NOTHING
-                ''')
-            
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS compensation_tracking (
-                        user_id TEXT PRIMARY KEY,
-                        last_compensation_loss DECIMAL(15, 2) DEFAULT 0,
-                        last_compensation_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
+    def run_migrations(self):
+        """تطبيق ترحيلات المخطط غير المطبقة فقط دون حذف أي بيانات"""
+        migrations = self.get_migrations()
+        latest_version = migrations[-1][0]
+        
+        # مسار سريع: المخطط محدث بالفعل في هذه العملية (مثلاً عند إعادة الاتصال)
+        if self.schema_version >= latest_version:
+            return True
+        
+        try:
+            with self.get_connection() as conn, conn.cursor() as cursor:
+                # قراءة الإصدار بلا أي DDL، فالإقلاع العادي لمخطط محدث لا ينشئ شيئاً ولا يأخذ القفل
+                cursor.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+                current_version = 0
+                if cursor.fetchone()[0]:
+                    cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+                    current_version = cursor.fetchone()[0]
+                
+                if current_version < latest_version:
+                    # قفل استشاري قبل أي DDL حتى لا تنشئ أو ترحل عدة نسخ من البوت المخطط في نفس الوقت
+                    cursor.execute('SELECT pg_advisory_xact_lock(%s)', (SCHEMA_MIGRATION_LOCK_ID,))
+                    cursor.execute('''
+                        CREATE TABLE IF NOT EXISTS schema_version (
+                            version INTEGER PRIMARY KEY,
+                            description TEXT,
+                            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                        )
+                    ''')
+                    cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+                    current_version = cursor.fetchone()[0]
+                    
+                    for version, description, migrate in migrations:
+                        if version <= current_version:
+                            continue
+                        logger.info(f"🔧 تطبيق ترحيل المخطط {version}: {description}")
+                        migrate(cursor)
+                        cursor.execute(
+                            'INSERT INTO schema_version (version, description) VALUES (%s, %s)',
+                            (version, description)
+                        )
+                        current_version = version
+                
+                conn.commit()
+                self.schema_version = current_version
+                logger.info(f"✅ مخطط قاعدة البيانات محدث (الإصدار {current_version})")
+                return True
             
-                # جدول طلبات الدعم
-                cursor.execute("""
-                CREATE TABLE support_requests (
-                    request_id TEXT PRIMARY KEY,
-                    user_id TEXT NOT NULL,
-                    username TEXT,
-                    message_text TEXT,
-                    photo_id TEXT,
-                    status TEXT DEFAULT 'pending',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    admin_chat_id TEXT,
-                    admin_message_id TEXT
+        except Exception as e:
+            logger.error(f"❌ خطأ في تطبيق ترحيلات المخطط: {str(e)}")
+            return False
+
+    def migration_001_base_schema(self, cursor):
+        """الترحيل 1: إنشاء الجداول الأساسية وإدخال الإعدادات الافتراضية"""
+        # ==================== الجداول الأساسية ====================
+    
+        # جدول الحسابات
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS accounts (
+                chat_id TEXT PRIMARY KEY,
+                username TEXT NOT NULL,
+                password TEXT NOT NULL,
+                player_id TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+    
+        # جدول المحافظ
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS wallets (
+                chat_id TEXT PRIMARY KEY,
+                balance DECIMAL(15, 2) DEFAULT 0.0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+    
+        # جدول المعاملات
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS transactions (
+                transaction_id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                type TEXT NOT NULL,
+                amount DECIMAL(15, 2) NOT NULL,
+                description TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+    
+        # جدول طرق الدفع
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS payment_methods (
+                method_id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                address TEXT NOT NULL,
+                min_amount DECIMAL(15, 2) NOT NULL,
+                exchange_rate DECIMAL(10, 4) DEFAULT 1.0,
+                active BOOLEAN DEFAULT TRUE,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+    
+        # جدول طرق السحب
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS withdraw_methods (
+                method_id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                commission_rate DECIMAL(5, 4) NOT NULL,
+                active BOOLEAN DEFAULT TRUE,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+    
+        # جدول المستخدمين المحظورين
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS banned_users (
+                user_id TEXT PRIMARY KEY,
+                banned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                banned_by TEXT NOT NULL
+            )
+        ''')
+    
+        # جدول إعدادات النظام
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS system_settings (
+                setting_key TEXT PRIMARY KEY,
+                setting_value TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+    
+        # جدول طلبات السحب المعلقة
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS pending_withdrawals (
+                withdrawal_id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                amount DECIMAL(15, 2) NOT NULL,
+                method_id TEXT NOT NULL,
+                address TEXT NOT NULL,
+                status TEXT DEFAULT 'pending',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                completed_at TIMESTAMP,
+                group_message_id TEXT,
+                group_chat_id TEXT
+            )
+        ''')
+    
+        # جدول طلبات الدفع
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS payment_requests (
+                request_id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                amount DECIMAL(15, 2) NOT NULL,
+                method_id TEXT NOT NULL,
+                transaction_id TEXT NOT NULL,
+                status TEXT DEFAULT 'pending',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                approved_at TIMESTAMP,
+                rejected_at TIMESTAMP,
+                group_message_id TEXT,
+                group_chat_id TEXT
+            )
+        ''')
+    
+        # جدول الصيانة
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS maintenance (
+                maintenance_key TEXT PRIMARY KEY,
+                active BOOLEAN DEFAULT FALSE,
+                message TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+    
+        # ==================== نظام الإحالات ====================
+    
+        # جدول الإحالات
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS referrals (
+                referrer_id TEXT NOT NULL,
+                referred_id TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (referrer_id, referred_id)
+            )
+        ''')
+    
+        # جدول نسب الإحالات
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS referral_commissions (
+                referral_id SERIAL PRIMARY KEY,
+                referrer_id TEXT NOT NULL,
+                referred_id TEXT NOT NULL,
+                transaction_type TEXT NOT NULL,
+                amount DECIMAL(15, 2) NOT NULL,
+                net_loss DECIMAL(15, 2) DEFAULT 0,
+                commission_rate DECIMAL(5, 4) DEFAULT 0.1,
+                commission_amount DECIMAL(15, 2) DEFAULT 0,
+                status TEXT DEFAULT 'pending',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                processed_at TIMESTAMP
+            )
+        ''')
+    
+        # جدول إعدادات الإحالات
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS referral_settings (
+                setting_key TEXT PRIMARY KEY,
+                setting_value TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+    
+        # جدول مستحقات الإحالات
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS referral_earnings (
+                referrer_id TEXT PRIMARY KEY,
+                pending_commission DECIMAL(15, 2) DEFAULT 0,
+                total_commission DECIMAL(15, 2) DEFAULT 0,
+                last_payout TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+    
+        # ==================== نظام نقاط الامتياز ====================
+    
+        # جدول نقاط الامتياز
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS loyalty_points (
+                user_id TEXT PRIMARY KEY,
+                points INTEGER DEFAULT 0,
+                last_reset TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+    
+        # جدول سجل نقاط الامتياز
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS loyalty_points_history (
+                history_id SERIAL PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                points_change INTEGER NOT NULL,
+                reason TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+    
+        # جدول الجوائز
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS loyalty_rewards (
+                reward_id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                description TEXT,
+                points_cost INTEGER NOT NULL,
+                discount_rate DECIMAL(5,2) DEFAULT 0,
+                active BOOLEAN DEFAULT TRUE,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+    
+        # جدول طلبات استبدال النقاط
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS loyalty_redemptions (
+                redemption_id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                reward_id TEXT NOT NULL,
+                points_cost INTEGER NOT NULL,
+                status TEXT DEFAULT 'pending',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                processed_at TIMESTAMP,
+                admin_notes TEXT
+            )
+        ''')
+    
+        # جدول إعدادات نظام النقاط
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS loyalty_settings (
+                setting_key TEXT PRIMARY KEY,
+                setting_value TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+    
+        # ==================== نظام التعويض ====================
+    
+        # جدول طلبات التعويض
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS compensation_requests (
+                request_id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                amount DECIMAL(15, 2) NOT NULL,
+                net_loss DECIMAL(15, 2) NOT NULL,
+                status TEXT DEFAULT 'pending',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                approved_at TIMESTAMP,
+                rejected_at TIMESTAMP,
+                group_message_id TEXT,
+                group_chat_id TEXT
+            )
+        ''')
+    
+        # جدول إعدادات نظام التعويض
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS compensation_settings (
+                setting_key TEXT PRIMARY KEY,
+                setting_value TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+    
+        # ==================== جداول إضافية ====================
+    
+        # جدول تتبع أول إيداع
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS first_deposit_tracking (
+                user_id TEXT PRIMARY KEY,
+                referrer_id TEXT NOT NULL,
+                bonus_awarded BOOLEAN DEFAULT FALSE,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+    
+        # ==================== إدخال البيانات الافتراضية ====================
+    
+        # إدخال إعدادات الصيانة الافتراضية
+        cursor.execute('''
+            INSERT INTO maintenance (maintenance_key, active, message) 
+            VALUES ('main', FALSE, 'البوت في حالة صيانة مؤقتة، يرجى التحلي بالصبر.')
+            ON CONFLICT (maintenance_key) DO NOTHING
+        ''')
+    
+        # إدخال إعدادات الإحالات الافتراضية
+        next_payout = datetime.now() + timedelta(days=10)
+        cursor.execute('''
+            INSERT INTO referral_settings (setting_key, setting_value) 
+            VALUES 
+                ('commission_rate', '0.1'),
+                ('payout_days', '10'),
+                ('last_payout_date', %s),
+                ('next_payout_date', %s)
+            ON CONFLICT (setting_key) DO NOTHING
+        ''', (datetime.now().isoformat(), next_payout.isoformat()))
+    
+        # إدخال إعدادات نقاط الامتياز الافتراضية
+        cursor.execute('''
+            INSERT INTO loyalty_settings (setting_key, setting_value) VALUES 
+                ('points_per_10000', '1'),
+                ('min_redemption_points', '100'),
+                ('reset_days', '30'),
+                ('redemption_enabled', 'false'),
+                ('referral_points', '1'),
+                ('first_deposit_bonus', '3')
+        ON CONFLICT (setting_key) DO NOTHING
+        ''')
+    
+        # إدخال إعدادات التعويض الافتراضية
+        cursor.execute('''
+            INSERT INTO compensation_settings (setting_key, setting_value) VALUES 
+                ('compensation_rate', '0.1'),
+                ('min_loss_amount', '10000'),
+                ('compensation_enabled', 'true')
+            ON CONFLICT (setting_key) DO NOTHING
+        ''')
+    
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS compensation_tracking (
+                user_id TEXT PRIMARY KEY,
+                last_compensation_loss DECIMAL(15, 2) DEFAULT 0,
+                last_compensation_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+    
+        # جدول طلبات الدعم
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS support_requests (
+            request_id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            username TEXT,
+            message_text TEXT,
+            photo_id TEXT,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            admin_chat_id TEXT,
+            admin_message_id TEXT
 )
-                """)
-                cursor.execute("""
-                CREATE TABLE gift_transactions (
-                    gift_id TEXT PRIMARY KEY,
-                    from_user_id TEXT NOT NULL,
-                    to_user_id TEXT NOT NULL,
-                    amount DECIMAL(15, 2) NOT NULL,
-                    commission DECIMAL(15, 2) NOT NULL,
-                    net_amount DECIMAL(15, 2) NOT NULL,
-                    status TEXT DEFAULT 'completed',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        """)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS gift_transactions (
+            gift_id TEXT PRIMARY KEY,
+            from_user_id TEXT NOT NULL,
+            to_user_id TEXT NOT NULL,
+            amount DECIMAL(15, 2) NOT NULL,
+            commission DECIMAL(15, 2) NOT NULL,
+            net_amount DECIMAL(15, 2) NOT NULL,
+            status TEXT DEFAULT 'completed',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 )
-                """)
-                
-                # جدول أكواد الهدايا
-                cursor.execute("""
-                CREATE TABLE gift_codes (
-                    code TEXT PRIMARY KEY,
-                    amount DECIMAL(15, 2) NOT NULL,
-                    max_uses INTEGER NOT NULL,
-                    used_count INTEGER DEFAULT 0,
-                    created_by TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    expires_at TIMESTAMP,
-                    active BOOLEAN DEFAULT TRUE
+        """)
+        
+        # جدول أكواد الهدايا
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS gift_codes (
+            code TEXT PRIMARY KEY,
+            amount DECIMAL(15, 2) NOT NULL,
+            max_uses INTEGER NOT NULL,
+            used_count INTEGER DEFAULT 0,
+            created_by TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP,
+            active BOOLEAN DEFAULT TRUE
 )
 """)
 
-                # جدول استخدامات أكواد الهدايا
-                cursor.execute("""
-                CREATE TABLE gift_code_usage (
-                    usage_id SERIAL PRIMARY KEY,
-                    code TEXT NOT NULL,
-                    user_id TEXT NOT NULL,
-                    used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    amount_received DECIMAL(15, 2) NOT NULL
+        # جدول استخدامات أكواد الهدايا
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS gift_code_usage (
+            usage_id SERIAL PRIMARY KEY,
+            code TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            amount_received DECIMAL(15, 2) NOT NULL
 )
 """)
-                
-                # جدول إعدادات النرد
-                cursor.execute("""
-                CREATE TABLE dice_settings (
-                    setting_key TEXT PRIMARY KEY,
-                    setting_value TEXT NOT NULL,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        
+        # جدول إعدادات النرد
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS dice_settings (
+            setting_key TEXT PRIMARY KEY,
+            setting_value TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 )
-                """)
-
-                # جدول جوايز النرد
-                cursor.execute("""
-                CREATE TABLE dice_rewards (
-                    dice_value INTEGER PRIMARY KEY,
-                    reward_type TEXT NOT NULL,
-                    reward_value DECIMAL(15, 2) NOT NULL,
-                    description TEXT,
-                    active BOOLEAN DEFAULT TRUE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        """)
+
+        # جدول جوايز النرد
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS dice_rewards (
+            dice_value INTEGER PRIMARY KEY,
+            reward_type TEXT NOT NULL,
+            reward_value DECIMAL(15, 2) NOT NULL,
+            description TEXT,
+            active BOOLEAN DEFAULT TRUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 )
 """)
 
-                # جدول سجل لعب النرد
-                cursor.execute("""
-                CREATE TABLE dice_plays (
-                    play_id TEXT PRIMARY KEY,
-                    user_id TEXT NOT NULL,
-                    dice_value INTEGER NOT NULL,
-                    amount_paid DECIMAL(15, 2) NOT NULL,
-                    reward_type TEXT,
-                    reward_value DECIMAL(15, 2),
-                    final_reward DECIMAL(15, 2),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        # جدول سجل لعب النرد
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS dice_plays (
+            play_id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            dice_value INTEGER NOT NULL,
+            amount_paid DECIMAL(15, 2) NOT NULL,
+            reward_type TEXT,
+            reward_value DECIMAL(15, 2),
+            final_reward DECIMAL(15, 2),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 )
 """)
 
-                # جدول منع المستخدمين
-                cursor.execute("""
-                CREATE TABLE dice_cooldown (
-                    user_id TEXT PRIMARY KEY,
-                    last_play TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        # جدول منع المستخدمين
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS dice_cooldown (
+            user_id TEXT PRIMARY KEY,
+            last_play TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 )
 """)
 
-                # إدخال الإعدادات الافتراضية
-                cursor.execute("""
-                INSERT INTO dice_settings (setting_key, setting_value) VALUES 
-                ('dice_enabled', 'true'),
-                ('dice_price', '100'),
-                ('cooldown_hours', '24')
-                ON CONFLICT (setting_key) DO NOTHING
+        # إدخال الإعدادات الافتراضية
+        cursor.execute("""
+        INSERT INTO dice_settings (setting_key, setting_value) VALUES 
+        ('dice_enabled', 'true'),
+        ('dice_price', '100'),
+        ('cooldown_hours', '24')
+        ON CONFLICT (setting_key) DO NOTHING
 """)
 
-                
-                cursor.execute("""
-                    CREATE TABLE user_titles (
-                        user_id TEXT PRIMARY KEY,
-                        title TEXT NOT NULL,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS user_titles (
+                user_id TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )
 """)
-                # جدول الرسائل الجماعية
-                cursor.execute("""
-                CREATE TABLE broadcast_messages (
-                    message_id TEXT PRIMARY KEY,
-                    message_text TEXT NOT NULL,
-                    sent_count INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    sent_at TIMESTAMP,
-                    status TEXT DEFAULT 'pending'
+        # جدول الرسائل الجماعية
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_messages (
+            message_id TEXT PRIMARY KEY,
+            message_text TEXT NOT NULL,
+            sent_count INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP,
+            status TEXT DEFAULT 'pending'
 )
 """)
-                
-                # إدخال الجوايز الافتراضية
-                default_rewards = [
-                    (1, 'fixed', '50', 'جائزة ثابتة للرقم 1'),
-                    (2, 'fixed', '100', 'جائزة ثابتة للرقم 2'),
-                    (3, 'percentage', '10', '10% من آخر عملية دفع'),
-                    (4, 'percentage', '20', '20% من آخر عملية دفع'),
-                    (5, 'fixed', '200', 'جائزة ثابتة للرقم 5'),
-                    (6, 'bonus', '500', 'جائزة الحظ السعيد')
+        
+        # إدخال الجوايز الافتراضية
+        default_rewards = [
+            (1, 'fixed', '50', 'جائزة ثابتة للرقم 1'),
+            (2, 'fixed', '100', 'جائزة ثابتة للرقم 2'),
+            (3, 'percentage', '10', '10% من آخر عملية دفع'),
+            (4, 'percentage', '20', '20% من آخر عملية دفع'),
+            (5, 'fixed', '200', 'جائزة ثابتة للرقم 5'),
+            (6, 'bonus', '500', 'جائزة الحظ السعيد')
 ]
 
-                for reward in default_rewards:
-                    cursor.execute("""
-                    INSERT INTO dice_rewards (dice_value, reward_type, reward_value, description)
-                    VALUES (%s, %s, %s, %s)
-                    ON CONFLICT (dice_value) DO NOTHING
-                    """, reward)
-                
-                
-                
-                
-                # إدخال الجوائز الافتراضية
-                default_rewards = [
-                    ('reward_1', '10$', 'رصيد 10 دولار', 250, 0),
-                    ('reward_2', '100$', 'رصيد 100 دولار', 2500, 7),
-                    ('reward_3', 'Apple AirPods Pro 3', 'سماعات أبل برو 3', 4500, 0),
-                    ('reward_4', 'XBOX Series X', 'جهاز إكس بوكس سيريس X', 10000, 0),
-                    ('reward_5', 'PlayStation 5', 'جهاز بلايستيشن 5', 10500, 0),
-                    ('reward_6', '500$', 'رصيد 500 دولار', 12500, 10),
-                    ('reward_7', 'GOLD Coin', 'عملة ذهبية', 16000, 0),
-                    ('reward_8', 'Samsung Galaxy S25 Ultra', 'سامسونج جلاكسي S25 الترا', 22000, 0),
-                    ('reward_9', 'iPhone 16 Pro Max', 'آيفون 16 برو ماكس', 28000, 0)
-                ]
-            
-                for reward in default_rewards:
-                    cursor.execute('''
-                        INSERT INTO loyalty_rewards (reward_id, name, description, points_cost, discount_rate)
-                        VALUES (%s, %s, %s, %s, %s)
-                        ON CONFLICT (reward_id) DO NOTHING
-                    ''', reward)
+        for reward in default_rewards:
+            cursor.execute("""
+            INSERT INTO dice_rewards (dice_value, reward_type, reward_value, description)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (dice_value) DO NOTHING
+            """, reward)
+        
+        
+        
+        
+        # إدخال الجوائز الافتراضية
+        default_rewards = [
+            ('reward_1', '10$', 'رصيد 10 دولار', 250, 0),
+            ('reward_2', '100$', 'رصيد 100 دولار', 2500, 7),
+            ('reward_3', 'Apple AirPods Pro 3', 'سماعات أبل برو 3', 4500, 0),
+            ('reward_4', 'XBOX Series X', 'جهاز إكس بوكس سيريس X', 10000, 0),
+            ('reward_5', 'PlayStation 5', 'جهاز بلايستيشن 5', 10500, 0),
+            ('reward_6', '500$', 'رصيد 500 دولار', 12500, 10),
+            ('reward_7', 'GOLD Coin', 'عملة ذهبية', 16000, 0),
+            ('reward_8', 'Samsung Galaxy S25 Ultra', 'سامسونج جلاكسي S25 الترا', 22000, 0),
+            ('reward_9', 'iPhone 16 Pro Max', 'آيفون 16 برو ماكس', 28000, 0)
+        ]
+    
+        for reward in default_rewards:
+            cursor.execute('''
+                INSERT INTO loyalty_rewards (reward_id, name, description, points_cost, discount_rate)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (reward_id) DO NOTHING
+            ''', reward)
+
+    def migration_002_secondary_indexes(self, cursor):
+        """الترحيل 2: إنشاء الفهارس الثانوية المدارة"""
+        for index_name, table, columns in DATABASE_INDEXES:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table} ({columns})")
+        cursor.execute(f"ANALYZE {', '.join(sorted({table for _, table, _ in DATABASE_INDEXES}))}")
+
+    def migration_003_account_jobs(self, cursor):
+        """الترحيل 3: جدول المهام الدائم لعمليات الحسابات"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS account_jobs (
+                job_id BIGSERIAL PRIMARY KEY,
+                task_type TEXT NOT NULL,
+                chat_id TEXT NOT NULL,
+                payload JSONB NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                step TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL DEFAULT 5,
+                idempotency_key TEXT UNIQUE,
+                available_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                locked_by TEXT,
+                locked_until TIMESTAMP,
+                last_error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # فهارس جزئية للمهام غير المنتهية فقط حتى يبقى الحجز سريعاً مع تراكم السجل
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_account_jobs_claim
+            ON account_jobs (status, available_at, job_id)
+            WHERE status IN ('pending', 'running')
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_account_jobs_chat_open
+            ON account_jobs (chat_id, job_id)
+            WHERE status IN ('pending', 'running')
+        ''')
+
+    def migration_004_agent_players(self, cursor):
+        """الترحيل 4: دليل أسماء مستخدمي الوكيل ومعرفاتهم"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS agent_players (
+                username TEXT PRIMARY KEY,
+                player_id TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+    def migration_005_broadcast_checkpoints(self, cursor):
+        """الترحيل 5: تتبع تقدم الإرسال الجماعي والمستخدمين الذين حظروا البوت"""
+        cursor.execute('''
+            ALTER TABLE broadcast_messages
+                ADD COLUMN IF NOT EXISTS failed_count INTEGER DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS blocked_count INTEGER DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS total_count INTEGER DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS last_chat_id TEXT,
+                ADD COLUMN IF NOT EXISTS admin_chat_id TEXT,
+                ADD COLUMN IF NOT EXISTS progress_message_id BIGINT,
+                ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_blocked_chats (
+                chat_id TEXT PRIMARY KEY,
+                reason TEXT,
+                blocked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+    def migration_006_conversation_state(self, cursor):
+        """الترحيل 6: حالات المحادثات متعددة الخطوات لمخزن postgres"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS conversation_state (
+                chat_id TEXT PRIMARY KEY,
+                data JSONB NOT NULL,
+                expires_at TIMESTAMP NOT NULL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_conversation_state_expires ON conversation_state (expires_at)')
+
+    def migration_007_transaction_hourly_totals(self, cursor):
+        """الترحيل 7: مجاميع الإيداع والسحب لكل مستخدم بالساعة، مع تعبئة آخر 25 ساعة من المعاملات"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS transaction_hourly_totals (
+                user_id TEXT NOT NULL,
+                bucket_hour TIMESTAMP NOT NULL,
+                deposits DECIMAL(15, 2) NOT NULL DEFAULT 0,
+                withdrawals DECIMAL(15, 2) NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, bucket_hour)
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_transaction_hourly_totals_hour ON transaction_hourly_totals (bucket_hour)')
+        cursor.execute('''
+            INSERT INTO transaction_hourly_totals (user_id, bucket_hour, deposits, withdrawals)
+            SELECT user_id, date_trunc('hour', created_at),
+                   COALESCE(SUM(amount) FILTER (WHERE type = 'deposit'), 0),
+                   COALESCE(SUM(amount) FILTER (WHERE type = 'withdraw'), 0)
+            FROM transactions
+            WHERE type IN ('deposit', 'withdraw')
+              AND created_at >= date_trunc('hour', NOW() - INTERVAL '24 hours')
+            GROUP BY user_id, date_trunc('hour', created_at)
+            ON CONFLICT (user_id, bucket_hour) DO NOTHING
+        ''')
+
+    def migration_008_loyalty_points_rank(self, cursor):
+        """الترحيل 8: فهرس جزئي على النقاط تنازلياً لتحميل الترتيب وأفضل المستخدمين"""
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_loyalty_points_rank
+            ON loyalty_points (points DESC, user_id) WHERE points > 0
+        ''')
+
+    def migration_009_stats_rollups(self, cursor):
+        """الترحيل 9: مجاميع يومية للمقاييس ولقطات جاهزة للوحات الإحصائيات"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stats_daily (
+                stat_date DATE NOT NULL,
+                metric TEXT NOT NULL,
+                count BIGINT NOT NULL DEFAULT 0,
+                total DECIMAL(20, 2) NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (metric, stat_date)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stats_snapshots (
+                panel TEXT PRIMARY KEY,
+                data JSONB NOT NULL,
+                computed_at TIMESTAMP NOT NULL
+            )
+        ''')
+        # الضغط التزايدي يقرأ الأيام الأخيرة فقط من جداول الأحداث
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_gift_transactions_created ON gift_transactions (created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_dice_plays_created ON dice_plays (created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_loyalty_points_history_created ON loyalty_points_history (created_at)')
+
+    def migration_010_drop_duplicate_loyalty_index(self, cursor):
+        """الترحيل 10: حذف idx_loyalty_points_points لأن idx_loyalty_points_rank يغطي نفس الترتيب"""
+        cursor.execute('DROP INDEX IF EXISTS idx_loyalty_points_points')
+
+    def migration_011_broadcast_lease(self, cursor):
+        """الترحيل 11: مالك الإرسال الجماعي ومهلة حجزه حتى لا تستأنفه عدة نسخ معاً"""
+        cursor.execute('''
+            ALTER TABLE broadcast_messages
+                ADD COLUMN IF NOT EXISTS owner TEXT,
+                ADD COLUMN IF NOT EXISTS locked_until TIMESTAMP
+        ''')
+
+    @contextmanager
+    def transaction(self):
+        """تنفيذ عدة استعلامات على اتصال واحد وحفظها معاً مرة واحدة"""
+        current = getattr(self.local, 'transaction', None)
+        if current is not None:
+            # معاملة متداخلة: تنضم للمعاملة الخارجية في نفس الخيط
+            yield current
+            return
+        
+        with self.get_connection() as conn:
+            state = {'conn': conn, 'error': None, 'after_commit': []}
+            self.local.transaction = state
+            try:
+                yield state
+                if state['error'] is not None:
+                    raise state['error']
+                conn.commit()
+            finally:
+                self.local.transaction = None
+        
+        # آثار الذاكرة تطبق فقط بعد الحفظ الفعلي، وتسقط مع المعاملة عند التراجع
+        for callback in state['after_commit']:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"❌ خطأ في تنفيذ إجراء ما بعد الحفظ: {str(e)}")
 
-                self.connection.commit()
-                logger.info("✅ تم إنشاء جميع الجداول بنجاح بهيكل موحد ومصحح")
-            
+    def on_commit(self, callback):
+        """تنفيذ callback بعد حفظ المعاملة الجارية، أو فوراً إذا لم تكن هناك معاملة"""
+        state = getattr(self.local, 'transaction', None)
+        if state is None:
+            callback()
+        else:
+            state['after_commit'].append(callback)
+
+    def run_in_transaction(self, func, *args, **kwargs):
+        """تشغيل دالة داخل معاملة واحدة مع إعادة المحاولة عند تعارض التسلسل أو الجمود"""
+        for attempt in range(self.transaction_retries):
+            try:
+                with self.transaction():
+                    return func(*args, **kwargs)
+            except psycopg2.Error as e:
+                if e.pgcode not in TRANSACTION_RETRY_PGCODES or attempt == self.transaction_retries - 1:
+                    raise
+                delay = 0.05 * (2 ** attempt) * random.uniform(0.5, 1.5)
+                logger.warning(f"🔄 إعادة تنفيذ المعاملة بعد تعارض ({e.pgcode}) خلال {delay:.2f} ثانية")
+                time.sleep(delay)
+
+    def execute_in_transaction(self, state, query, params=None):
+        """تنفيذ استعلام ضمن المعاملة الجارية دون حفظ منفصل"""
+        if state['error'] is not None:
+            # المعاملة فشلت بالفعل وسيتم التراجع عنها عند الخروج
+            return False
+        try:
+            with state['conn'].cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute(query, params or ())
+                return cursor.fetchall() if cursor.description else True
         except Exception as e:
-            logger.error(f"❌ خطأ في إنشاء الجداول: {str(e)}")
-            if self.connection:
-                self.connection.rollback()
+            logger.error(f"❌ خطأ في تنفيذ الاستعلام داخل المعاملة: {str(e)}")
+            state['error'] = e
+            return False
 
     def execute_query(self, query, params=None):
+        state = getattr(self.local, 'transaction', None)
+        if state is not None:
+            return self.execute_in_transaction(state, query, params)
+        
         try:
-            if not self.connection or self.connection.closed:
-                self.reconnect()
-                if not self.connection:
-                    return False
-                    
-            with self.connection.cursor(cursor_factory=RealDictCursor) as cursor:
-                cursor.execute(query, params or ())
-                if query.strip().upper().startswith('SELECT'):
-                    result = cursor.fetchall()
+            with self.get_connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                    cursor.execute(query, params or ())
+                    if query.strip().upper().startswith('SELECT'):
+                        result = cursor.fetchall()
+                        return result
+                    # استعلامات التعديل مع RETURNING تعيد الصفوف بعد الحفظ
+                    result = cursor.fetchall() if cursor.description else True
+                    conn.commit()
                     return result
-                self.connection.commit()
-                return True
         except psycopg2.InterfaceError:
             logger.warning("🔄 إعادة الاتصال بقاعدة البيانات...")
-            self.reconnect()
             return False
         except Exception as e:
             logger.error(f"❌ خطأ في تنفيذ الاستعلام: {str(e)}")
-            if self.connection:
-                self.connection.rollback()
             return False
 
+    def stream_query(self, query, params=None, itersize=None):
+        """قراءة نتيجة استعلام على دفعات عبر مؤشر مسمى في الخادم بدلاً من fetchall"""
+        with self.get_connection() as conn:
+            cursor_name = f"stream_{threading.get_ident()}_{int(time.time() * 1000)}"
+            with conn.cursor(name=cursor_name, cursor_factory=RealDictCursor) as cursor:
+                cursor.itersize = itersize or EXPORT_FETCH_SIZE
+                cursor.execute(query, params or ())
+                for row in cursor:
+                    yield row
+
+    def create_listener_connection(self):
+        """اتصال مستقل خارج المجمع لاستقبال إشعارات LISTEN"""
+        database_url = os.getenv('DATABASE_URL')
+        if database_url.startswith('postgres://'):
+            database_url = database_url.replace('postgres://', 'postgresql://', 1)
+        conn = psycopg2.connect(database_url, connect_timeout=30, keepalives=1, keepalives_idle=30)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        return conn
+
     def reconnect(self):
-        try:
-            if self.connection:
-                self.connection.close()
-            self.connect_with_retry()
-        except Exception as e:
-            logger.error(f"❌ خطأ في إعادة الاتصال: {str(e)}")
+        with self.pool_lock:
+            try:
+                if self.pool is not None and not self.pool.closed:
+                    # خيط آخر أعاد إنشاء المجمع بالفعل
+                    return
+                if self.pool is not None:
+                    self.pool.closeall()
+                self.pool = None
+                self.last_used.clear()
+                self.connect_with_retry()
+            except Exception as e:
+                logger.error(f"❌ خطأ في إعادة الاتصال: {str(e)}")
 
 # إنشاء مدير قاعدة البيانات
 db_manager = DatabaseManager()
 
+# ===============================================================
+# تصدير البيانات
+# ===============================================================
+
+def export_date_filter(column, start_date=None, end_date=None):
+    """شرط WHERE اختياري لنطاق التاريخ (البداية شاملة والنهاية غير شاملة)"""
+    conditions = []
+    params = []
+    if start_date:
+        conditions.append(f"{column} >= %s")
+        params.append(start_date)
+    if end_date:
+        conditions.append(f"{column} < %s")
+        params.append(end_date)
+    return (' AND '.join(conditions) or 'TRUE'), params
+
+def export_start_from_days(param):
+    """بداية نطاق التصدير من معامل الزر بعدد الأيام الأخيرة، و all أو فارغ يعني كل البيانات"""
+    if param and param.isdigit() and int(param) > 0:
+        return datetime.now() - timedelta(days=int(param))
+    return None
+
+def send_csv_export(chat_id, filename, header, query, params, format_row, caption, compress=None):
+    """كتابة نتيجة الاستعلام كملف CSV صفاً بصف في ملف مؤقت ثم إرساله، يعيد عدد الصفوف المصدرة"""
+    compress = EXPORT_GZIP if compress is None else compress
+    
+    with SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_SIZE) as spool:
+        raw = gzip.GzipFile(filename=filename, fileobj=spool, mode='wb') if compress else spool
+        text = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+        writer = csv.writer(text)
+        writer.writerow(header)
+        
+        row_count = 0
+        for row in db_manager.stream_query(query, params):
+            writer.writerow(format_row(row))
+            row_count += 1
+        
+        text.flush()
+        text.detach()
+        if compress:
+            # إغلاق GzipFile يكتب نهاية الضغط دون إغلاق الملف المؤقت
+            raw.close()
+        
+        if row_count == 0:
+            return 0
+        
+        spool.seek(0)
+        bot.send_document(
+            chat_id,
+            (f"{filename}.gz" if compress else filename, spool),
+            caption=caption.format(count=row_count),
+            parse_mode="HTML"
+        )
+        logger.info(f"📤 تم تصدير {row_count} صف إلى {filename} للمستخدم {chat_id}")
+        return row_count
+
 # ===============================================================
 # دوال المساعدة المحسنة مع الهيكل الجديد
 # ===============================================================
@@ -842,52 +1435,106 @@ def get_wallet_balance(chat_id):
     return 0.0
 
 def update_wallet_balance(chat_id, amount):
-    """تحديث رصيد محفظة المستخدم"""
+    """تحديث رصيد محفظة المستخدم بشكل ذري داخل قاعدة البيانات"""
     try:
-        current_balance = get_wallet_balance(chat_id)
-        
-        # تحويل جميع القيم إلى float لتجنب مشكلة decimal
-        current_balance_float = float(current_balance)
-        amount_float = float(amount)
-        new_balance = current_balance_float + amount_float
-        
-        success = db_manager.execute_query(
+        # الجمع يتم في PostgreSQL بنوع NUMERIC لتجنب ضياع التحديثات المتزامنة وأخطاء float
+        result = db_manager.execute_query(
             """INSERT INTO wallets (chat_id, balance) 
                VALUES (%s, %s) 
                ON CONFLICT (chat_id) 
-               DO UPDATE SET balance = EXCLUDED.balance, updated_at = CURRENT_TIMESTAMP""",
-            (str(chat_id), new_balance)
+               DO UPDATE SET balance = wallets.balance + EXCLUDED.balance, updated_at = CURRENT_TIMESTAMP
+               RETURNING balance""",
+            (str(chat_id), Decimal(str(amount)))
         )
         
-        if success:
-            logger.info(f"تم تحديث رصيد المحفظة {chat_id}: {current_balance} -> {new_balance} ✔")
+        if result:
+            user_profiles.invalidate(chat_id)
+            new_balance = float(result[0]['balance'])
+            logger.info(f"تم تحديث رصيد المحفظة {chat_id}: {amount:+} -> {new_balance} ✔")
             return new_balance
         else:
-            logger.error(f"فشل في تحديث رصيد المحفظة {chat_id}: {current_balance} ✘")
-            return current_balance
+            logger.error(f"فشل في تحديث رصيد المحفظة {chat_id} بمقدار {amount} ✘")
+            return get_wallet_balance(chat_id)
             
     except Exception as e:
         logger.error(f"خطأ في تحديث رصيد المحفظة: {str(e)} ✘")
         return get_wallet_balance(chat_id)
 
-def load_accounts():
-    """تحميل جميع الحسابات"""
-    result = db_manager.execute_query('SELECT * FROM accounts')
-    accounts = {}
-    if result:
-        for row in result:
-            accounts[row['chat_id']] = {
-                'username': row['username'],
-                'password': row['password'],
-                'playerId': row['player_id'],
-                'created_at': row['created_at'].timestamp() if row['created_at'] else time.time()
-            }
-    return accounts
+def debit_wallet_balance(chat_id, amount):
+    """خصم مشروط من المحفظة لا يسمح بالرصيد السالب، يعيد الرصيد الجديد أو None إذا كان غير كافي"""
+    try:
+        amount_decimal = Decimal(str(amount))
+        result = db_manager.execute_query(
+            """UPDATE wallets 
+               SET balance = balance - %s, updated_at = CURRENT_TIMESTAMP 
+               WHERE chat_id = %s AND balance >= %s
+               RETURNING balance""",
+            (amount_decimal, str(chat_id), amount_decimal)
+        )
+        
+        if result:
+            user_profiles.invalidate(chat_id)
+            new_balance = float(result[0]['balance'])
+            logger.info(f"تم خصم {amount} من المحفظة {chat_id} -> {new_balance} ✔")
+            return new_balance
+        
+        logger.info(f"رصيد المحفظة {chat_id} غير كافي لخصم {amount} ✘")
+        return None
+        
+    except Exception as e:
+        logger.error(f"خطأ في خصم رصيد المحفظة: {str(e)} ✘")
+        return None
 
-def save_accounts(accounts):
-    """حفظ جميع الحسابات"""
-    for chat_id, account_data in accounts.items():
-        success = db_manager.execute_query('''
+class AccountRepository:
+    """حسابات 55BETS حسب chat_id مع ذاكرة LRU محدودة بدلاً من تحميل الجدول كاملاً"""
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries or ACCOUNT_CACHE_MAX_ENTRIES
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    @staticmethod
+    def row_to_account(row):
+        return {
+            'username': row['username'],
+            'password': row['password'],
+            'playerId': row['player_id'],
+            'created_at': row['created_at'].timestamp() if row['created_at'] else time.time()
+        }
+
+    def remember(self, chat_id, account):
+        with self.lock:
+            self.entries[chat_id] = account
+            self.entries.move_to_end(chat_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get(self, chat_id):
+        """جلب حساب المستخدم أو None، الحسابات غير الموجودة لا تُخزن حتى يظهر الحساب الجديد فوراً"""
+        chat_id = str(chat_id)
+        with self.lock:
+            account = self.entries.get(chat_id)
+            if account is not None:
+                self.entries.move_to_end(chat_id)
+                return dict(account)
+
+        result = db_manager.execute_query(
+            'SELECT username, password, player_id, created_at FROM accounts WHERE chat_id = %s',
+            (chat_id,)
+        )
+        if not result:
+            return None
+
+        account = self.row_to_account(result[0])
+        self.remember(chat_id, account)
+        return dict(account)
+
+    def exists(self, chat_id):
+        return self.get(chat_id) is not None
+
+    def put(self, chat_id, account_data):
+        """حفظ حساب مستخدم واحد"""
+        chat_id = str(chat_id)
+        result = db_manager.execute_query('''
             INSERT INTO accounts (chat_id, username, password, player_id) 
             VALUES (%s, %s, %s, %s)
             ON CONFLICT (chat_id) 
@@ -895,18 +1542,29 @@ def save_accounts(accounts):
                 username = EXCLUDED.username,
                 password = EXCLUDED.password,
                 player_id = EXCLUDED.player_id
+            RETURNING username, password, player_id, created_at
         ''', (
-            str(chat_id),
+            chat_id,
             account_data.get('username'),
             account_data.get('password'),
             account_data.get('playerId')
         ))
-        if not success:
+        user_profiles.invalidate(chat_id)
+        if not result:
+            self.invalidate(chat_id)
             return False
-    return True
 
-def load_payment_methods():
-    """تحميل طرق الدفع"""
+        self.remember(chat_id, self.row_to_account(result[0]))
+        return True
+
+    def invalidate(self, chat_id):
+        with self.lock:
+            self.entries.pop(str(chat_id), None)
+
+account_repository = AccountRepository()
+
+def load_payment_methods():
+    """تحميل طرق الدفع"""
     result = db_manager.execute_query('SELECT * FROM payment_methods')
     methods = {}
     if result:
@@ -1017,27 +1675,338 @@ def save_transactions(transactions):
             return False
     return True
 
+# ===============================================================
+# نظام حالات المحادثة
+# ===============================================================
+
+class MemoryConversationBackend:
+    """مخزن في الذاكرة محدود الحجم (LRU) مع انتهاء صلاحية لكل محادثة"""
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, chat_id):
+        with self.lock:
+            entry = self.entries.get(chat_id)
+            if entry is None:
+                return None
+            if entry[1] < time.time():
+                del self.entries[chat_id]
+                return None
+            self.entries.move_to_end(chat_id)
+            return entry[0]
+
+    def set(self, chat_id, data):
+        with self.lock:
+            self.entries[chat_id] = (dict(data), time.time() + self.ttl)
+            self.entries.move_to_end(chat_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, chat_id):
+        with self.lock:
+            return self.entries.pop(chat_id, None) is not None
+
+    def items(self):
+        now = time.time()
+        with self.lock:
+            return [(chat_id, entry[0]) for chat_id, entry in self.entries.items() if entry[1] >= now]
+
+class PostgresConversationBackend:
+    """مخزن في PostgreSQL مشترك بين نسخ البوت بتسلسل JSON مضغوط"""
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.last_purge = 0
+
+    def get(self, chat_id):
+        result = db_manager.execute_query(
+            'SELECT data FROM conversation_state WHERE chat_id = %s AND expires_at > NOW()',
+            (chat_id,)
+        )
+        return dict(result[0]['data']) if result else None
+
+    def set(self, chat_id, data):
+        db_manager.execute_query('''
+            INSERT INTO conversation_state (chat_id, data, expires_at)
+            VALUES (%s, %s, NOW() + %s * INTERVAL '1 second')
+            ON CONFLICT (chat_id) DO UPDATE SET data = EXCLUDED.data, expires_at = EXCLUDED.expires_at
+        ''', (chat_id, json.dumps(data, separators=(',', ':'), ensure_ascii=False, default=str), self.ttl))
+        self.purge_expired()
+
+    def delete(self, chat_id):
+        result = db_manager.execute_query('DELETE FROM conversation_state WHERE chat_id = %s RETURNING chat_id', (chat_id,))
+        return bool(result) and result is not True
+
+    def items(self):
+        result = db_manager.execute_query('SELECT chat_id, data FROM conversation_state WHERE expires_at > NOW()')
+        return [(row['chat_id'], dict(row['data'])) for row in result or []]
+
+    def purge_expired(self):
+        if time.time() - self.last_purge < 300:
+            return
+        self.last_purge = time.time()
+        db_manager.execute_query('DELETE FROM conversation_state WHERE expires_at <= NOW()')
+
+class ConversationData(dict):
+    """بيانات محادثة تحفظ نفسها في المخزن عند أي تعديل مثل user_data[chat_id]['state'] = ..."""
+    def __init__(self, store, chat_id, data):
+        super().__init__(data)
+        self.store = store
+        self.chat_id = chat_id
+
+    def save(self):
+        self.store.backend.set(self.chat_id, self)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.save()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.save()
+
+    def pop(self, key, *default):
+        value = super().pop(key, *default)
+        self.save()
+        return value
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self.save()
+
+    def setdefault(self, key, default=None):
+        value = super().setdefault(key, default)
+        self.save()
+        return value
+
+    def clear(self):
+        super().clear()
+        self.save()
+
+class ConversationStore(MutableMapping):
+    """واجهة قاموس user_data فوق مخزن قابل للاستبدال"""
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getitem__(self, chat_id):
+        data = self.backend.get(str(chat_id))
+        if data is None:
+            raise KeyError(chat_id)
+        return ConversationData(self, str(chat_id), data)
+
+    def __setitem__(self, chat_id, data):
+        self.backend.set(str(chat_id), dict(data))
+
+    def __delitem__(self, chat_id):
+        if not self.backend.delete(str(chat_id)):
+            raise KeyError(chat_id)
+
+    def __contains__(self, chat_id):
+        return self.backend.get(str(chat_id)) is not None
+
+    def __iter__(self):
+        return iter([chat_id for chat_id, data in self.backend.items()])
+
+    def __len__(self):
+        return len(self.backend.items())
+
+    def items(self):
+        return [(chat_id, ConversationData(self, chat_id, data)) for chat_id, data in self.backend.items()]
+
+if CONVERSATION_STORE_BACKEND == 'postgres':
+    user_data = ConversationStore(PostgresConversationBackend(CONVERSATION_STORE_TTL))
+else:
+    user_data = ConversationStore(MemoryConversationBackend(CONVERSATION_STORE_MAX_ENTRIES, CONVERSATION_STORE_TTL))
+logger.info(f"✅ مخزن حالات المحادثة: {CONVERSATION_STORE_BACKEND}")
+
+class ConversationStates:
+    """سجل حالة ← معالج لرسائل المحادثات متعددة الخطوات مع انتقالات معلنة ومهلة للمحادثات المتروكة"""
+    def __init__(self, default_timeout):
+        self.default_timeout = default_timeout
+        self.states = {}
+        self.seen = {}
+        self.sweeper_started = False
+
+    def on(self, state, next_states=(), timeout=None):
+        """مزخرف لتسجيل معالج حالة والحالات التي يمكنه الانتقال إليها"""
+        def decorator(handler):
+            self.states[state] = {
+                'handler': handler,
+                'next_states': set(next_states),
+                'timeout': timeout or self.default_timeout,
+            }
+            return handler
+        return decorator
+
+    def current_state(self, chat_id):
+        data = user_data.get(chat_id)
+        return data.get('state') if data else None
+
+    def handles(self, message):
+        return self.current_state(str(message.chat.id)) in self.states
+
+    def dispatch(self, message):
+        chat_id = str(message.chat.id)
+        state = self.current_state(chat_id)
+        entry = self.states.get(state)
+        if entry is None:
+            return
+        
+        entry['handler'](message)
+        
+        # البقاء في نفس الحالة (إدخال خاطئ) أو إنهاء المحادثة مسموحان دائماً
+        new_state = self.current_state(chat_id)
+        if new_state not in (None, state) and new_state not in entry['next_states']:
+            logger.warning(f"⚠️ انتقال غير معلن في المحادثة: {state} ← {new_state}")
+
+    def expire_abandoned(self):
+        """إلغاء المحادثات التي بقيت في نفس الحالة أطول من مهلتها"""
+        now = time.time()
+        active = {}
+        for chat_id, data in list(user_data.items()):
+            state = data.get('state') if isinstance(data, dict) else None
+            if not state:
+                continue
+            previous = self.seen.get(chat_id)
+            since = previous[1] if previous and previous[0] == state else now
+            active[chat_id] = (state, since)
+            
+            timeout = self.states.get(state, {}).get('timeout', self.default_timeout)
+            if now - since > timeout:
+                user_data.pop(chat_id, None)
+                active.pop(chat_id, None)
+                logger.info(f"⌛ انتهت مهلة المحادثة {state} للمستخدم {chat_id}")
+                try:
+                    bot.send_message(chat_id, "⌛ انتهت مهلة العملية الحالية، يرجى البدء من جديد.")
+                except Exception:
+                    pass
+        self.seen = active
+
+    def start_sweeper(self, interval=60):
+        if self.sweeper_started:
+            return
+        self.sweeper_started = True
+        
+        def sweep_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.expire_abandoned()
+                except Exception as e:
+                    logger.error(f"خطأ في تنظيف المحادثات المتروكة: {e}")
+        
+        threading.Thread(target=sweep_loop, daemon=True, name="conversation-sweeper").start()
+
+conversation_states = ConversationStates(CONVERSATION_STATE_TIMEOUT)
+
+# ===============================================================
+# ذاكرة الإعدادات المشتركة
+# ===============================================================
+
+class SettingsCache:
+    """ذاكرة موحدة لجداول الإعدادات تحمل مرة واحدة وتبطل عند الحفظ من أي نسخة للبوت"""
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        # عداد لكل إعداد يزيد مع كل إبطال حتى لا يكتب تحميل قديم قيمته بعد الإبطال
+        self.generations = {}
+        self.generation = 0
+        self.lock = Lock()
+        self.listener_started = False
+
+    def get(self, name, loader):
+        """المحمل يعيد (القيم, loaded) و loaded خطأ يعني قيم افتراضية بسبب فشل القراءة فلا تخزن"""
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry and time.time() - entry[1] < self.ttl:
+                # نسخة حتى لا يعدل المستدعي القيم المخزنة
+                return dict(entry[0])
+            generation = (self.generation, self.generations.get(name, 0))
+        value, loaded = loader()
+        with self.lock:
+            if loaded and generation == (self.generation, self.generations.get(name, 0)):
+                self.entries[name] = (value, time.time())
+        return dict(value)
+
+    def invalidate_local(self, name=None):
+        with self.lock:
+            if name:
+                self.entries.pop(name, None)
+                self.generations[name] = self.generations.get(name, 0) + 1
+            else:
+                self.entries.clear()
+                self.generation += 1
+
+    def invalidate(self, name):
+        """إبطال الإعداد محلياً وإشعار باقي النسخ عبر NOTIFY"""
+        self.invalidate_local(name)
+        db_manager.execute_query(f"NOTIFY {SETTINGS_NOTIFY_CHANNEL}, %s", (name,))
+
+    def start_listener(self):
+        if self.listener_started:
+            return
+        self.listener_started = True
+        threading.Thread(target=self.listen_loop, daemon=True, name="settings-listener").start()
+
+    def listen_loop(self):
+        while True:
+            conn = None
+            try:
+                conn = db_manager.create_listener_connection()
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {SETTINGS_NOTIFY_CHANNEL}")
+                # أي تغيير أثناء الانقطاع فات إشعاره
+                self.invalidate_local()
+                logger.info("👂 الاستماع لتغييرات الإعدادات")
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        self.invalidate_local(notify.payload or None)
+            except Exception as e:
+                logger.error(f"❌ خطأ في مستمع الإعدادات: {e}")
+                time.sleep(5)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+settings_cache = SettingsCache(SETTINGS_CACHE_TTL)
+
 def load_maintenance():
     """تحميل إعدادات الصيانة"""
+    return settings_cache.get('maintenance', fetch_maintenance)
+
+def fetch_maintenance():
+    """قراءة إعدادات الصيانة من قاعدة البيانات"""
     result = db_manager.execute_query('SELECT * FROM maintenance WHERE maintenance_key = %s', ('main',))
     if result and len(result) > 0:
         return {
             'active': result[0]['active'],
             'message': result[0]['message']
-        }
-    return {'active': False, 'message': 'البوت في حالة صيانة مؤقتة، يرجى التحلي بالصبر.'}
+        }, True
+    return {'active': False, 'message': 'البوت في حالة صيانة مؤقتة، يرجى التحلي بالصبر.'}, result is not False
 
 def save_maintenance(maintenance):
     """حفظ إعدادات الصيانة"""
-    return db_manager.execute_query('''
-        INSERT INTO maintenance (maintenance_key, active, message) 
-        VALUES ('main', %s, %s)
-        ON CONFLICT (maintenance_key) 
-        DO UPDATE SET 
-            active = EXCLUDED.active,
-            message = EXCLUDED.message,
-            updated_at = CURRENT_TIMESTAMP
-    ''', (maintenance.get('active', False), maintenance.get('message', '')))
+    try:
+        return db_manager.execute_query('''
+            INSERT INTO maintenance (maintenance_key, active, message) 
+            VALUES ('main', %s, %s)
+            ON CONFLICT (maintenance_key) 
+            DO UPDATE SET 
+                active = EXCLUDED.active,
+                message = EXCLUDED.message,
+                updated_at = CURRENT_TIMESTAMP
+        ''', (maintenance.get('active', False), maintenance.get('message', '')))
+    finally:
+        settings_cache.invalidate('maintenance')
 
 def load_pending_withdrawals():
     """تحميل طلبات السحب المعلقة"""
@@ -1282,32 +2251,80 @@ def is_user_banned(user_id):
 
 def ban_user(user_id):
     """حظر مستخدم"""
-    return db_manager.execute_query(
+    result = db_manager.execute_query(
         'INSERT INTO banned_users (user_id, banned_by) VALUES (%s, %s) ON CONFLICT (user_id) DO NOTHING',
         (str(user_id), ADMIN_CHAT_ID)
     )
+    user_profiles.invalidate(user_id)
+    return result
 
 def unban_user(user_id):
     """فك حظر مستخدم"""
-    return db_manager.execute_query(
+    result = db_manager.execute_query(
         'DELETE FROM banned_users WHERE user_id = %s',
         (str(user_id),)
     )
+    user_profiles.invalidate(user_id)
+    return result
 
 def is_maintenance_mode():
     """التحقق من وضع الصيانة"""
     maintenance = load_maintenance()
     return maintenance.get('active', False)
 
-def is_user_subscribed(user_id):
+class SubscriptionCache:
+    """نتائج التحقق من الاشتراك في القناة مع مدة صلاحية مختلفة للمشترك وغير المشترك"""
+    def __init__(self, positive_ttl, negative_ttl, max_entries):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, user_id):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None or entry[1] < time.time():
+                return None
+            return entry[0]
+
+    def set(self, user_id, subscribed):
+        ttl = self.positive_ttl if subscribed else self.negative_ttl
+        with self.lock:
+            self.entries[user_id] = (subscribed, time.time() + ttl)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+subscription_cache = SubscriptionCache(SUBSCRIPTION_POSITIVE_TTL, SUBSCRIPTION_NEGATIVE_TTL, SUBSCRIPTION_CACHE_MAX_ENTRIES)
+
+def is_user_subscribed(user_id, force=False):
     """التحقق من اشتراك المستخدم في القناة"""
+    user_id = str(user_id)
+    if not force:
+        cached = subscription_cache.get(user_id)
+        if cached is not None:
+            return cached
     try:
         chat_member = bot.get_chat_member(CHANNEL_ID, user_id)
-        return chat_member.status in ['member', 'administrator', 'creator']
+        subscribed = chat_member.status in SUBSCRIBED_STATUSES
+        subscription_cache.set(user_id, subscribed)
+        return subscribed
     except Exception as e:
         logger.error(f"❌ خطأ في التحقق من الاشتراك: {str(e)}")
         return False
 
+def is_subscription_channel(chat):
+    """هل المحادثة هي قناة الاشتراك الإجباري"""
+    if CHANNEL_ID and str(chat.id) == str(CHANNEL_ID):
+        return True
+    return bool(CHANNEL_USERNAME and chat.username and chat.username.lower() == CHANNEL_USERNAME.lstrip('@').lower())
+
+@bot.chat_member_handler(func=lambda update: is_subscription_channel(update.chat))
+def handle_channel_member_update(update):
+    """تحديث ذاكرة الاشتراك من تحديثات أعضاء القناة (يتطلب أن يكون البوت مشرفاً فيها)"""
+    subscription_cache.set(str(update.new_chat_member.user.id), update.new_chat_member.status in SUBSCRIBED_STATUSES)
+
 def generate_suffix():
     """إنشاء لاحقة عشوائية"""
     return ''.join(random.choices("ABCDEFGHJKLMNPQRSTUVWXYZ23456789", k=4))
@@ -1316,26 +2333,154 @@ def add_transaction(transaction_data):
     """إضافة معاملة جديدة"""
     transaction_id = str(int(time.time() * 1000))
     
-    success = db_manager.execute_query(
-        "INSERT INTO transactions (transaction_id, user_id, type, amount, description) "
-        "VALUES (%s, %s, %s, %s, %s)",
-        (transaction_id, transaction_data.get('user_id'), transaction_data.get('type'),
-         transaction_data.get('amount'), transaction_data.get('description'))
-    )
+    # المعاملة ومجموع ساعتها يكتبان في استعلام واحد حتى لا يختلفا أبداً
+    success = db_manager.execute_query("""
+        WITH t AS (
+            INSERT INTO transactions (transaction_id, user_id, type, amount, description)
+            VALUES (%s, %s, %s, %s, %s)
+            RETURNING user_id, type, amount, created_at
+        )
+        INSERT INTO transaction_hourly_totals (user_id, bucket_hour, deposits, withdrawals)
+        SELECT user_id, date_trunc('hour', created_at),
+               CASE WHEN type = 'deposit' THEN amount ELSE 0 END,
+               CASE WHEN type = 'withdraw' THEN amount ELSE 0 END
+        FROM t
+        WHERE type IN ('deposit', 'withdraw')
+        ON CONFLICT (user_id, bucket_hour) DO UPDATE SET
+            deposits = transaction_hourly_totals.deposits + EXCLUDED.deposits,
+            withdrawals = transaction_hourly_totals.withdrawals + EXCLUDED.withdrawals
+    """, (transaction_id, transaction_data.get('user_id'), transaction_data.get('type'),
+          transaction_data.get('amount'), transaction_data.get('description')))
     
     return transaction_id if success else None  # ✅ إرجاع transaction_id
 
+class TransactionBuckets:
+    """خسارة آخر 24 ساعة من مجاميع الساعات (25 صفاً كحد أقصى) بدلاً من جمع جدول المعاملات"""
+    def __init__(self, retention_hours=48):
+        self.retention_hours = retention_hours
+        self.pruner_started = False
+
+    def loss_summary(self, user_id):
+        """الإيداعات والسحوبات والخسارة الإجمالية والمتاحة للتعويض وآخر تعويض في قراءة واحدة"""
+        # الساعة الأولى في النافذة جزئية: يطرح منها ما سبق بداية الـ 24 ساعة من جدول العمليات
+        result = db_manager.execute_query("""
+            SELECT s.deposits - p.deposits AS deposits,
+                   s.withdrawals - p.withdrawals AS withdrawals,
+                   c.last_compensation_loss, c.last_compensation_date
+            FROM (SELECT NOW() - INTERVAL '24 hours' AS since) w
+            CROSS JOIN LATERAL (
+                SELECT COALESCE(SUM(deposits), 0) AS deposits,
+                       COALESCE(SUM(withdrawals), 0) AS withdrawals
+                FROM transaction_hourly_totals
+                WHERE user_id = %s AND bucket_hour >= date_trunc('hour', w.since)
+            ) s
+            CROSS JOIN LATERAL (
+                SELECT COALESCE(SUM(amount) FILTER (WHERE type = 'deposit'), 0) AS deposits,
+                       COALESCE(SUM(amount) FILTER (WHERE type = 'withdraw'), 0) AS withdrawals
+                FROM transactions
+                WHERE user_id = %s AND type IN ('deposit', 'withdraw')
+                  AND created_at >= date_trunc('hour', w.since) AND created_at < w.since
+            ) p
+            LEFT JOIN compensation_tracking c
+                ON c.user_id = %s AND c.last_compensation_date >= w.since
+        """, (str(user_id), str(user_id), str(user_id)))
+        if not result:
+            return None
+        
+        row = result[0]
+        deposits = float(row['deposits'])
+        withdrawals = float(row['withdrawals'])
+        compensated_loss = float(row['last_compensation_loss'] or 0)
+        gross_net_loss = deposits - withdrawals
+        return {
+            'deposits': deposits,
+            'withdrawals': withdrawals,
+            'gross_net_loss': max(0, gross_net_loss),
+            'compensated_loss': compensated_loss,
+            'last_compensation_date': row['last_compensation_date'],
+            'net_loss': max(0, gross_net_loss - compensated_loss)
+        }
+
+    def prune(self):
+        """حذف مجاميع الساعات التي خرجت من نافذة الحساب"""
+        return db_manager.execute_query(
+            "DELETE FROM transaction_hourly_totals WHERE bucket_hour < NOW() - %s * INTERVAL '1 hour'",
+            (self.retention_hours,)
+        )
+
+    def start_pruner(self, interval=3600):
+        if self.pruner_started:
+            return
+        self.pruner_started = True
+        
+        def prune_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.prune()
+                except Exception as e:
+                    logger.error(f"خطأ في تنظيف مجاميع المعاملات: {e}")
+        
+        threading.Thread(target=prune_loop, daemon=True, name="transaction-buckets-pruner").start()
+
+transaction_buckets = TransactionBuckets()
+
 def get_cashier_balance_via_agent():
+    balance = fetch_cashier_balance()
+    return balance if balance is not None else 0.0
+
+def fetch_cashier_balance():
+    """جلب رصيد الكاشير من الوكيل، يعيد None عند الفشل"""
     result = agent.get_cashier_balance()
     if result and "error" not in result:
         wallets = result.get("wallets", []) or result.get("result", [])
         if isinstance(wallets, list) and len(wallets) > 0:
             return float(wallets[0].get("balance", 0))
-    return 0.0
+    return None
+
+class CashierBalanceCache:
+    """رصيد الكاشير مخزن محلياً ينقص مع كل شحن ناجح ويعاد جلبه عند انتهاء الصلاحية أو أي فشل"""
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.balance = None
+        self.fetched_at = 0
+        self.lock = Lock()
+
+    def is_fresh(self):
+        return self.balance is not None and time.time() - self.fetched_at < self.ttl
+
+    def refresh(self):
+        balance = fetch_cashier_balance()
+        with self.lock:
+            if balance is None:
+                self.balance = None
+            else:
+                self.balance = balance
+                self.fetched_at = time.time()
+        return balance
+
+    def peek(self):
+        """الرصيد المخزن الصالح فقط بدون أي اتصال بالشبكة"""
+        with self.lock:
+            return self.balance if self.is_fresh() else None
+
+    def adjust(self, delta):
+        with self.lock:
+            if self.balance is not None:
+                self.balance += delta
+
+    def invalidate(self):
+        with self.lock:
+            self.balance = None
+
+cashier_balance_cache = CashierBalanceCache(CASHIER_BALANCE_TTL)
 
 def check_cashier_balance_sufficient(amount):
     """التحقق من كفاية رصيد الكاشير"""
-    cashier_balance = get_cashier_balance_via_agent()
+    cashier_balance = cashier_balance_cache.peek()
+    if cashier_balance is None or cashier_balance < amount:
+        # لا يوجد رصيد صالح أو قد يكون قديماً (شحن الكاشير يدوياً مثلاً)، نجلبه قبل الرفض
+        cashier_balance = cashier_balance_cache.refresh() or 0.0
     logger.info(f"رصيد الكاشير الحالي: {cashier_balance}, المبلغ المطلوب: {amount}")
     return cashier_balance >= amount
 
@@ -1432,46 +2577,68 @@ def get_loyalty_points(user_id):
 
 def add_loyalty_points(user_id, points, reason):
     """إضافة نقاط امتياز للمستخدم"""
+    return add_loyalty_points_bulk([(user_id, points, reason)])
+
+def add_loyalty_points_bulk(awards):
+    """إضافة نقاط لعدة مستخدمين (user_id, points, reason) مع التصفير الدوري والسجل في استعلام واحد"""
+    awards = [(str(user_id), int(points), reason) for user_id, points, reason in awards]
+    if not awards:
+        return True
+    
     try:
-        # التحقق من انتهاء فترة التصفير
-        result = db_manager.execute_query(
-            'SELECT last_reset FROM loyalty_points WHERE user_id = %s',
-            (str(user_id),)
-        )
-        
-        if result and len(result) > 0:
-            last_reset = result[0]['last_reset']
-            reset_days = int(load_loyalty_settings().get('reset_days', 30))
-            if (datetime.now() - last_reset).days >= reset_days:
-                # تصفير النقاط
-                db_manager.execute_query(
-                    'UPDATE loyalty_points SET points = 0, last_reset = CURRENT_TIMESTAMP WHERE user_id = %s',
-                    (str(user_id),)
-                )
-        
-        # إضافة النقاط
-        success = db_manager.execute_query("""
-            INSERT INTO loyalty_points (user_id, points) 
-            VALUES (%s, %s)
-            ON CONFLICT (user_id) 
-            DO UPDATE SET points = loyalty_points.points + EXCLUDED.points,
-                         updated_at = CURRENT_TIMESTAMP
-        """, (str(user_id), points))
-        
-        if success:
-            # تسجيل في السجل
-            db_manager.execute_query("""
+        # التصفير يتم عند أول إضافة بعد انتهاء الفترة بدلاً من قراءة last_reset مسبقاً
+        reset_days = int(load_loyalty_settings().get('reset_days', 30))
+        result = db_manager.execute_query("""
+            WITH awards AS (
+                SELECT * FROM unnest(%s::text[], %s::int[], %s::text[]) AS a(user_id, points, reason)
+            ), totals AS (
+                SELECT user_id, SUM(points)::int AS points FROM awards GROUP BY user_id
+            ), updated AS (
+                INSERT INTO loyalty_points (user_id, points)
+                SELECT user_id, points FROM totals
+                ON CONFLICT (user_id) DO UPDATE SET
+                    points = CASE WHEN loyalty_points.last_reset <= NOW() - %s * INTERVAL '1 day'
+                                  THEN EXCLUDED.points
+                                  ELSE loyalty_points.points + EXCLUDED.points END,
+                    last_reset = CASE WHEN loyalty_points.last_reset <= NOW() - %s * INTERVAL '1 day'
+                                      THEN CURRENT_TIMESTAMP
+                                      ELSE loyalty_points.last_reset END,
+                    updated_at = CURRENT_TIMESTAMP
+                RETURNING user_id, points
+            ), history AS (
                 INSERT INTO loyalty_points_history (user_id, points_change, reason)
-                VALUES (%s, %s, %s)
-            """, (str(user_id), points, reason))
+                SELECT awards.user_id, awards.points, awards.reason
+                FROM awards JOIN updated USING (user_id)
+            )
+            SELECT user_id, points FROM updated
+        """, (
+            [award[0] for award in awards],
+            [award[1] for award in awards],
+            [award[2] for award in awards],
+            reset_days,
+            reset_days
+        ))
         
-        return success
+        if not result:
+            return False
+        
+        # تحديث الذاكرة بعد حفظ المعاملة الجارية فقط
+        def apply_to_memory():
+            for row in result:
+                user_profiles.invalidate(row['user_id'])
+                leaderboard.update(row['user_id'], row['points'])
+        db_manager.on_commit(apply_to_memory)
+        return True
     except Exception as e:
         logger.error(f"خطأ في إضافة نقاط الامتياز: {str(e)}")
         return False
 
 def load_loyalty_settings():
     """تحميل إعدادات نظام النقاط"""
+    return settings_cache.get('loyalty', fetch_loyalty_settings)
+
+def fetch_loyalty_settings():
+    """قراءة إعدادات نظام النقاط من قاعدة البيانات"""
     result = db_manager.execute_query('SELECT * FROM loyalty_settings')
     settings = {}
     if result:
@@ -1492,32 +2659,112 @@ def load_loyalty_settings():
         if key not in settings:
             settings[key] = value
     
-    return settings
+    return settings, result is not False
 
 def save_loyalty_settings(settings):
     """حفظ إعدادات نظام النقاط"""
-    for key, value in settings.items():
-        success = db_manager.execute_query("""
-            INSERT INTO loyalty_settings (setting_key, setting_value)
-            VALUES (%s, %s)
-            ON CONFLICT (setting_key)
-            DO UPDATE SET setting_value = EXCLUDED.setting_value,
-                         updated_at = CURRENT_TIMESTAMP
-        """, (key, str(value)))
-        if not success:
-            return False
-    return True
+    try:
+        for key, value in settings.items():
+            success = db_manager.execute_query("""
+                INSERT INTO loyalty_settings (setting_key, setting_value)
+                VALUES (%s, %s)
+                ON CONFLICT (setting_key)
+                DO UPDATE SET setting_value = EXCLUDED.setting_value,
+                             updated_at = CURRENT_TIMESTAMP
+            """, (key, str(value)))
+            if not success:
+                return False
+        return True
+    finally:
+        settings_cache.invalidate('loyalty')
 
 def get_top_users_by_points(limit=10):
     """جلب أفضل المستخدمين حسب النقاط"""
-    result = db_manager.execute_query("""
-        SELECT user_id, points 
-        FROM loyalty_points 
-        WHERE points > 0 
-        ORDER BY points DESC 
-        LIMIT %s
-    """, (limit,))
-    return result if result else []
+    return leaderboard.top(limit)
+
+class Leaderboard:
+    """ترتيب حاملي النقاط في قائمة مرتبة بمفاتيح (-points, user_id) تتحدث مع كل تغيير في النقاط"""
+    def __init__(self, reload_interval):
+        self.reload_interval = reload_interval
+        self.keys = []
+        self.points = {}
+        self.total_points = 0
+        self.loaded_at = 0
+        self.lock = Lock()
+        self.reload_lock = Lock()
+
+    def reload(self):
+        """إعادة البناء من قاعدة البيانات عبر الفهرس الجزئي على النقاط"""
+        result = db_manager.execute_query('SELECT user_id, points FROM loyalty_points WHERE points > 0')
+        if result is False:
+            return False
+        
+        # الترتيب في بايثون وليس ORDER BY حتى يطابق مقارنة النصوص في bisect وليس ترتيب قاعدة البيانات
+        keys = sorted((-row['points'], row['user_id']) for row in result)
+        with self.lock:
+            self.keys = keys
+            self.points = {row['user_id']: row['points'] for row in result}
+            self.total_points = sum(self.points.values())
+            self.loaded_at = time.time()
+        logger.info(f"🏆 تم تحميل ترتيب النقاط: {len(self.keys)} مستخدم")
+        return True
+
+    def ensure_loaded(self):
+        if time.time() - self.loaded_at < self.reload_interval:
+            return
+        # خيط واحد يعيد البناء، والباقون يستخدمون الترتيب الحالي إن وجد
+        if not self.reload_lock.acquire(blocking=not self.loaded_at):
+            return
+        try:
+            if time.time() - self.loaded_at >= self.reload_interval:
+                self.reload()
+        finally:
+            self.reload_lock.release()
+
+    def update(self, user_id, points):
+        """تطبيق الرصيد الجديد لمستخدم، بدون أثر قبل أول تحميل لأن التحميل سيقرأه من قاعدة البيانات"""
+        user_id = str(user_id)
+        points = int(points or 0)
+        with self.lock:
+            if not self.loaded_at:
+                return
+            old_points = self.points.pop(user_id, 0)
+            if old_points > 0:
+                index = bisect.bisect_left(self.keys, (-old_points, user_id))
+                if index < len(self.keys) and self.keys[index] == (-old_points, user_id):
+                    del self.keys[index]
+            if points > 0:
+                bisect.insort(self.keys, (-points, user_id))
+                self.points[user_id] = points
+            self.total_points += max(points, 0) - old_points
+
+    def reset(self):
+        """تصفير جميع النقاط"""
+        with self.lock:
+            self.keys = []
+            self.points = {}
+            self.total_points = 0
+
+    def rank_of(self, user_id):
+        """ترتيب المستخدم (المتساوون بالنقاط يتشاركون الترتيب) أو None إذا لم يكن لديه نقاط"""
+        self.ensure_loaded()
+        with self.lock:
+            points = self.points.get(str(user_id))
+            if not points:
+                return None
+            return bisect.bisect_left(self.keys, (-points, '')) + 1
+
+    def top(self, limit=10):
+        self.ensure_loaded()
+        with self.lock:
+            return [{'user_id': user_id, 'points': -negative_points} for negative_points, user_id in self.keys[:limit]]
+
+    def get_stats(self):
+        self.ensure_loaded()
+        with self.lock:
+            return {'holders': len(self.keys), 'total_points': self.total_points}
+
+leaderboard = Leaderboard(LEADERBOARD_RELOAD_INTERVAL)
 
 def get_loyalty_rewards():
     """جلب الجوائز المتاحة"""
@@ -1540,7 +2787,7 @@ def get_loyalty_rewards():
 
 def create_redemption_request(user_id, reward_id):
     """إنشاء طلب استبدال نقاط"""
-    try:
+    def apply_redemption():
         # التحقق من الجائزة
         reward_result = db_manager.execute_query(
             'SELECT * FROM loyalty_rewards WHERE reward_id = %s AND active = TRUE',
@@ -1567,42 +2814,41 @@ def create_redemption_request(user_id, reward_id):
         if settings.get('redemption_enabled', 'false') != 'true':
             return None, "نظام الاستبدال غير مفعل حالياً"
         
-        # خصم النقاط
-        success = db_manager.execute_query("""
+        # خصم النقاط بشرط كفايتها لحظة التنفيذ
+        deducted = db_manager.execute_query("""
             UPDATE loyalty_points 
             SET points = points - %s 
             WHERE user_id = %s AND points >= %s
+            RETURNING points
         """, (points_cost, str(user_id), points_cost))
         
-        if not success:
+        if not deducted:
             return None, "فشل في خصم النقاط"
+        remaining = deducted[0]['points']
+        
+        # الترتيب يحدث بعد حفظ المعاملة وليس قبلها
+        def apply_to_memory():
+            user_profiles.invalidate(user_id)
+            leaderboard.update(user_id, remaining)
+        db_manager.on_commit(apply_to_memory)
         
-        # إنشاء طلب الاستبدال
+        # إنشاء طلب الاستبدال وتسجيله في السجل ضمن نفس المعاملة
         redemption_id = f"redemption_{int(time.time() * 1000)}"
-        success = db_manager.execute_query("""
+        db_manager.execute_query("""
             INSERT INTO loyalty_redemptions 
             (redemption_id, user_id, reward_id, points_cost)
             VALUES (%s, %s, %s, %s)
         """, (redemption_id, str(user_id), reward_id, points_cost))
+        db_manager.execute_query("""
+            INSERT INTO loyalty_points_history 
+            (user_id, points_change, reason)
+            VALUES (%s, %s, %s)
+        """, (str(user_id), -points_cost, f"استبدال لنقاط - {reward['name']}"))
         
-        if success:
-            # تسجيل في السجل
-            db_manager.execute_query("""
-                INSERT INTO loyalty_points_history 
-                (user_id, points_change, reason)
-                VALUES (%s, %s, %s)
-            """, (str(user_id), -points_cost, f"استبدال لنقاط - {reward['name']}"))
-            
-            return redemption_id, "تم إنشاء طلب الاستبدال بنجاح"
-        else:
-            # استرجاع النقاط إذا فشل إنشاء الطلب
-            db_manager.execute_query("""
-                UPDATE loyalty_points 
-                SET points = points + %s 
-                WHERE user_id = %s
-            """, (points_cost, str(user_id)))
-            return None, "فشل في إنشاء طلب الاستبدال"
+        return redemption_id, "تم إنشاء طلب الاستبدال بنجاح"
     
+    try:
+        return db_manager.run_in_transaction(apply_redemption)
     except Exception as e:
         logger.error(f"خطأ في إنشاء طلب الاستبدال: {str(e)}")
         return None, "حدث خطأ أثناء إنشاء الطلب"
@@ -1913,6 +3159,10 @@ def show_terms_and_conditions(chat_id, message_id=None):
 
 def get_gift_settings():
     """جلب إعدادات نظام الإهداء"""
+    return settings_cache.get('gift', fetch_gift_settings)
+
+def fetch_gift_settings():
+    """قراءة إعدادات الإهداء من قاعدة البيانات"""
     result = db_manager.execute_query('SELECT * FROM system_settings WHERE setting_key LIKE %s', ('gift_%',))
     settings = {}
     if result:
@@ -1930,19 +3180,22 @@ def get_gift_settings():
         if key not in settings:
             settings[key] = value
     
-    return settings
+    return settings, result is not False
 
 def save_gift_settings(settings):
     """حفظ إعدادات نظام الإهداء"""
-    for key, value in settings.items():
-        success = db_manager.execute_query(
-            "INSERT INTO system_settings (setting_key, setting_value) VALUES (%s, %s) "
-            "ON CONFLICT (setting_key) DO UPDATE SET setting_value = EXCLUDED.setting_value",
-            (key, str(value))
-        )
-        if not success:
-            return False
-    return True
+    try:
+        for key, value in settings.items():
+            success = db_manager.execute_query(
+                "INSERT INTO system_settings (setting_key, setting_value) VALUES (%s, %s) "
+                "ON CONFLICT (setting_key) DO UPDATE SET setting_value = EXCLUDED.setting_value",
+                (key, str(value))
+            )
+            if not success:
+                return False
+        return True
+    finally:
+        settings_cache.invalidate('gift')
 
 def add_gift_transaction(from_user_id, to_user_id, amount, commission, net_amount):
     """إضافة عملية إهداء جديدة"""
@@ -2156,15 +3409,26 @@ def process_gift_transaction(chat_id):
         commission = user_data[chat_id]['gift_commission']
         net_amount = user_data[chat_id]['gift_net_amount']
         
-        # خصم المبلغ من المرسل
-        sender_new_balance = update_wallet_balance(chat_id, -amount)
+        def apply_gift():
+            # خصم المبلغ من المرسل بشرط كفاية الرصيد
+            sender_balance = debit_wallet_balance(chat_id, amount)
+            if sender_balance is None:
+                return None
+            
+            # إضافة المبلغ الصافي للمستلم وتسجيل العملية
+            receiver_balance = update_wallet_balance(to_user_id, net_amount)
+            gift_id = add_gift_transaction(chat_id, to_user_id, amount, commission, net_amount)
+            return sender_balance, receiver_balance, gift_id
         
-        # إضافة المبلغ الصافي للمستلم
-        receiver_old_balance = get_wallet_balance(to_user_id)
-        receiver_new_balance = update_wallet_balance(to_user_id, net_amount)
+        result = db_manager.run_in_transaction(apply_gift)
+        if result is None:
+            bot.send_message(chat_id, "❌ رصيدك غير كافي لإتمام عملية الإهداء")
+            if chat_id in user_data:
+                del user_data[chat_id]
+            return
         
-        # تسجيل العملية
-        gift_id = add_gift_transaction(chat_id, to_user_id, amount, commission, net_amount)
+        sender_new_balance, receiver_new_balance, gift_id = result
+        receiver_old_balance = receiver_new_balance - net_amount
         
         # إرسال إشعار للمرسل
         bot.send_message(
@@ -2257,53 +3521,185 @@ def show_gift_history(chat_id, message_id):
             reply_markup=markup
         )
 
-def get_gift_stats():
-    """جلب إحصائيات نظام الإهداء"""
-    try:
-        # إجمالي عمليات الإهداء
-        total_result = db_manager.execute_query(
-            "SELECT COUNT(*) as total_count, COALESCE(SUM(amount), 0) as total_amount FROM gift_transactions"
-        )
-        
-        # عمليات اليوم
-        today_result = db_manager.execute_query(
-            "SELECT COUNT(*) as today_count, COALESCE(SUM(amount), 0) as today_amount FROM gift_transactions WHERE created_at >= CURRENT_DATE"
-        )
-        
-        # إجمالي العمولة
-        commission_result = db_manager.execute_query(
-            "SELECT COALESCE(SUM(commission), 0) as total_commission FROM gift_transactions"
-        )
-        
-        # أفضل 5 مرسلين
+# ===============================================================
+# لقطات إحصائيات الإدارة
+# ===============================================================
+
+# المقاييس اليومية القابلة للجمع: (المقياس، الجدول، عمود المجموع، شرط إضافي)
+STATS_DAILY_METRICS = [
+    ('gifts', 'gift_transactions', 'amount', ''),
+    ('gift_commission', 'gift_transactions', 'commission', ''),
+    ('dice_plays', 'dice_plays', 'final_reward', ''),
+    ('loyalty_earned', 'loyalty_points_history', 'points_change', 'AND points_change > 0'),
+]
+
+class StatsRollup:
+    """ضغط دوري تزايدي للمقاييس في stats_daily، ولقطات اللوحات تبنى عند الطلب فقط إذا كانت قديمة"""
+    def __init__(self, interval):
+        self.interval = interval
+        self.compact_lock = Lock()
+        self.snapshot_locks = {}
+        self.snapshot_locks_guard = Lock()
+        self.compactor_started = False
+
+    def compact_metric(self, metric, table, total_column, condition):
+        """إعادة تجميع الأيام من آخر يوم مضغوط فقط، وكامل التاريخ في المرة الأولى"""
+        last = db_manager.execute_query(
+            'SELECT MAX(stat_date) AS last_date FROM stats_daily WHERE metric = %s',
+            (metric,)
+        )
+        last_date = last[0]['last_date'] if last else None
+        # اليوم السابق يعاد دائماً لالتقاط الصفوف التي أضيفت قرب منتصف الليل
+        since = last_date - timedelta(days=1) if last_date else datetime(1970, 1, 1).date()
+        
+        return db_manager.execute_query(f'''
+            INSERT INTO stats_daily (stat_date, metric, count, total)
+            SELECT created_at::date, %s, COUNT(*), COALESCE(SUM({total_column}), 0)
+            FROM {table}
+            WHERE created_at >= %s {condition}
+            GROUP BY created_at::date
+            ON CONFLICT (stat_date, metric) DO UPDATE SET
+                count = EXCLUDED.count,
+                total = EXCLUDED.total,
+                updated_at = CURRENT_TIMESTAMP
+        ''', (metric, since))
+
+    def load_totals(self):
+        """إجماليات كل مقياس (الكل واليوم والشهر الحالي) من صفوف stats_daily"""
+        result = db_manager.execute_query('''
+            SELECT metric,
+                   SUM(count) AS count,
+                   SUM(total) AS total,
+                   COALESCE(SUM(count) FILTER (WHERE stat_date = CURRENT_DATE), 0) AS today_count,
+                   COALESCE(SUM(total) FILTER (WHERE stat_date = CURRENT_DATE), 0) AS today_total,
+                   COALESCE(SUM(total) FILTER (WHERE stat_date >= date_trunc('month', CURRENT_DATE)), 0) AS month_total
+            FROM stats_daily
+            GROUP BY metric
+        ''') or []
+        empty = {'count': 0, 'total': 0, 'today_count': 0, 'today_total': 0, 'month_total': 0}
+        totals = {metric: dict(empty) for metric, _, _, _ in STATS_DAILY_METRICS}
+        for row in result:
+            totals[row['metric']] = {key: float(row[key]) for key in empty}
+        return totals
+
+    def build_gifts(self, totals):
+        gifts = totals['gifts']
         top_senders = db_manager.execute_query(
             "SELECT from_user_id, COUNT(*) as gift_count, SUM(amount) as total_sent FROM gift_transactions GROUP BY from_user_id ORDER BY total_sent DESC LIMIT 5"
-        )
-        
-        # أفضل 5 مستقبلين
+        ) or []
         top_receivers = db_manager.execute_query(
             "SELECT to_user_id, COUNT(*) as gift_count, SUM(net_amount) as total_received FROM gift_transactions GROUP BY to_user_id ORDER BY total_received DESC LIMIT 5"
+        ) or []
+        return {
+            'total_count': int(gifts['count']),
+            'total_amount': gifts['total'],
+            'today_count': int(gifts['today_count']),
+            'today_amount': gifts['today_total'],
+            'total_commission': totals['gift_commission']['total'],
+            'top_senders': top_senders,
+            'top_receivers': top_receivers
+        }
+
+    def build_dice(self, totals):
+        dice = totals['dice_plays']
+        active_users = db_manager.execute_query(
+            "SELECT COUNT(DISTINCT user_id) as active_users FROM dice_plays WHERE created_at >= NOW() - INTERVAL '7 days'"
         )
-        
-        stats = {
-            'total_count': total_result[0]['total_count'] if total_result else 0,
-            'total_amount': float(total_result[0]['total_amount']) if total_result else 0,
-            'today_count': today_result[0]['today_count'] if today_result else 0,
-            'today_amount': float(today_result[0]['today_amount']) if today_result else 0,
-            'total_commission': float(commission_result[0]['total_commission']) if commission_result else 0,
-            'top_senders': top_senders if top_senders else [],
-            'top_receivers': top_receivers if top_receivers else []
+        return {
+            'total_plays': int(dice['count']),
+            'total_rewards': dice['total'],
+            'avg_reward': dice['total'] / dice['count'] if dice['count'] else 0,
+            'active_users': active_users[0]['active_users'] if active_users else 0
         }
+
+    def build_loyalty(self, totals):
+        return {'monthly_points': int(totals['loyalty_earned']['month_total'])}
+
+    def compact(self):
+        """تحديث stats_daily تزايدياً، خيط واحد فقط في كل مرة"""
+        if not self.compact_lock.acquire(blocking=False):
+            return False
+        try:
+            started = time.time()
+            for metric, table, total_column, condition in STATS_DAILY_METRICS:
+                self.compact_metric(metric, table, total_column, condition)
+            logger.info(f"📊 تم ضغط المقاييس اليومية خلال {time.time() - started:.2f} ثانية")
+            return True
+        except Exception as e:
+            logger.error(f"❌ خطأ في ضغط الإحصائيات: {e}")
+            return False
+        finally:
+            self.compact_lock.release()
+
+    def read_snapshot(self, panel):
+        result = db_manager.execute_query(
+            '''SELECT data, computed_at, computed_at >= NOW() - %s * INTERVAL '1 second' AS fresh
+               FROM stats_snapshots WHERE panel = %s''',
+            (self.interval, panel)
+        )
+        return result[0] if result else None
+
+    def snapshot(self, panel):
+        """قراءة لقطة اللوحة (البيانات، وقت الحساب)، وإعادة بنائها فقط عند طلبها وهي أقدم من الفترة"""
+        row = self.read_snapshot(panel)
+        if row and row['fresh']:
+            return row['data'], row['computed_at']
+        
+        with self.snapshot_locks_guard:
+            lock = self.snapshot_locks.setdefault(panel, Lock())
+        # إذا كان خيط آخر يبني نفس اللقطة تعرض القديمة بدلاً من تكرار الاستعلامات
+        if not lock.acquire(blocking=row is None):
+            return row['data'], row['computed_at']
+        try:
+            builder = getattr(self, f"build_{panel}")
+            data = builder(self.load_totals())
+            result = db_manager.execute_query('''
+                INSERT INTO stats_snapshots (panel, data, computed_at)
+                VALUES (%s, %s::jsonb, CURRENT_TIMESTAMP)
+                ON CONFLICT (panel) DO UPDATE SET data = EXCLUDED.data, computed_at = EXCLUDED.computed_at
+                RETURNING computed_at
+            ''', (panel, json.dumps(data, default=float)))
+            computed_at = result[0]['computed_at'] if result else datetime.now()
+            return json.loads(json.dumps(data, default=float)), computed_at
+        except Exception as e:
+            logger.error(f"❌ خطأ في بناء لقطة {panel}: {e}")
+            return (row['data'], row['computed_at']) if row else ({}, None)
+        finally:
+            lock.release()
+
+    @staticmethod
+    def format_computed_at(computed_at):
+        if not computed_at:
+            return "\n<em>الإحصائيات قيد الحساب</em>"
+        return f"\n<em>🕒 آخر تحديث للإحصائيات: {computed_at.strftime('%Y-%m-%d %H:%M')}</em>"
+
+    def start_compactor(self):
+        if self.compactor_started:
+            return
+        self.compactor_started = True
         
-        return stats
+        def compact_loop():
+            while True:
+                self.compact()
+                time.sleep(self.interval)
         
-    except Exception as e:
-        logger.error(f"خطأ في جلب إحصائيات الإهداء: {str(e)}")
-        return {
-            'total_count': 0, 'total_amount': 0, 'today_count': 0, 
-            'today_amount': 0, 'total_commission': 0,
-            'top_senders': [], 'top_receivers': []
-        }
+        threading.Thread(target=compact_loop, daemon=True, name="stats-compactor").start()
+
+stats_rollup = StatsRollup(STATS_COMPACTION_INTERVAL)
+
+def get_gift_stats():
+    """جلب إحصائيات نظام الإهداء من آخر لقطة محسوبة"""
+    stats, computed_at = stats_rollup.snapshot('gifts')
+    return {
+        'total_count': stats.get('total_count', 0),
+        'total_amount': stats.get('total_amount', 0),
+        'today_count': stats.get('today_count', 0),
+        'today_amount': stats.get('today_amount', 0),
+        'total_commission': stats.get('total_commission', 0),
+        'top_senders': stats.get('top_senders', []),
+        'top_receivers': stats.get('top_receivers', []),
+        'computed_at': computed_at
+    }
 
 def get_all_gift_transactions(limit=50):
     """جلب جميع عمليات الإهداء"""
@@ -2371,7 +3767,8 @@ def show_gift_admin_panel(chat_id, message_id):
     else:
         text += "لا توجد بيانات\n"
     
-    text += "\n<b>🎯 اختر الإجراء المطلوب:</b>"
+    text += stats_rollup.format_computed_at(stats['computed_at'])
+    text += "\n\n<b>🎯 اختر الإجراء المطلوب:</b>"
     
     markup = types.InlineKeyboardMarkup()
     
@@ -2385,6 +3782,12 @@ def show_gift_admin_panel(chat_id, message_id):
         
     )
     
+    markup.row(
+        types.InlineKeyboardButton("📤 تصدير 7 أيام", callback_data="export_gift_data_7"),
+        types.InlineKeyboardButton("📤 تصدير 30 يوم", callback_data="export_gift_data_30"),
+        types.InlineKeyboardButton("📤 تصدير الكل", callback_data="export_gift_data_all")
+    )
+    
     markup.row(
         types.InlineKeyboardButton("🔄 تحديث", callback_data="gift_admin")
         
@@ -2449,6 +3852,8 @@ def show_gift_detailed_stats(chat_id, message_id):
     else:
         text += "لا توجد بيانات\n"
     
+    text += stats_rollup.format_computed_at(stats['computed_at'])
+    
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("➞ رجوع", callback_data="gift_admin"))
     
@@ -2655,31 +4060,30 @@ def handle_edit_gift_min_amount(message):
         
     except ValueError:
         bot.send_message(chat_id, "❌ يرجى إدخال رقم صحيح")
-def export_gift_data(chat_id):
+def export_gift_data(chat_id, start_date=None, end_date=None, compress=None):
     """تصدير بيانات الإهداء"""
     if not is_admin(chat_id):
         return
     
     try:
-        transactions = get_all_gift_transactions(1000)  # جلب أكبر عدد ممكن
-        
-        if transactions:
-            # إنشاء ملف CSV
-            csv_data = "Gift ID,From User,To User,Amount,Commission,Net Amount,Date\n"
-            
-            for transaction in transactions:
-                csv_data += f"{transaction['gift_id']},{transaction['from_user_id']},{transaction['to_user_id']},"
-                csv_data += f"{transaction['amount']},{transaction['commission']},{transaction['net_amount']},"
-                csv_data += f"{transaction['created_at'].strftime('%Y-%m-%d %H:%M:%S')}\n"
-            
-            # إرسال الملف
-            bot.send_document(
-                chat_id,
-                ('gift_transactions.csv', csv_data.encode('utf-8')),
-                caption="<b>📤 تصدير بيانات الإهداء</b>\n\nتم تصدير آخر 1000 عملية إهداء",
-                parse_mode="HTML"
-            )
-        else:
+        date_condition, params = export_date_filter('created_at', start_date, end_date)
+        exported = send_csv_export(
+            chat_id,
+            'gift_transactions.csv',
+            ['Gift ID', 'From User', 'To User', 'Amount', 'Commission', 'Net Amount', 'Date'],
+            f"""SELECT gift_id, from_user_id, to_user_id, amount, commission, net_amount, created_at
+                FROM gift_transactions WHERE {date_condition} ORDER BY created_at DESC""",
+            params,
+            lambda row: [
+                row['gift_id'], row['from_user_id'], row['to_user_id'],
+                row['amount'], row['commission'], row['net_amount'],
+                row['created_at'].strftime('%Y-%m-%d %H:%M:%S')
+            ],
+            "<b>📤 تصدير بيانات الإهداء</b>\n\nتم تصدير {count} عملية إهداء",
+            compress
+        )
+        
+        if not exported:
             bot.send_message(chat_id, "❌ لا توجد بيانات للتصدير")
             
     except Exception as e:
@@ -2718,7 +4122,10 @@ def can_user_use_gift_code_today(user_id):
 
 def use_gift_code(code, user_id):
     """استخدام كود هدية"""
-    try:
+    code = code.upper()
+    user_id = str(user_id)
+    
+    def apply_gift_code():
         # التحقق إذا استخدم المستخدم أي كود خلال 24 ساعة
         if not can_user_use_gift_code_today(user_id):
             return False, "⚠️ يمكنك استخدام كود هدية واحدة فقط كل 24 ساعة"
@@ -2726,17 +4133,17 @@ def use_gift_code(code, user_id):
         # التحقق من أن المستخدم لم يستخدم هذا الكود من قبل
         existing_usage = db_manager.execute_query(
             "SELECT 1 FROM gift_code_usage WHERE code = %s AND user_id = %s",
-            (code.upper(), str(user_id))
+            (code, user_id)
         )
         
         if existing_usage and len(existing_usage) > 0:
             return False, "❌ لقد استخدمت هذا الكود من قبل"
         
-        # التحقق من صلاحية الكود
+        # التحقق من صلاحية الكود مع قفل الصف حتى نهاية المعاملة
         code_data = db_manager.execute_query(
             """SELECT code, amount, max_uses, used_count, expires_at, active 
-               FROM gift_codes WHERE code = %s""",
-            (code.upper(),)
+               FROM gift_codes WHERE code = %s FOR UPDATE""",
+            (code,)
         )
         
         if not code_data or len(code_data) == 0:
@@ -2754,33 +4161,32 @@ def use_gift_code(code, user_id):
             return False, "❌ تم استخدام هذا الكود بالكامل"
         
         # استخدام الكود
-        success = db_manager.execute_query(
+        db_manager.execute_query(
             "UPDATE gift_codes SET used_count = used_count + 1 WHERE code = %s",
-            (code.upper(),)
+            (code,)
+        )
+        db_manager.execute_query(
+            """INSERT INTO gift_code_usage (code, user_id, amount_received) 
+               VALUES (%s, %s, %s)""",
+            (code, user_id, code_info['amount'])
         )
         
-        if success:
-            db_manager.execute_query(
-                """INSERT INTO gift_code_usage (code, user_id, amount_received) 
-                   VALUES (%s, %s, %s)""",
-                (code.upper(), str(user_id), code_info['amount'])
-            )
-            
-            # إضافة المبلغ للمحفظة
-            new_balance = update_wallet_balance(user_id, code_info['amount'])
-            
-            # تسجيل المعاملة
-            add_transaction({
-                'user_id': str(user_id),
-                'type': 'gift_code',
-                'amount': code_info['amount'],
-                'description': f"هدية من كود: {code.upper()}"
-            })
-            
-            return True, f"🎉 تمت إضافة {code_info['amount']} إلى رصيدك بنجاح!"
+        # إضافة المبلغ للمحفظة
+        update_wallet_balance(user_id, code_info['amount'])
         
-        return False, "❌ حدث خطأ أثناء معالجة الكود"
+        # تسجيل المعاملة
+        add_transaction({
+            'user_id': user_id,
+            'type': 'gift_code',
+            'amount': code_info['amount'],
+            'description': f"هدية من كود: {code}"
+        })
         
+        return True, f"🎉 تمت إضافة {code_info['amount']} إلى رصيدك بنجاح!"
+    
+    try:
+        # جميع التعديلات تحفظ معاً أو يتم التراجع عنها معاً
+        return db_manager.run_in_transaction(apply_gift_code)
     except Exception as e:
         logger.error(f"خطأ في استخدام كود الهدية: {str(e)}")
         return False, "❌ حدث خطأ أثناء معالجة الكود"
@@ -2828,8 +4234,7 @@ def start_create_gift_code(chat_id):
         "🛠 إنشاء كود هدية جديد\n\nأدخل الكود (مثال: WELCOME2024):",
         parse_mode="HTML"
     )
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and 
-                    user_data[str(message.chat.id)].get('state') == 'gift_code_input')
+@conversation_states.on('gift_code_input')
 def handle_gift_code_input(message):
     """معالجة إدخال كود الهدية"""
     chat_id = str(message.chat.id)
@@ -2848,8 +4253,7 @@ def handle_gift_code_input(message):
     
     bot.send_message(chat_id, message_text, parse_mode="HTML")
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and 
-                    user_data[str(message.chat.id)].get('state') == 'create_gift_code')
+@conversation_states.on('create_gift_code', next_states=('create_gift_code_amount',))
 def handle_create_gift_code(message):
     """معالجة إنشاء كود هدية"""
     chat_id = str(message.chat.id)
@@ -2864,8 +4268,7 @@ def handle_create_gift_code(message):
     
     bot.send_message(chat_id, "💰 أدخل مبلغ الهدية:")
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and 
-                    user_data[str(message.chat.id)].get('state') == 'create_gift_code_amount')
+@conversation_states.on('create_gift_code_amount', next_states=('create_gift_code_uses',))
 def handle_create_gift_code_amount(message):
     """معالجة مبلغ كود الهدية"""
     chat_id = str(message.chat.id)
@@ -2885,8 +4288,7 @@ def handle_create_gift_code_amount(message):
     except ValueError:
         bot.send_message(chat_id, "❌ يرجى إدخال مبلغ صحيح")
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and 
-                    user_data[str(message.chat.id)].get('state') == 'create_gift_code_uses')
+@conversation_states.on('create_gift_code_uses')
 def handle_create_gift_code_uses(message):
     """معالجة عدد استخدمات كود الهدية"""
     chat_id = str(message.chat.id)
@@ -2926,6 +4328,10 @@ def handle_create_gift_code_uses(message):
 
 def get_dice_settings():
     """جلب إعدادات النرد"""
+    return settings_cache.get('dice', fetch_dice_settings)
+
+def fetch_dice_settings():
+    """قراءة إعدادات النرد من قاعدة البيانات"""
     result = db_manager.execute_query('SELECT * FROM dice_settings')
     settings = {}
     if result:
@@ -2943,19 +4349,22 @@ def get_dice_settings():
         if key not in settings:
             settings[key] = value
     
-    return settings
+    return settings, result is not False
 
 def save_dice_settings(settings):
     """حفظ إعدادات النرد"""
-    for key, value in settings.items():
-        success = db_manager.execute_query(
-            "INSERT INTO dice_settings (setting_key, setting_value) VALUES (%s, %s) "
-            "ON CONFLICT (setting_key) DO UPDATE SET setting_value = EXCLUDED.setting_value",
-            (key, str(value))
-        )
-        if not success:
-            return False
-    return True
+    try:
+        for key, value in settings.items():
+            success = db_manager.execute_query(
+                "INSERT INTO dice_settings (setting_key, setting_value) VALUES (%s, %s) "
+                "ON CONFLICT (setting_key) DO UPDATE SET setting_value = EXCLUDED.setting_value",
+                (key, str(value))
+            )
+            if not success:
+                return False
+        return True
+    finally:
+        settings_cache.invalidate('dice')
 
 def get_dice_rewards():
     """جلب جوايز النرد"""
@@ -3483,8 +4892,7 @@ def handle_edit_dice_cooldown(call):
         reply_markup=EnhancedKeyboard.create_back_button("dice_settings")
     )
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and 
-                   user_data[str(message.chat.id)].get('state') == 'edit_dice_price')
+@conversation_states.on('edit_dice_price')
 def handle_edit_dice_price_input(message):
     chat_id = str(message.chat.id)
     try:
@@ -3508,8 +4916,7 @@ def handle_edit_dice_price_input(message):
     except ValueError:
         bot.send_message(chat_id, "يرجى إدخال رقم صحيح")
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and 
-                   user_data[str(message.chat.id)].get('state') == 'edit_dice_cooldown')
+@conversation_states.on('edit_dice_cooldown')
 def handle_edit_dice_cooldown_input(message):
     chat_id = str(message.chat.id)
     try:
@@ -3613,31 +5020,12 @@ def show_dice_rewards_management(chat_id, message_id):
 def show_dice_admin_stats(chat_id, message_id):
     """عرض إحصائيات النرد للإدارة"""
     try:
-        # إحصائيات اللعب
-        result = db_manager.execute_query("""
-            SELECT COUNT(*) as total_plays, 
-                   SUM(final_reward) as total_rewards,
-                   AVG(final_reward) as avg_reward
-            FROM dice_plays
-        """)
-        
-        if result and len(result) > 0:
-            stats = result[0]
-            total_plays = stats['total_plays'] or 0
-            total_rewards = float(stats['total_rewards'] or 0)
-            avg_reward = float(stats['avg_reward'] or 0)
-        else:
-            total_plays = 0
-            total_rewards = 0
-            avg_reward = 0
-        
-        # عدد المستخدمين النشطين
-        users_result = db_manager.execute_query("""
-            SELECT COUNT(DISTINCT user_id) as active_users
-            FROM dice_plays 
-            WHERE created_at >= NOW() - INTERVAL '7 days'
-        """)
-        active_users = users_result[0]['active_users'] if users_result else 0
+        # إحصائيات اللعب من آخر لقطة محسوبة
+        stats, computed_at = stats_rollup.snapshot('dice')
+        total_plays = stats.get('total_plays', 0)
+        total_rewards = float(stats.get('total_rewards', 0))
+        avg_reward = float(stats.get('avg_reward', 0))
+        active_users = stats.get('active_users', 0)
         
         text = f"""
 <b>📊 إحصائيات نظام النرد</b>
@@ -3651,6 +5039,7 @@ def show_dice_admin_stats(chat_id, message_id):
 <b>ملاحظة:</b>
 النظام مجاني تماماً - الجوائز فقط بدون مدفوعات
 """
+        text += stats_rollup.format_computed_at(computed_at)
         
         markup = types.InlineKeyboardMarkup()
         markup.add(types.InlineKeyboardButton("➞ رجوع", callback_data="dice_admin"))
@@ -3803,8 +5192,7 @@ def handle_dice_enable(call):
         bot.answer_callback_query(call.id, "❌ فشل في التفعيل", show_alert=True)
     
     handle_edit_dice_reward(call)
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and 
-                   user_data[str(message.chat.id)].get('state') == 'dice_fixed_amount')
+@conversation_states.on('dice_fixed_amount')
 def handle_dice_fixed_amount(message):
     chat_id = str(message.chat.id)
     try:
@@ -3829,8 +5217,7 @@ def handle_dice_fixed_amount(message):
     except ValueError:
         bot.send_message(chat_id, "يرجى إدخال رقم صحيح")
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and 
-                   user_data[str(message.chat.id)].get('state') == 'dice_percentage_amount')
+@conversation_states.on('dice_percentage_amount')
 def handle_dice_percentage_amount(message):
     chat_id = str(message.chat.id)
     try:
@@ -3855,8 +5242,7 @@ def handle_dice_percentage_amount(message):
     except ValueError:
         bot.send_message(chat_id, "يرجى إدخال رقم صحيح")
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and 
-                   user_data[str(message.chat.id)].get('state') == 'dice_bonus_amount')
+@conversation_states.on('dice_bonus_amount')
 def handle_dice_bonus_amount(message):
     chat_id = str(message.chat.id)
     try:
@@ -3898,6 +5284,7 @@ def set_user_title(user_id, title):
         'ON CONFLICT (user_id) DO UPDATE SET title = EXCLUDED.title, updated_at = CURRENT_TIMESTAMP',
         (str(user_id), title)
     )
+    user_profiles.invalidate(user_id)
     return success
 
 def has_user_title(user_id):
@@ -3909,9 +5296,115 @@ def has_user_title(user_id):
     return bool(result and len(result) > 0)
 
 
+# ===============================================================
+# ملف المستخدم للقائمة الرئيسية
+# ===============================================================
+
+class UserProfile:
+    """بيانات القائمة الرئيسية للمستخدم: اللقب والرصيد والنقاط ووجود الحساب والحظر باستعلام واحد"""
+    PROFILE_QUERY = '''
+        WITH u AS (SELECT %s::text AS id)
+        SELECT
+            (SELECT title FROM user_titles WHERE user_id = u.id) AS title,
+            (SELECT balance FROM wallets WHERE chat_id = u.id) AS balance,
+            (SELECT points FROM loyalty_points WHERE user_id = u.id) AS points,
+            EXISTS (SELECT 1 FROM accounts WHERE chat_id = u.id) AS has_account,
+            EXISTS (SELECT 1 FROM banned_users WHERE user_id = u.id) AS banned,
+            EXISTS (SELECT 1 FROM broadcast_blocked_chats WHERE chat_id = u.id) AS broadcast_blocked
+        FROM u
+    '''
+
+    def __init__(self, chat_id, row):
+        self.chat_id = str(chat_id)
+        self.title = row['title']
+        self.wallet_balance = float(row['balance']) if row['balance'] is not None else 0.0
+        self.loyalty_points = row['points'] or 0
+        self.has_account = bool(row['has_account'])
+        self.banned = bool(row['banned'])
+        self.broadcast_blocked = bool(row['broadcast_blocked'])
+        self.missing_rows = row['balance'] is None or row['points'] is None
+
+    @classmethod
+    def fetch(cls, chat_id):
+        """قراءة الملف من قاعدة البيانات بدون أي كتابة"""
+        chat_id = str(chat_id)
+        result = db_manager.execute_query(cls.PROFILE_QUERY, (chat_id,))
+        if not result:
+            return None
+        return cls(chat_id, result[0])
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and 
-                   user_data[str(message.chat.id)].get('state') == 'set_user_title')
+    def ensure_rows(self):
+        """إنشاء المحفظة وسجل النقاط إذا كانا غير موجودين، تستدعى فقط عند عرض القائمة لمستخدم مسموح له"""
+        if not self.missing_rows:
+            return
+        # سجل المحفظة هو ما يضيف المستخدم لقائمة الإرسال الجماعي
+        db_manager.execute_query('''
+            WITH w AS (
+                INSERT INTO wallets (chat_id, balance) VALUES (%s, 0)
+                ON CONFLICT (chat_id) DO NOTHING
+            )
+            INSERT INTO loyalty_points (user_id, points) VALUES (%s, 0)
+            ON CONFLICT (user_id) DO NOTHING
+        ''', (self.chat_id, self.chat_id))
+        self.missing_rows = False
+
+
+class UserProfileCache:
+    """ذاكرة قصيرة لملفات المستخدمين تُمسح عند كل كتابة على بيانات المستخدم"""
+    def __init__(self, ttl=None, max_entries=None):
+        self.ttl = USER_PROFILE_CACHE_TTL if ttl is None else ttl
+        self.max_entries = max_entries or USER_PROFILE_CACHE_MAX_ENTRIES
+        self.entries = OrderedDict()
+        # رمز لكل تحميل جارٍ، الإبطال يحذفه فلا يخزن تحميل بدأ قبل الإبطال نتيجته القديمة
+        self.loading = {}
+        self.lock = Lock()
+
+    def get(self, chat_id):
+        """إرجاع ملف المستخدم من الذاكرة أو تحميله باستعلام واحد"""
+        chat_id = str(chat_id)
+        now = time.time()
+        token = object()
+        with self.lock:
+            entry = self.entries.get(chat_id)
+            if entry and entry[1] > now:
+                self.entries.move_to_end(chat_id)
+                return entry[0]
+            self.loading[chat_id] = token
+
+        profile = None
+        try:
+            profile = UserProfile.fetch(chat_id)
+        finally:
+            with self.lock:
+                current = self.loading.get(chat_id) is token
+                if current:
+                    del self.loading[chat_id]
+                if current and profile is not None:
+                    self.entries[chat_id] = (profile, now + self.ttl)
+                    self.entries.move_to_end(chat_id)
+                    while len(self.entries) > self.max_entries:
+                        self.entries.popitem(last=False)
+        return profile
+
+    def invalidate(self, chat_id):
+        """الإبطال بعد حفظ المعاملة الجارية، حتى لا يعاد تخزين القيمة القديمة قبل الحفظ"""
+        db_manager.on_commit(lambda: self.invalidate_local(chat_id))
+
+    def invalidate_local(self, chat_id):
+        chat_id = str(chat_id)
+        with self.lock:
+            self.entries.pop(chat_id, None)
+            self.loading.pop(chat_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.loading.clear()
+
+user_profiles = UserProfileCache()
+
+
+@conversation_states.on('set_user_title')
 def handle_user_title_input(message):
     chat_id = str(message.chat.id)
     title = message.text.strip()
@@ -3962,42 +5455,223 @@ def handle_user_title_input(message):
             parse_mode="HTML"
         )
 
-def send_broadcast_message(message_text):
-    """إرسال رسالة جماعية لجميع المستخدمين"""
-    try:
-        # جلب جميع المستخدمين من جدول المحافظ
-        result = db_manager.execute_query('SELECT chat_id FROM wallets')
-        if not result:
-            return 0, "لا يوجد مستخدمين للإرسال"
-        
-        sent_count = 0
-        failed_count = 0
+class TokenBucket:
+    """دلو رموز مشترك بين عمال الإرسال لضبط المعدل الكلي"""
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.time()
+        self.paused_until = 0
+        self.lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                    self.updated_at = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """إيقاف جميع العمال بعد 429 حتى انتهاء retry_after"""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+            self.tokens = 0
+
+class BroadcastEngine:
+    """محرك إرسال جماعي في الخلفية بمعدل محدود ونقاط استئناف في broadcast_messages"""
+    def __init__(self, rate, worker_count, batch_size):
+        self.bucket = TokenBucket(rate)
+        self.worker_count = max(worker_count, 1)
+        self.batch_size = batch_size
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds = BROADCAST_LEASE_SECONDS
+        self.active = set()
+        self.lock = Lock()
+
+    def start(self, message_text, admin_chat_id):
+        broadcast_id = f"broadcast_{int(time.time() * 1000)}"
+        count_result = db_manager.execute_query('''
+            SELECT COUNT(*) AS total FROM wallets w
+            WHERE NOT EXISTS (SELECT 1 FROM broadcast_blocked_chats b WHERE b.chat_id = w.chat_id)
+        ''')
+        total = count_result[0]['total'] if count_result else 0
+        if not total:
+            return None
         
-        for row in result:
+        progress = bot.send_message(admin_chat_id, f"📢 <b>بدأ الإرسال الجماعي</b>\n\n👥 المستهدفون: {total}", parse_mode="HTML")
+        success = db_manager.execute_query(
+            "INSERT INTO broadcast_messages (message_id, message_text, total_count, admin_chat_id, progress_message_id, status, owner, locked_until) "
+            "VALUES (%s, %s, %s, %s, %s, 'running', %s, NOW() + (%s * INTERVAL '1 second'))",
+            (broadcast_id, message_text, total, str(admin_chat_id), progress.message_id, self.owner, self.lease_seconds)
+        )
+        if not success:
+            return None
+        self.launch(broadcast_id)
+        return broadcast_id
+
+    def launch(self, broadcast_id):
+        with self.lock:
+            if broadcast_id in self.active:
+                return
+            self.active.add(broadcast_id)
+        threading.Thread(target=self.run, args=(broadcast_id,), daemon=True, name=broadcast_id).start()
+
+    def claim(self, broadcast_id):
+        """حجز الإرسال في قاعدة البيانات لهذه النسخة، ينجح فقط إن لم تكن نسخة أخرى تملكه بحجز صالح"""
+        result = db_manager.execute_query("""
+            UPDATE broadcast_messages
+            SET owner = %s, locked_until = NOW() + (%s * INTERVAL '1 second')
+            WHERE message_id = %s AND status = 'running'
+              AND (owner IS NULL OR owner = %s OR locked_until IS NULL OR locked_until < NOW())
+            RETURNING message_id
+        """, (self.owner, self.lease_seconds, broadcast_id, self.owner))
+        return bool(result)
+
+    def resume_pending(self):
+        """استئناف الإرسالات التي انقطعت بإعادة التشغيل من آخر نقطة محفوظة"""
+        result = db_manager.execute_query("""
+            SELECT message_id FROM broadcast_messages
+            WHERE status = 'running' AND (owner IS NULL OR owner = %s OR locked_until IS NULL OR locked_until < NOW())
+        """, (self.owner,))
+        for row in result or []:
+            logger.info(f"📢 استئناف الإرسال الجماعي {row['message_id']}")
+            self.launch(row['message_id'])
+
+    def start_resumer(self):
+        """استئناف دوري يلتقط إرسالات نسخة توقفت بعد انتهاء مهلة حجزها"""
+        def resume_loop():
+            while True:
+                try:
+                    self.resume_pending()
+                except Exception as e:
+                    logger.error(f"❌ خطأ في استئناف الإرسال الجماعي: {e}")
+                time.sleep(self.lease_seconds)
+        threading.Thread(target=resume_loop, daemon=True, name="broadcast-resumer").start()
+
+    def send_one(self, chat_id, message_text):
+        """إرسال رسالة واحدة، يعيد sent أو blocked أو failed"""
+        for attempt in range(BROADCAST_MAX_RETRIES):
+            self.bucket.acquire()
             try:
-                bot.send_message(
-                    row['chat_id'],
-                    message_text,
-                    parse_mode="HTML"
-                )
-                sent_count += 1
-                time.sleep(0.1)  # تجنب حظر التيليجرام
+                bot.send_message(chat_id, message_text, parse_mode="HTML")
+                return 'sent'
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code == 429:
+                    retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 5)
+                    logger.warning(f"⚠️ تجاوز حد تيليجرام، انتظار {retry_after} ثانية")
+                    self.bucket.pause(retry_after)
+                    continue
+                if e.error_code == 403 or (e.error_code == 400 and 'chat not found' in str(e.description).lower()):
+                    db_manager.execute_query(
+                        "INSERT INTO broadcast_blocked_chats (chat_id, reason) VALUES (%s, %s) ON CONFLICT (chat_id) DO NOTHING",
+                        (chat_id, str(e.description)[:200])
+                    )
+                    return 'blocked'
+                logger.error(f"فشل في الإرسال لـ {chat_id}: {str(e)}")
+                return 'failed'
             except Exception as e:
-                failed_count += 1
-                logger.error(f"فشل في الإرسال لـ {row['chat_id']}: {str(e)}")
-        
-        # تسجيل الرسالة في قاعدة البيانات
-        message_id = f"broadcast_{int(time.time() * 1000)}"
-        db_manager.execute_query(
-            "INSERT INTO broadcast_messages (message_id, message_text, sent_count, sent_at, status) VALUES (%s, %s, %s, %s, %s)",
-            (message_id, message_text, sent_count, datetime.now(), 'completed')
-        )
-        
-        return sent_count, f"تم الإرسال بنجاح لـ {sent_count} مستخدم، فشل: {failed_count}"
-    
+                logger.error(f"فشل في الإرسال لـ {chat_id}: {str(e)}")
+                return 'failed'
+        return 'failed'
+
+    def report_progress(self, row, done=False):
+        if not row.get('admin_chat_id') or not row.get('progress_message_id'):
+            return
+        processed = row['sent_count'] + row['failed_count'] + row['blocked_count']
+        total = max(row['total_count'] or 0, processed, 1)
+        title = "✅ <b>اكتمل الإرسال الجماعي</b>" if done else "📢 <b>الإرسال الجماعي جارٍ...</b>"
+        text = f"""{title}
+
+📊 <b>التقدم:</b> {processed}/{total} ({processed * 100 // total}%)
+✅ <b>تم الإرسال:</b> {row['sent_count']}
+🚫 <b>حظروا البوت:</b> {row['blocked_count']}
+❌ <b>فشل:</b> {row['failed_count']}"""
+        try:
+            self.bucket.acquire()
+            bot.edit_message_text(chat_id=row['admin_chat_id'], message_id=row['progress_message_id'],
+                                  text=text, parse_mode="HTML",
+                                  reply_markup=EnhancedKeyboard.create_back_button("admin_panel") if done else None)
+        except Exception as e:
+            logger.error(f"خطأ في تحديث تقدم الإرسال الجماعي: {e}")
+
+    def run(self, broadcast_id):
+        try:
+            # نسخة أخرى تعمل على نفس الإرسال، فلا يستأنف هنا حتى لا تصل الرسالة مرتين
+            if not self.claim(broadcast_id):
+                logger.info(f"📢 الإرسال الجماعي {broadcast_id} محجوز لنسخة أخرى")
+                return
+            result = db_manager.execute_query("SELECT * FROM broadcast_messages WHERE message_id = %s", (broadcast_id,))
+            if not result:
+                return
+            row = dict(result[0])
+            for key in ('sent_count', 'failed_count', 'blocked_count'):
+                row[key] = row.get(key) or 0
+            
+            with ThreadPoolExecutor(max_workers=self.worker_count, thread_name_prefix="broadcast") as executor:
+                while True:
+                    batch = db_manager.execute_query('''
+                        SELECT w.chat_id FROM wallets w
+                        WHERE w.chat_id > %s
+                        AND NOT EXISTS (SELECT 1 FROM broadcast_blocked_chats b WHERE b.chat_id = w.chat_id)
+                        ORDER BY w.chat_id
+                        LIMIT %s
+                    ''', (row.get('last_chat_id') or '', self.batch_size))
+                    if not batch:
+                        break
+                    
+                    chat_ids = [r['chat_id'] for r in batch]
+                    for outcome in executor.map(lambda target: self.send_one(target, row['message_text']), chat_ids):
+                        row[f"{outcome}_count"] += 1
+                    row['last_chat_id'] = chat_ids[-1]
+                    
+                    # نقطة استئناف بعد كل دفعة تجدد الحجز: إعادة التشغيل تعيد إرسال دفعة واحدة على الأكثر
+                    renewed = db_manager.execute_query('''
+                        UPDATE broadcast_messages
+                        SET sent_count = %s, failed_count = %s, blocked_count = %s, last_chat_id = %s,
+                            locked_until = NOW() + (%s * INTERVAL '1 second'), updated_at = CURRENT_TIMESTAMP
+                        WHERE message_id = %s AND owner = %s
+                        RETURNING message_id
+                    ''', (row['sent_count'], row['failed_count'], row['blocked_count'], row['last_chat_id'],
+                          self.lease_seconds, broadcast_id, self.owner))
+                    if renewed == []:
+                        logger.warning(f"⚠️ فقدت هذه النسخة حجز الإرسال الجماعي {broadcast_id}، التوقف")
+                        return
+                    self.report_progress(row)
+            
+            db_manager.execute_query(
+                "UPDATE broadcast_messages SET status = 'completed', sent_at = %s, locked_until = NULL, updated_at = CURRENT_TIMESTAMP "
+                "WHERE message_id = %s AND owner = %s",
+                (datetime.now(), broadcast_id, self.owner)
+            )
+            self.report_progress(row, done=True)
+            logger.info(f"✅ اكتمل الإرسال الجماعي {broadcast_id}: {row['sent_count']} رسالة")
+        except Exception as e:
+            logger.error(f"خطأ في الإرسال الجماعي: {str(e)}")
+        finally:
+            with self.lock:
+                self.active.discard(broadcast_id)
+
+broadcast_engine = BroadcastEngine(BROADCAST_RATE_PER_SECOND, BROADCAST_WORKERS, BROADCAST_BATCH_SIZE)
+
+def send_broadcast_message(message_text, admin_chat_id):
+    """بدء إرسال رسالة جماعية لجميع المستخدمين في الخلفية"""
+    try:
+        broadcast_id = broadcast_engine.start(message_text, admin_chat_id)
+        if not broadcast_id:
+            return None, "لا يوجد مستخدمين للإرسال"
+        return broadcast_id, "بدأ الإرسال في الخلفية، سيتم تحديث رسالة التقدم أعلاه تلقائياً"
     except Exception as e:
         logger.error(f"خطأ في الإرسال الجماعي: {str(e)}")
-        return 0, f"خطأ في الإرسال: {str(e)}"
+        return None, f"خطأ في الإرسال: {str(e)}"
 
 def send_private_message(user_id, message_text):
     """إرسال رسالة لمستخدم معين عن طريق الآيدي"""
@@ -4012,7 +5686,7 @@ def send_private_message(user_id, message_text):
         logger.error(f"خطأ في الإرسال لـ {user_id}: {str(e)}")
         return False, f"فشل في الإرسال: {str(e)}"
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'admin_broadcast')
+@conversation_states.on('admin_broadcast')
 def handle_broadcast_message(message):
     chat_id = str(message.chat.id)
     message_text = message.text
@@ -4021,8 +5695,8 @@ def handle_broadcast_message(message):
     if chat_id in user_data:
         del user_data[chat_id]
     
-    # إرسال الرسالة الجماعية
-    sent_count, result_message = send_broadcast_message(message_text)
+    # بدء الإرسال الجماعي في الخلفية
+    broadcast_id, result_message = send_broadcast_message(message_text, chat_id)
     
     bot.send_message(
         chat_id,
@@ -4031,7 +5705,7 @@ def handle_broadcast_message(message):
         reply_markup=EnhancedKeyboard.create_back_button("admin_panel")
     )
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'admin_private_user')
+@conversation_states.on('admin_private_user', next_states=('admin_private_message',))
 def handle_private_user_input(message):
     chat_id = str(message.chat.id)
     user_id = message.text.strip()
@@ -4052,7 +5726,7 @@ def handle_private_user_input(message):
         reply_markup=EnhancedKeyboard.create_back_button("admin_panel")
     )
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'admin_private_message')
+@conversation_states.on('admin_private_message')
 def handle_private_message_input(message):
     chat_id = str(message.chat.id)
     message_text = message.text
@@ -4133,6 +5807,21 @@ def get_all_user_withdrawals(user_id):
         logger.error(f"خطأ في جلب جميع السحوبات: {str(e)}")
         return []
 
+def get_user_withdraw_summary(user_id):
+    """ملخص سحوبات المستخدم في استعلام تجميعي واحد بدلاً من جلب كل العمليات"""
+    result = db_manager.execute_query("""
+        SELECT COUNT(*) AS total_withdrawals,
+               COALESCE(SUM(amount), 0) AS total_amount,
+               COUNT(*) FILTER (WHERE status = 'completed') AS completed_count,
+               COUNT(*) FILTER (WHERE status = 'pending') AS pending_count,
+               COUNT(*) FILTER (WHERE status = 'refunded') AS refunded_count,
+               MIN(created_at) AS first_created_at,
+               MAX(created_at) AS last_created_at
+        FROM pending_withdrawals
+        WHERE user_id = %s
+    """, (str(user_id),))
+    return result[0] if result else None
+
 def format_withdraw_status(status):
     """تنسيق حالة السحب"""
     status_map = {
@@ -4221,22 +5910,18 @@ def show_withdraw_history(chat_id, message_id=None):
 def show_withdraw_stats(chat_id, message_id):
     """عرض إحصائيات السحوبات للمستخدم"""
     try:
-        # جلب جميع سحوبات المستخدم
-        all_withdrawals = get_all_user_withdrawals(chat_id)
+        # ملخص سحوبات المستخدم
+        summary = get_user_withdraw_summary(chat_id)
         
-        if not all_withdrawals:
+        if not summary or not summary['total_withdrawals']:
             text = "📊 <b>إحصائيات السحوبات</b>\n\n❌ لا توجد عمليات سحب سابقة"
         else:
             # حساب الإحصائيات
-            total_withdrawals = len(all_withdrawals)
-            total_amount = sum(float(w['amount']) for w in all_withdrawals)
-            completed_count = len([w for w in all_withdrawals if w['status'] == 'completed'])
-            pending_count = len([w for w in all_withdrawals if w['status'] == 'pending'])
-            refunded_count = len([w for w in all_withdrawals if w['status'] == 'refunded'])
-            
-            # أول وآخر سحب
-            first_withdraw = min(all_withdrawals, key=lambda x: x['created_at'])
-            last_withdraw = max(all_withdrawals, key=lambda x: x['created_at'])
+            total_withdrawals = summary['total_withdrawals']
+            total_amount = float(summary['total_amount'])
+            completed_count = summary['completed_count']
+            pending_count = summary['pending_count']
+            refunded_count = summary['refunded_count']
             
             text = "📊 <b>إحصائيات السحوبات</b>\n\n"
             text += f"📈 <b>إجمالي العمليات:</b> {total_withdrawals}\n"
@@ -4244,8 +5929,8 @@ def show_withdraw_stats(chat_id, message_id):
             text += f"✅ <b>العمليات المكتملة:</b> {completed_count}\n"
             text += f"⏳ <b>العمليات المعلقة:</b> {pending_count}\n"
             text += f"🔄 <b>العمليات المستردة:</b> {refunded_count}\n"
-            text += f"📅 <b>أول عملية:</b> {first_withdraw['created_at'].strftime('%Y-%m-%d')}\n"
-            text += f"📅 <b>آخر عملية:</b> {last_withdraw['created_at'].strftime('%Y-%m-%d')}\n"
+            text += f"📅 <b>أول عملية:</b> {summary['first_created_at'].strftime('%Y-%m-%d')}\n"
+            text += f"📅 <b>آخر عملية:</b> {summary['last_created_at'].strftime('%Y-%m-%d')}\n"
             
             if completed_count > 0:
                 avg_amount = total_amount / completed_count
@@ -4257,6 +5942,10 @@ def show_withdraw_stats(chat_id, message_id):
             types.InlineKeyboardButton("📋 السجل الكامل", callback_data="withdraw_history"),
             types.InlineKeyboardButton("🔄 تحديث", callback_data="withdraw_stats")
         )
+        markup.row(
+            types.InlineKeyboardButton("📤 تصدير 30 يوم", callback_data="export_withdraw_history_30"),
+            types.InlineKeyboardButton("📤 تصدير الكل", callback_data="export_withdraw_history_all")
+        )
         markup.add(types.InlineKeyboardButton("➞ رجوع", callback_data="main_menu"))
         
         bot.edit_message_text(
@@ -4275,26 +5964,35 @@ def show_withdraw_stats(chat_id, message_id):
             show_alert=True
         )
 
-def export_withdraw_history(user_id):
-    """تصدير سجل السحوبات كملف CSV (للمستخدمين المتقدمين)"""
+def export_withdraw_history(user_id, start_date=None, end_date=None, compress=None):
+    """تصدير سجل السحوبات كملف CSV وإرساله للمستخدم (للمستخدمين المتقدمين)"""
     try:
-        withdrawals = get_all_user_withdrawals(user_id)
+        date_condition, params = export_date_filter('created_at', start_date, end_date)
+        
+        def format_row(withdrawal):
+            method_name = withdraw_system.methods.get(withdrawal['method_id'], {}).get('name', 'غير معروف')
+            return [
+                withdrawal['withdrawal_id'], method_name, withdrawal['amount'], withdrawal['status'],
+                withdrawal['created_at'].strftime('%Y-%m-%d %H:%M'),
+                withdrawal['completed_at'].strftime('%Y-%m-%d %H:%M') if withdrawal['completed_at'] else 'N/A'
+            ]
         
-        if not withdrawals:
+        exported = send_csv_export(
+            user_id,
+            'withdraw_history.csv',
+            ['رقم العملية', 'الطريقة', 'المبلغ', 'الحالة', 'التاريخ', 'وقت الإكمال'],
+            f"""SELECT withdrawal_id, method_id, amount, status, created_at, completed_at
+                FROM pending_withdrawals WHERE user_id = %s AND {date_condition}
+                ORDER BY created_at DESC""",
+            [str(user_id)] + params,
+            format_row,
+            "<b>📤 سجل السحوبات</b>\n\nتم تصدير {count} عملية",
+            compress
+        )
+        
+        if not exported:
             return False, "لا توجد بيانات للتصدير"
-        
-        # إنشاء ملف CSV
-        csv_data = "رقم العملية,الطريقة,المبلغ,الحالة,التاريخ,وقت الإكمال\n"
-        
-        for withdrawal in withdrawals:
-            method_id = withdrawal['method_id']
-            method_name = withdraw_system.methods.get(method_id, {}).get('name', 'غير معروف')
-            
-            csv_data += f"{withdrawal['withdrawal_id']},{method_name},{withdrawal['amount']},"
-            csv_data += f"{withdrawal['status']},{withdrawal['created_at'].strftime('%Y-%m-%d %H:%M')},"
-            csv_data += f"{withdrawal['completed_at'].strftime('%Y-%m-%d %H:%M') if withdrawal['completed_at'] else 'N/A'}\n"
-        
-        return True, csv_data
+        return True, f"تم تصدير {exported} عملية"
         
     except Exception as e:
         logger.error(f"خطأ في تصدير سجل السحوبات: {str(e)}")
@@ -4318,18 +6016,25 @@ def search_withdrawals_by_date(user_id, start_date, end_date):
 
 def save_referral_settings(settings):
     """حفظ إعدادات الإحالات"""
-    for key, value in settings.items():
-        success = db_manager.execute_query(
-            "INSERT INTO referral_settings (setting_key, setting_value) VALUES (%s, %s) "
-            "ON CONFLICT (setting_key) DO UPDATE SET setting_value = EXCLUDED.setting_value, updated_at = CURRENT_TIMESTAMP",
-            (key, str(value))
-        )
-        if not success:
-            return False
-    return True
+    try:
+        for key, value in settings.items():
+            success = db_manager.execute_query(
+                "INSERT INTO referral_settings (setting_key, setting_value) VALUES (%s, %s) "
+                "ON CONFLICT (setting_key) DO UPDATE SET setting_value = EXCLUDED.setting_value, updated_at = CURRENT_TIMESTAMP",
+                (key, str(value))
+            )
+            if not success:
+                return False
+        return True
+    finally:
+        settings_cache.invalidate('referral')
 
 def load_referral_settings():
     """تحميل إعدادات الإحالات"""
+    return settings_cache.get('referral', fetch_referral_settings)
+
+def fetch_referral_settings():
+    """قراءة إعدادات الإحالات من قاعدة البيانات"""
     result = db_manager.execute_query("SELECT * FROM referral_settings")
     settings = {}
     if result:
@@ -4347,7 +6052,7 @@ def load_referral_settings():
         next_payout = datetime.now() + timedelta(days=10)
         settings['next_payout_date'] = next_payout.isoformat()
         
-    return settings
+    return settings, result is not False
 
 def add_referral(referrer_id, referred_id):
     """إضافة إحالة جديدة"""
@@ -4814,6 +6519,10 @@ def confirm_distribution_final(chat_id, message_id):
 
 def load_compensation_settings():
     """تحميل إعدادات نظام التعويض"""
+    return settings_cache.get('compensation', fetch_compensation_settings)
+
+def fetch_compensation_settings():
+    """قراءة إعدادات التعويض من قاعدة البيانات"""
     result = db_manager.execute_query('SELECT * FROM compensation_settings')
     settings = {}
     if result:
@@ -4831,55 +6540,36 @@ def load_compensation_settings():
         if key not in settings:
             settings[key] = value
     
-    return settings
+    return settings, result is not False
 
 def save_compensation_settings(settings):
     """حفظ إعدادات نظام التعويض"""
-    for key, value in settings.items():
-        success = db_manager.execute_query(
-            "INSERT INTO compensation_settings (setting_key, setting_value) VALUES (%s, %s) "
-            "ON CONFLICT (setting_key) DO UPDATE SET setting_value = EXCLUDED.setting_value, "
-            "updated_at = CURRENT_TIMESTAMP",
-            (key, str(value))
-        )
-        if not success:
-            return False
-    return True
+    try:
+        for key, value in settings.items():
+            success = db_manager.execute_query(
+                "INSERT INTO compensation_settings (setting_key, setting_value) VALUES (%s, %s) "
+                "ON CONFLICT (setting_key) DO UPDATE SET setting_value = EXCLUDED.setting_value, "
+                "updated_at = CURRENT_TIMESTAMP",
+                (key, str(value))
+            )
+            if not success:
+                return False
+        return True
+    finally:
+        settings_cache.invalidate('compensation')
 
 def get_user_net_loss_24h(user_id):
     """حساب صافي خسارة المستخدم خلال 24 ساعة (باستثناء التعويضات السابقة)"""
     try:
-        # حساب إجمالي الإيداعات
-        deposit_result = db_manager.execute_query(
-            "SELECT COALESCE(SUM(amount), 0) as total_deposits FROM transactions "
-            "WHERE user_id = %s AND type = 'deposit' AND created_at >= NOW() - INTERVAL '24 hours'",
-            (str(user_id),)
-        )
-        total_deposits = float(deposit_result[0]['total_deposits']) if deposit_result else 0
-        
-        # حساب إجمالي السحوبات
-        withdraw_result = db_manager.execute_query(
-            "SELECT COALESCE(SUM(amount), 0) as total_withdrawals FROM transactions "
-            "WHERE user_id = %s AND type = 'withdraw' AND created_at >= NOW() - INTERVAL '24 hours'",
-            (str(user_id),)
-        )
-        total_withdrawals = float(withdraw_result[0]['total_withdrawals']) if withdraw_result else 0
-        
-        # ✅ استبعاد الخسارة التي تم تعويضها مسبقاً
-        compensation_tracking = db_manager.execute_query(
-            "SELECT last_compensation_loss, last_compensation_date FROM compensation_tracking "
-            "WHERE user_id = %s AND last_compensation_date >= NOW() - INTERVAL '24 hours'",
-            (str(user_id),)
-        )
+        summary = transaction_buckets.loss_summary(user_id)
+        if not summary:
+            return 0
         
-        compensated_loss = 0
-        if compensation_tracking and len(compensation_tracking) > 0:
-            compensated_loss = float(compensation_tracking[0]['last_compensation_loss'])
-            logger.info(f"✅ استبعاد خسارة سابقة تم تعويضها: {compensated_loss} للمستخدم {user_id}")
+        if summary['compensated_loss']:
+            logger.info(f"✅ استبعاد خسارة سابقة تم تعويضها: {summary['compensated_loss']} للمستخدم {user_id}")
         
         # صافي الخسارة = الإيداعات - السحوبات - الخسارة المعوضة سابقاً
-        net_loss = total_deposits - total_withdrawals - compensated_loss
-        return max(0, net_loss)  # إرجاع القيمة الموجبة فقط
+        return summary['net_loss']
         
     except Exception as e:
         logger.error(f"❌ خطأ في حساب صافي الخسارة: {str(e)}")
@@ -4971,13 +6661,11 @@ def revoke_gift_code_usage(usage_id):
         amount = usage_info['amount_received']
         code = usage_info['code']
         
-        # خصم المبلغ من المستخدم
-        current_balance = get_wallet_balance(user_id)
-        if current_balance < amount:
+        # خصم المبلغ من المستخدم بشرط كفاية الرصيد
+        new_balance = debit_wallet_balance(user_id, amount)
+        if new_balance is None:
             return False, "رصيد المستخدم غير كافي للاسترداد"
         
-        new_balance = update_wallet_balance(user_id, -amount)
-        
         # تحديث عدد استخدامات الكود
         db_manager.execute_query(
             "UPDATE gift_codes SET used_count = used_count - 1 WHERE code = %s",
@@ -5315,8 +7003,8 @@ class EnhancedKeyboard:
         )
         
         markup.row(
-            
-            types.InlineKeyboardButton("🔧 الصيانة", callback_data="maintenance_settings")
+            types.InlineKeyboardButton("🔧 الصيانة", callback_data="maintenance_settings"),
+            types.InlineKeyboardButton("⚙️ حالة الطابور", callback_data="account_queue_stats")
         )
         markup.row(
             types.InlineKeyboardButton("🎖 إدارة النقاط", callback_data="loyalty_admin"),
@@ -5353,36 +7041,211 @@ def create_account_via_agent(username, password):
     success = result.get("status", False) if result and "error" not in result else False
     return success, result
 
-def get_player_id_via_agent(username):
-    """الحصول على معرف اللاعب عبر الوكيل"""
-    try:
-        start = 0
-        limit = 100
-        while True:
-            players_data = agent.get_players(start, limit)
-            if not players_data or "error" in players_data:
-                break
+def extract_player_records(players_data):
+    """استخراج سجلات اللاعبين من استجابة الوسيط"""
+    if not players_data or "error" in players_data:
+        return []
+    if "result" in players_data and isinstance(players_data["result"], dict) and "records" in players_data["result"]:
+        return players_data["result"]["records"] or []
+    if "records" in players_data:
+        return players_data["records"] or []
+    return []
+
+def extract_player_identity(player):
+    """استخراج اسم المستخدم ومعرف اللاعب من سجل لاعب"""
+    player_username = player.get("username", "") or player.get("login", "")
+    player_id = player.get("playerId") or player.get("id")
+    return player_username, player_id
+
+class PlayerDirectory:
+    """دليل محلي لمعرفات اللاعبين (اسم المستخدم ← معرف اللاعب) بدلاً من تصفح قائمة اللاعبين كاملة"""
+    FULL_SYNC_SETTING = 'agent_players_last_full_sync'
+
+    def __init__(self, page_size=100, full_sync_interval=AGENT_PLAYERS_FULL_SYNC_INTERVAL, max_entries=AGENT_PLAYERS_CACHE_MAX_ENTRIES):
+        self.page_size = page_size
+        self.full_sync_interval = full_sync_interval
+        # الجدول يحمل الدليل كاملاً، والذاكرة LRU محدودة للأسماء المستخدمة مؤخراً
+        self.max_entries = max_entries
+        self.players = OrderedDict()
+        self.lock = Lock()
+        self.sync_lock = Lock()
+        self.full_sync_lock = Lock()
+        self.full_sync_started = False
+
+    def cache_get(self, key):
+        with self.lock:
+            player_id = self.players.get(key)
+            if player_id is not None:
+                self.players.move_to_end(key)
+            return player_id
+
+    def cache_put(self, players):
+        with self.lock:
+            for key, player_id in players.items():
+                self.players[key] = player_id
+                self.players.move_to_end(key)
+            while len(self.players) > self.max_entries:
+                self.players.popitem(last=False)
+
+    def remember_many(self, pairs):
+        """حفظ مجموعة لاعبين دفعة واحدة، يعيد عدد اللاعبين الجدد أو المتغيرين في الجدول"""
+        players = {}
+        for username, player_id in pairs:
+            if username and player_id:
+                key = username.lower()
+                if self.cache_get(key) != str(player_id):
+                    players[key] = str(player_id)
+        if not players:
+            return 0
+        
+        values = ', '.join(['(%s, %s)'] * len(players))
+        params = [item for pair in players.items() for item in pair]
+        # العد من الجدول لا من الذاكرة المحدودة حتى لا تحسب الأسماء المطرودة من الذاكرة كلاعبين جدد
+        result = db_manager.execute_query(f"""
+            INSERT INTO agent_players (username, player_id) VALUES {values}
+            ON CONFLICT (username) DO UPDATE SET player_id = EXCLUDED.player_id, updated_at = CURRENT_TIMESTAMP
+            WHERE agent_players.player_id IS DISTINCT FROM EXCLUDED.player_id
+            RETURNING username
+        """, params)
+        self.cache_put(players)
+        return len(result) if result else 0
+
+    def remember(self, username, player_id):
+        self.remember_many([(username, player_id)])
+
+    def lookup(self, username):
+        """البحث في الذاكرة ثم في جدول الدليل"""
+        key = username.lower()
+        player_id = self.cache_get(key)
+        if player_id is not None:
+            return player_id
+        result = db_manager.execute_query(
+            'SELECT player_id FROM agent_players WHERE username = %s',
+            (key,)
+        )
+        if result:
+            self.cache_put({key: result[0]['player_id']})
+            return result[0]['player_id']
+        return None
 
-            records = []
-            if "result" in players_data and "records" in players_data["result"]:
-                records = players_data["result"]["records"]
-            elif "records" in players_data:
-                records = players_data["records"]
+    def search_on_agent(self, username):
+        """محاولة البحث من جهة الخادم عبر searchBy قبل تصفح القائمة"""
+        records = extract_player_records(agent.get_players(0, self.page_size, search=username))
+        self.remember_many(extract_player_identity(player) for player in records)
+        for player in records:
+            player_username, player_id = extract_player_identity(player)
+            if player_username and player_username.lower() == username.lower():
+                return player_id
+        return None
 
+    def scan_pages(self, username=None, full=False):
+        """تصفح قائمة لاعبي الوكيل، يعيد (معرف اللاعب المطلوب، هل وصل لنهاية القائمة)"""
+        start = 0
+        found = None
+        while True:
+            records = extract_player_records(agent.get_players(start, self.page_size))
             if not records:
-                break
+                # صفحة أولى فارغة قد تكون خطأ من الوكيل فلا تعتبر مسحاً كاملاً
+                return found, start > 0
+            
+            pairs = [extract_player_identity(player) for player in records]
+            new_count = self.remember_many(pairs)
+            if username and found is None:
+                for player_username, player_id in pairs:
+                    if player_username and player_username.lower() == username.lower():
+                        found = player_id
+                        break
+            
+            if found is not None and not full:
+                return found, False
+            if len(records) < self.page_size:
+                return found, True
+            if new_count == 0 and not full:
+                return found, False
+            start += self.page_size
+
+    def sync_from_agent(self, username=None, full=False):
+        """تعبئة الدليل من قائمة لاعبي الوكيل، التحديث التدريجي يتوقف عند أول صفحة بلا لاعبين جدد"""
+        with self.sync_lock:
+            # ربما وجده خيط آخر أثناء انتظار القفل
+            if username:
+                found = self.lookup(username)
+                if found:
+                    return found
+            
+            found, _ = self.scan_pages(username, full)
+            logger.info(f"📒 دليل اللاعبين: {len(self.players)} لاعب في الذاكرة")
+            return found
+
+    def claim_full_sync(self):
+        """حجز المسح الكامل الدوري في قاعدة البيانات حتى تنفذه نسخة واحدة فقط في كل فترة"""
+        now = time.time()
+        result = db_manager.execute_query("""
+            INSERT INTO system_settings (setting_key, setting_value) VALUES (%s, %s)
+            ON CONFLICT (setting_key) DO UPDATE SET setting_value = EXCLUDED.setting_value, updated_at = CURRENT_TIMESTAMP
+            WHERE system_settings.setting_value::float <= %s
+            RETURNING setting_key
+        """, (self.FULL_SYNC_SETTING, str(now), now - self.full_sync_interval))
+        return bool(result)
+
+    def full_sync(self):
+        """مسح كامل لقائمة الوكيل يلتقط ما فات التحديث التدريجي لأن ترتيب القائمة غير مضمون"""
+        with self.full_sync_lock:
+            logger.info("📒 مسح كامل دوري لدليل اللاعبين")
+            _, completed = self.scan_pages(full=True)
+            if not completed:
+                # إعادة المحاولة في الدورة التالية بدلاً من انتظار فترة كاملة
+                db_manager.execute_query(
+                    "UPDATE system_settings SET setting_value = '0' WHERE setting_key = %s",
+                    (self.FULL_SYNC_SETTING,)
+                )
+            return completed
+
+    def start_full_sync_scheduler(self):
+        """المسح الكامل في الخلفية فلا يتحمله طلب إنشاء حساب"""
+        if self.full_sync_started:
+            return
+        self.full_sync_started = True
+        
+        def full_sync_loop():
+            while True:
+                try:
+                    if self.claim_full_sync():
+                        self.full_sync()
+                except Exception as e:
+                    logger.error(f"❌ خطأ في المسح الكامل لدليل اللاعبين: {e}")
+                time.sleep(min(self.full_sync_interval, 600))
+        
+        threading.Thread(target=full_sync_loop, daemon=True, name="player-directory-sync").start()
 
-            for player in records:
-                player_username = player.get("username", "") or player.get("login", "")
-                player_id = player.get("playerId") or player.get("id")
-                if player_username and player_username.lower() == username.lower():
-                    return player_id
+player_directory = PlayerDirectory()
 
-            if len(records) < limit:
-                break
-            start += limit
-            time.sleep(0.5)
-        return None
+def get_player_id_via_agent(username, register_result=None):
+    """الحصول على معرف اللاعب عبر الوكيل"""
+    try:
+        # استجابة التسجيل نفسها قد تحتوي على المعرف
+        if register_result and isinstance(register_result.get("result"), dict):
+            registered = register_result["result"]
+            player_id = registered.get("playerId") or registered.get("id") or (registered.get("player") or {}).get("id")
+            if player_id:
+                player_directory.remember(username, player_id)
+                return player_id
+        
+        player_id = player_directory.lookup(username)
+        if player_id:
+            return player_id
+        
+        player_id = player_directory.search_on_agent(username)
+        if player_id:
+            return player_id
+        
+        # تحديث تدريجي للصفحات الجديدة فقط، التعبئة الكاملة تتم في الخلفية
+        player_id = player_directory.sync_from_agent(username)
+        if player_id:
+            return player_id
+        
+        # الملاذ الأخير: مسح كامل لهذا الطلب فقط دون حجز قفل المزامنة عن باقي التسجيلات
+        return player_directory.scan_pages(username, full=True)[0]
     except Exception as e:
         logger.error(f"❌ خطأ في البحث عن اللاعب: {e}")
         return None
@@ -5402,43 +7265,366 @@ def get_player_balance_via_agent(player_id):
 
 def deposit_to_account_via_agent(player_id, amount):
     """شحن الحساب عبر الوكيل"""
-    return agent.deposit_to_player(player_id, amount)
+    success = agent.deposit_to_player(player_id, amount)
+    if success:
+        cashier_balance_cache.adjust(-amount)
+    else:
+        cashier_balance_cache.invalidate()
+    return success
 
 def withdraw_from_account_via_agent(player_id, amount):
     """سحب من الحساب عبر الوكيل"""
-    return agent.withdraw_from_player(player_id, amount)
+    success = agent.withdraw_from_player(player_id, amount)
+    if success:
+        cashier_balance_cache.adjust(amount)
+    else:
+        cashier_balance_cache.invalidate()
+    return success
 
 # ===============================================================
 # نظام معالجة المهام - طابور موحد
 # ===============================================================
 
-def process_account_operations():
-    """معالجة المهام من طابور عمليات الحساب"""
-    while True:
-        if not account_operations_queue.empty():
-            task = account_operations_queue.get()
-            task_type = task.get('type')
-            
+class JobLeaseLost(Exception):
+    """انتهى حجز العامل للمهمة وأصبحت لعامل آخر، فلا يحق له تعديلها"""
+
+class AccountOperationsDispatcher:
+    """طابور دائم لعمليات الحسابات في PostgreSQL يعالج بعدة عمال مع الحفاظ على ترتيب مهام كل مستخدم"""
+    def __init__(self, worker_count):
+        self.worker_count = max(worker_count, 1)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.visibility_timeout = ACCOUNT_JOB_VISIBILITY_TIMEOUT
+        self.max_attempts = ACCOUNT_JOB_MAX_ATTEMPTS
+        self.poll_interval = ACCOUNT_JOB_POLL_INTERVAL
+        # إيقاظ العمال فور إضافة مهمة من نفس العملية
+        self.wakeup = threading.Condition()
+        self.busy_since = [None] * self.worker_count
+        self.busy_seconds = [0.0] * self.worker_count
+        self.processed_count = [0] * self.worker_count
+        self.stats_lock = Lock()
+        # حجوزات المهام الجارية في هذه العملية، تجدد دورياً قبل انتهاء مهلة الرؤية
+        self.leases = set()
+        self.leases_lock = Lock()
+        self.last_purge = 0
+        self.started = False
+
+    def put(self, task, idempotency_key=None):
+        """إضافة مهمة للطابور الدائم، تكرار نفس مفتاح التكرار لا ينشئ مهمة جديدة"""
+        result = db_manager.execute_query("""
+            INSERT INTO account_jobs (task_type, chat_id, payload, idempotency_key, max_attempts)
+            VALUES (%s, %s, %s::jsonb, %s, %s)
+            ON CONFLICT (idempotency_key) DO NOTHING
+            RETURNING job_id
+        """, (task.get('type'), str(task.get('chat_id')), json.dumps(task), idempotency_key, self.max_attempts))
+        
+        if result is False:
+            logger.error(f"❌ فشل في إضافة مهمة {task.get('type')} للطابور")
+            return False
+        if not result:
+            logger.info(f"⚠️ تم تجاهل مهمة مكررة: {idempotency_key}")
+        
+        with self.wakeup:
+            self.wakeup.notify()
+        return True
+
+    def qsize(self):
+        result = db_manager.execute_query(
+            "SELECT COUNT(*) AS total FROM account_jobs WHERE status IN ('pending', 'running')"
+        )
+        return result[0]['total'] if result else 0
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        for index in range(self.worker_count):
+            worker = threading.Thread(target=self.worker_loop, args=(index,), daemon=True)
+            worker.start()
+        threading.Thread(target=self.heartbeat_loop, daemon=True, name="account-jobs-heartbeat").start()
+
+    def heartbeat_loop(self):
+        """تجديد حجز المهام الجارية حتى لا يستعيدها عامل آخر أثناء اتصال طويل بالوسيط"""
+        interval = max(self.visibility_timeout / 3, 1)
+        while True:
+            time.sleep(interval)
+            with self.leases_lock:
+                leases = list(self.leases)
+            if not leases:
+                continue
             try:
-                if task_type == 'create_account':
-                    process_account_creation(task)
-                elif task_type == 'deposit_to_account':
-                    process_deposit_to_account(task)
-                elif task_type == 'withdraw_from_account':
-                    process_withdraw_from_account(task)
-                    
+                db_manager.execute_query("""
+                    UPDATE account_jobs SET locked_until = NOW() + (%s * INTERVAL '1 second')
+                    WHERE status = 'running' AND locked_by = ANY(%s)
+                """, (self.visibility_timeout, leases))
             except Exception as e:
-                logger.error(f"❌ خطأ في معالجة المهمة: {e}")
-                chat_id = task.get('chat_id')
-                if chat_id:
-                    try:
-                        bot.send_message(chat_id, "❌ حدث خطأ أثناء المعالجة. يرجى المحاولة لاحقاً.")
-                    except:
-                        pass
+                logger.error(f"❌ خطأ في تجديد حجز المهام: {e}")
+
+    def claim_job(self):
+        """حجز أقدم مهمة متاحة لا تسبقها مهمة غير منتهية لنفس المستخدم"""
+        # معرف حجز فريد لكل استلام حتى لو تكررت المهمة لنفس العملية
+        lease = f"{self.worker_id}:{uuid.uuid4().hex[:12]}"
+        result = db_manager.execute_query("""
+            UPDATE account_jobs 
+            SET status = 'running', attempts = attempts + 1, locked_by = %s,
+                locked_until = NOW() + (%s * INTERVAL '1 second'), updated_at = NOW()
+            WHERE job_id = (
+                SELECT j.job_id FROM account_jobs j
+                WHERE ((j.status = 'pending' AND j.available_at <= NOW())
+                       OR (j.status = 'running' AND j.locked_until < NOW()))
+                  AND NOT EXISTS (
+                      SELECT 1 FROM account_jobs prev
+                      WHERE prev.chat_id = j.chat_id AND prev.job_id < j.job_id
+                        AND prev.status IN ('pending', 'running')
+                  )
+                ORDER BY j.job_id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING job_id, task_type, chat_id, payload, step, attempts, max_attempts, locked_by
+        """, (lease, self.visibility_timeout))
+        return result[0] if result else None
+
+    def set_step(self, task, step):
+        """تسجيل تقدم المهمة حتى لا تتكرر الخطوات المالية عند إعادة المحاولة"""
+        job_id = task.get('job_id')
+        if job_id is None:
+            task['step'] = step
+            return True
+        # كل خطوة تجدد الحجز، ولا تسجل إذا انتقلت المهمة لعامل آخر
+        # كلمة المرور تلزم فقط قبل أول خطوة (طلب الوسيط) فتحذف من البيانات المخزنة مع تسجيلها
+        result = db_manager.execute_query("""
+            UPDATE account_jobs
+            SET step = %s, payload = payload - 'password',
+                locked_until = NOW() + (%s * INTERVAL '1 second'), updated_at = NOW()
+            WHERE job_id = %s AND locked_by = %s
+            RETURNING job_id
+        """, (step, self.visibility_timeout, job_id, task.get('lease')))
+        if result == []:
+            raise JobLeaseLost(f"المهمة {job_id} لم تعد محجوزة لهذا العامل")
+        # داخل معاملة لا تتغير المرحلة في الذاكرة قبل الحفظ، حتى لا يظن معالج الخطأ أنها اكتملت
+        db_manager.on_commit(lambda: task.__setitem__('step', step))
+        return result
+
+    def complete_job(self, job):
+        result = db_manager.execute_query("""
+            UPDATE account_jobs SET status = 'done', payload = payload - 'password',
+                locked_until = NULL, updated_at = NOW()
+            WHERE job_id = %s AND locked_by = %s
+            RETURNING job_id
+        """, (job['job_id'], job['locked_by']))
+        if result == []:
+            logger.warning(f"⚠️ المهمة {job['job_id']} انتقلت لعامل آخر قبل تسجيل انتهائها")
+
+    def fail_job(self, job, error):
+        """إعادة جدولة المهمة مع تأخير متزايد أو نقلها لقائمة المهام الميتة"""
+        if job['attempts'] >= job['max_attempts']:
+            self.dead_letter(job, str(error))
+            return
+        
+        delay = ACCOUNT_JOB_RETRY_BASE_DELAY * (2 ** (job['attempts'] - 1)) * random.uniform(0.8, 1.2)
+        logger.warning(f"🔄 إعادة جدولة المهمة {job['job_id']} بعد {delay:.0f} ثانية: {error}")
+        result = db_manager.execute_query("""
+            UPDATE account_jobs 
+            SET status = 'pending', available_at = NOW() + (%s * INTERVAL '1 second'),
+                locked_until = NULL, last_error = %s, updated_at = NOW()
+            WHERE job_id = %s AND locked_by = %s
+            RETURNING job_id
+        """, (delay, str(error)[:1000], job['job_id'], job['locked_by']))
+        if result == []:
+            logger.warning(f"⚠️ المهمة {job['job_id']} انتقلت لعامل آخر، تم تجاهل إعادة الجدولة")
+
+    def dead_letter(self, job, reason):
+        """نقل المهمة لقائمة المهام الميتة وإشعار المستخدم والإدارة"""
+        result = db_manager.execute_query("""
+            UPDATE account_jobs 
+            SET status = 'dead', payload = payload - 'password',
+                locked_until = NULL, last_error = %s, updated_at = NOW()
+            WHERE job_id = %s AND locked_by = %s
+            RETURNING job_id
+        """, (reason[:1000], job['job_id'], job['locked_by']))
+        if result == []:
+            # عامل آخر يملك المهمة الآن فلا يبلغ المستخدم بفشل لم يحدث
+            logger.warning(f"⚠️ المهمة {job['job_id']} انتقلت لعامل آخر، لم تنقل للمهام الميتة")
+            return
+        logger.error(f"☠️ نقل المهمة {job['job_id']} ({job['task_type']}) للمهام الميتة: {reason}")
+        
+        try:
+            bot.send_message(job['chat_id'], "❌ حدث خطأ أثناء المعالجة. تم تحويل طلبك للإدارة للمراجعة.")
+        except:
+            pass
+        try:
+            bot.send_message(
+                ADMIN_CHAT_ID,
+                f"""<b>☠️ مهمة تحتاج مراجعة يدوية</b>
+
+رقم المهمة: <code>{job['job_id']}</code>
+النوع: {job['task_type']}
+المستخدم: <code>{job['chat_id']}</code>
+البيانات: <code>{json.dumps({k: v for k, v in job['payload'].items() if k != 'password'}, ensure_ascii=False)}</code>
+المرحلة: {job['step'] or 'لم تبدأ'}
+السبب: {reason}""",
+                parse_mode="HTML"
+            )
+        except Exception as e:
+            logger.error(f"خطأ في إشعار الإدارة بالمهمة الميتة: {str(e)}")
+
+    def run_job(self, job):
+        task = dict(job['payload'])
+        task['job_id'] = job['job_id']
+        task['step'] = job['step']
+        task['lease'] = job['locked_by']
+        
+        # المهمة اكتملت قبل انقطاع العامل ولم يسجل انتهاؤها فقط
+        if job['step'] == 'completed':
+            self.complete_job(job)
+            return
+        
+        # انقطعت المعالجة أثناء طلب الوسيط ونتيجته مجهولة، لا نعيدها تلقائياً حتى لا تتكرر
+        if job['step'] == 'agent_called':
+            self.dead_letter(job, "انقطعت المعالجة أثناء الاتصال بالوسيط ونتيجة العملية غير معروفة")
+            return
+        
+        if job['attempts'] > job['max_attempts']:
+            self.dead_letter(job, "تجاوزت المهمة الحد الأقصى للمحاولات")
+            return
+        
+        with self.leases_lock:
+            self.leases.add(job['locked_by'])
+        try:
+            process_account_operation(task)
+            self.complete_job(job)
+        except JobLeaseLost as e:
+            logger.warning(f"⚠️ {e}")
+        except Exception as e:
+            logger.error(f"❌ خطأ في معالجة المهمة {job['job_id']}: {e}")
+            self.fail_job(job, e)
+        finally:
+            with self.leases_lock:
+                self.leases.discard(job['locked_by'])
+
+    def purge_finished_jobs(self):
+        """حذف المهام المنتهية القديمة مرة كل ساعة"""
+        if time.time() - self.last_purge < 3600:
+            return
+        self.last_purge = time.time()
+        db_manager.execute_query(
+            "DELETE FROM account_jobs WHERE status = 'done' AND updated_at < NOW() - INTERVAL '7 days'"
+        )
+        # المهام الميتة تبقى للمراجعة اليدوية لكن بدون كلمات مرور (تشمل الصفوف السابقة لهذا التنظيف)
+        db_manager.execute_query(
+            "UPDATE account_jobs SET payload = payload - 'password' "
+            "WHERE status IN ('done', 'dead') AND payload ? 'password'"
+        )
+        db_manager.execute_query(
+            "DELETE FROM account_jobs WHERE status = 'dead' AND updated_at < NOW() - INTERVAL '90 days'"
+        )
+
+    def worker_loop(self, index):
+        while True:
+            try:
+                job = self.claim_job()
+            except Exception as e:
+                logger.error(f"❌ خطأ في حجز مهمة من الطابور: {e}")
+                job = None
+            
+            if job is None:
+                if index == 0:
+                    self.purge_finished_jobs()
+                # الانتظار حتى إضافة مهمة جديدة أو انتهاء مهلة الاستطلاع (لمهام النسخ الأخرى وإعادة المحاولة)
+                with self.wakeup:
+                    self.wakeup.wait(timeout=self.poll_interval)
+                continue
+            
+            started_at = time.time()
+            self.busy_since[index] = started_at
+            try:
+                self.run_job(job)
             finally:
-                account_operations_queue.task_done()
-        else:
-            time.sleep(1)
+                with self.stats_lock:
+                    self.busy_seconds[index] += time.time() - started_at
+                    self.processed_count[index] += 1
+                self.busy_since[index] = None
+
+    def get_stats(self):
+        """إحصائيات الطابور الدائم والعمال الحاليين"""
+        now = time.time()
+        counts = {'pending': 0, 'running': 0, 'dead': 0}
+        result = db_manager.execute_query(
+            "SELECT status, COUNT(*) AS total FROM account_jobs WHERE status IN ('pending', 'running', 'dead') GROUP BY status"
+        )
+        for row in result or []:
+            counts[row['status']] = row['total']
+        
+        with self.stats_lock:
+            workers = []
+            for index in range(self.worker_count):
+                busy_since = self.busy_since[index]
+                workers.append({
+                    'busy': busy_since is not None,
+                    'current_task_seconds': now - busy_since if busy_since else 0.0,
+                    'busy_seconds': self.busy_seconds[index],
+                    'processed': self.processed_count[index]
+                })
+        return {
+            'worker_count': self.worker_count,
+            'queue_depth': counts['pending'] + counts['running'],
+            'pending': counts['pending'],
+            'running': counts['running'],
+            'dead': counts['dead'],
+            'busy_workers': sum(1 for w in workers if w['busy']),
+            'processed': sum(w['processed'] for w in workers),
+            'workers': workers
+        }
+
+def process_account_operation(task):
+    """معالجة مهمة واحدة من طابور عمليات الحساب"""
+    task_type = task.get('type')
+    
+    if task_type == 'create_account':
+        process_account_creation(task)
+    elif task_type == 'deposit_to_account':
+        process_deposit_to_account(task)
+    elif task_type == 'withdraw_from_account':
+        process_withdraw_from_account(task)
+    else:
+        logger.error(f"❌ نوع مهمة غير معروف: {task_type}")
+
+# الطابور العام للمهام
+account_operations_queue = AccountOperationsDispatcher(ACCOUNT_OPERATION_WORKERS)
+
+def show_account_operations_stats(chat_id, message_id):
+    """عرض حالة طابور عمليات الحسابات للإدارة"""
+    stats = account_operations_queue.get_stats()
+    
+    text = f"""
+<b>⚙️ حالة طابور العمليات</b>
+
+👷 <b>عدد العمال:</b> {stats['worker_count']}
+📥 <b>المهام المنتظرة:</b> {stats['pending']}
+🔄 <b>قيد التنفيذ:</b> {stats['running']}
+☠️ <b>مهام تحتاج مراجعة:</b> {stats['dead']}
+✅ <b>المهام المنجزة (هذه النسخة):</b> {stats['processed']}
+
+<b>تفاصيل العمال:</b>
+"""
+    for index, worker in enumerate(stats['workers'], 1):
+        status = f"🔄 {worker['current_task_seconds']:.1f}ث" if worker['busy'] else "💤"
+        text += f"{index}. {status} | منجز: {worker['processed']} | وقت العمل: {worker['busy_seconds']:.1f}ث\n"
+    
+    session_stats = agent_session.get_stats()
+    text += f"""
+<b>🔑 جلسة الوكيل:</b>
+عمليات الدخول: {session_stats['login_count']} | الفاشلة: {session_stats['failed_logins']}
+متوسط زمن الدخول: {session_stats['avg_latency']:.2f}ث | آخر دخول: {session_stats['last_latency']:.2f}ث
+تنتهي الجلسة بعد: {session_stats['expires_in']}ث
+"""
+    
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("🔄 تحديث", callback_data="account_queue_stats"))
+    markup.add(types.InlineKeyboardButton("➞ رجوع", callback_data="admin_panel"))
+    
+    bot.edit_message_text(chat_id=chat_id, message_id=message_id,
+                         text=text, parse_mode="HTML", reply_markup=markup)
 
 def process_account_creation(task):
     """معالجة إنشاء الحساب"""
@@ -5451,11 +7637,12 @@ def process_account_creation(task):
         final_username = f"{username}_{generate_suffix()}"
         
         # إنشاء الحساب عبر الوسيط
+        account_operations_queue.set_step(task, 'agent_called')
         success, result = create_account_via_agent(final_username, password)
         
         if success:
             # البحث عن معرف اللاعب
-            player_id = get_player_id_via_agent(final_username)
+            player_id = get_player_id_via_agent(final_username, result)
             if not player_id:
                 # إرسال رسالة فشل للمستخدم
                 bot.send_message(
@@ -5476,9 +7663,8 @@ def process_account_creation(task):
                 "created_at": time.time()
             }
             
-            accounts = load_accounts()
-            accounts[str(chat_id)] = account_data
-            save_accounts(accounts)
+            account_repository.put(chat_id, account_data)
+            account_operations_queue.set_step(task, 'completed')
             
             # إرسال رسالة النجاح
             success_text = f"""
@@ -5498,6 +7684,9 @@ def process_account_creation(task):
         else:
             bot.send_message(chat_id, "❌ فشل في إنشاء الحساب. يرجى المحاولة لاحقاً.")
             
+    except JobLeaseLost:
+        # المهمة أصبحت لعامل آخر سيكملها، فلا يبلغ المستخدم بخطأ
+        raise
     except Exception as e:
         error_msg = f"❌ حدث خطأ أثناء إنشاء الحساب: {str(e)}"
         bot.send_message(chat_id, error_msg)
@@ -5509,116 +7698,139 @@ def process_deposit_to_account(task):
     player_id = task['player_id']
 
     try:
-        # التحقق من رصيد الكاشير أولاً
-        if not check_cashier_balance_sufficient(amount):
-            # إشعار المستخدم
-            bot.send_message(
-                chat_id,
-                f"""<b>❌ عملية شحن فشلت</b>
+        if task.get('step') not in ('reserved', 'agent_done'):
+            # التحقق من رصيد الكاشير أولاً
+            if not check_cashier_balance_sufficient(amount):
+                # إشعار المستخدم
+                bot.send_message(
+                    chat_id,
+                    f"""<b>❌ عملية شحن فشلت</b>
 
 رصيد الكاشير غير كافي حالياً.
 سيتم إعلام الإدارة بالمحاولة.""",
-                parse_mode="HTML"
-            )
+                    parse_mode="HTML"
+                )
 
-            # إشعار الإدارة
-            try:
-                bot.send_message(
-                    ADMIN_CHAT_ID,
-                    f"""<b>❌ عملية شحن فشلت</b>
+                # إشعار الإدارة
+                try:
+                    bot.send_message(
+                        ADMIN_CHAT_ID,
+                        f"""<b>❌ عملية شحن فشلت</b>
 
 المستخدم: <code>{chat_id}</code>
 المبلغ: {amount}
 السبب: رصيد الكاشير غير كافي
 الوقت: {time.strftime("%Y-%m-%d %H:%M:%S")}""",
-                    parse_mode="HTML"
-                )
-            except:
-                pass
-            return
+                        parse_mode="HTML"
+                    )
+                except:
+                    pass
+                return
 
-        # التحقق من رصيد المحفظة
-        wallet_balance = get_wallet_balance(chat_id)
-        if wallet_balance < amount:
-            bot.send_message(chat_id, f"❌ رصيدك غير كافي. رصيدك الحالي: {wallet_balance}")
-            return
+            # حجز المبلغ من المحفظة قبل الشحن لمنع السحب على المكشوف
+            def reserve_amount():
+                balance = debit_wallet_balance(chat_id, amount)
+                if balance is not None:
+                    account_operations_queue.set_step(task, 'reserved')
+                return balance
+
+            new_balance = db_manager.run_in_transaction(reserve_amount)
+            if new_balance is None:
+                wallet_balance = get_wallet_balance(chat_id)
+                bot.send_message(chat_id, f"❌ رصيدك غير كافي. رصيدك الحالي: {wallet_balance}")
+                return
+        else:
+            # استكمال مهمة سبق حجز مبلغها قبل انقطاع العامل
+            new_balance = get_wallet_balance(chat_id)
 
-        # محاولة الشحن عبر الوسيط
-        success = deposit_to_account_via_agent(player_id, amount)  # ✅ تعريف success هنا
+        if task.get('step') == 'agent_done':
+            success = True
+        else:
+            # محاولة الشحن عبر الوسيط
+            account_operations_queue.set_step(task, 'agent_called')
+            success = deposit_to_account_via_agent(player_id, amount)  # ✅ تعريف success هنا
+            if success:
+                account_operations_queue.set_step(task, 'agent_done')
 
         if success:
-            # خصم المبلغ من المحفظة
-            new_balance = update_wallet_balance(chat_id, -amount)
-
-            # ✅ تسجيل معاملة الشحن في قاعدة البيانات
-            transaction_data = {
-                'user_id': str(chat_id),
-                'type': 'deposit',
-                'amount': amount,
-                'description': f'شحن حساب 55BETS - Player ID: {player_id}'
-            }
-            transaction_id = add_transaction(transaction_data)  # ✅ الحصول على transaction_id
+            def record_deposit():
+                # ✅ تسجيل معاملة الشحن في قاعدة البيانات
+                transaction_data = {
+                    'user_id': str(chat_id),
+                    'type': 'deposit',
+                    'amount': amount,
+                    'description': f'شحن حساب 55BETS - Player ID: {player_id}'
+                }
+                transaction_id = add_transaction(transaction_data)  # ✅ الحصول على transaction_id
+
+                # تسجيل عملية الشحن للإحالات
+                referrer_id = get_referrer(chat_id)
+                if referrer_id:
+                    settings = load_referral_settings()
+                    commission_rate = float(settings.get('commission_rate', 0.1))
+                    commission_amount = amount * commission_rate
 
-            # ✅ إشعار الإدارة بعملية الشحن الناجحة
-            try:
-                bot.send_message(
-                    ADMIN_CHAT_ID,
-                    f"""<b>✅ عملية شحن ناجحة</b>
+                    # إضافة للعمولات المعلقة
+                    update_referral_earning(referrer_id, commission_amount)
 
-المستخدم: <code>{chat_id}</code>
-المبلغ: <b>{amount}</b>
-معرف اللاعب: <code>{player_id}</code>
-رصيد المحفظة الجديد: <b>{new_balance}</b>
+                    # تسجيل في السجل
+                    log_referral_commission(referrer_id, chat_id, 'deposit', amount, 0,
+                                          commission_amount)
+
+                    logger.info(f"إضافة عمولة إحالة عند الشحن: {commission_amount}")
+
+                # إضافة نقاط الولاء للشحن ومكافأة المحيل دفعة واحدة
+                settings = load_loyalty_settings()
+                points_per_10000 = int(settings.get('points_per_10000', 1))
+                points_earned = (amount // 10000) * points_per_10000
+                loyalty_awards = []
+
+                if points_earned > 0:
+                    loyalty_awards.append((chat_id, points_earned, f"شحن مبلغ {amount}"))
+
+                # ✅ إضافة نقاط المكافأة الأولى للمحيل - التصحيح هنا
+                if referrer_id:
+                    # التحقق إذا كانت هذه أول عملية شحن للمحال
+                    # الآن نتحقق من عدد عمليات الشحن باستثناء العملية الحالية
+                    first_deposit_result = db_manager.execute_query(
+                        "SELECT COUNT(*) as deposit_count FROM transactions "
+                        "WHERE user_id = %s AND type = 'deposit' AND transaction_id != %s",
+                        (str(chat_id), transaction_id if transaction_id else '0')
+                    )
+
+                    deposit_count = first_deposit_result[0]['deposit_count'] if first_deposit_result else 0
+
+                    # ✅ إذا لم يكن هناك أي عمليات شحن سابقة (count = 0)
+                    if deposit_count == 0:
+                        first_deposit_bonus = int(settings.get('first_deposit_bonus', 3))
+                        loyalty_awards.append((referrer_id, first_deposit_bonus, "مكافأة أول إيداع للمحيل"))
+                        logger.info(f"تم إضافة {first_deposit_bonus} نقطة مكافأة للمحيل {referrer_id} لأول إيداع")
+                    else:
+                        logger.info(f"المستخدم {chat_id} لديه {deposit_count} عملية شحن سابقة - لا مكافأة أول إيداع")
+
+                add_loyalty_points_bulk(loyalty_awards)
+
+                account_operations_queue.set_step(task, 'completed')
+
+            # جميع سجلات الشحن (المعاملة، العمولة، النقاط) تحفظ في معاملة واحدة
+            db_manager.run_in_transaction(record_deposit)
+
+            # ✅ إشعار الإدارة بعملية الشحن الناجحة
+            try:
+                bot.send_message(
+                    ADMIN_CHAT_ID,
+                    f"""<b>✅ عملية شحن ناجحة</b>
+
+المستخدم: <code>{chat_id}</code>
+المبلغ: <b>{amount}</b>
+معرف اللاعب: <code>{player_id}</code>
+رصيد المحفظة الجديد: <b>{new_balance}</b>
 الوقت: {time.strftime("%Y-%m-%d %H:%M:%S")}""",
                     parse_mode="HTML"
                 )
             except Exception as e:
                 logger.error(f"خطأ في إرسال إشعار الشحن للإدارة: {str(e)}")
 
-            # تسجيل عملية الشحن للإحالات
-            referrer_id = get_referrer(chat_id)
-            if referrer_id:
-                settings = load_referral_settings()
-                commission_rate = float(settings.get('commission_rate', 0.1))
-                commission_amount = amount * commission_rate
-
-                # إضافة للعمولات المعلقة
-                update_referral_earning(referrer_id, commission_amount)
-
-                # تسجيل في السجل
-                log_referral_commission(referrer_id, chat_id, 'deposit', amount, 0,
-                                      commission_amount)
-
-                logger.info(f"إضافة عمولة إحالة عند الشحن: {commission_amount}")
-
-            # إضافة نقاط الولاء للشحن
-            settings = load_loyalty_settings()
-            points_per_10000 = int(settings.get('points_per_10000', 1))
-            points_earned = (amount // 10000) * points_per_10000
-
-            if points_earned > 0:
-                add_loyalty_points(chat_id, points_earned, f"شحن مبلغ {amount}")
-
-            # ✅ إضافة نقاط المكافأة الأولى للمحيل - التصحيح هنا
-            if referrer_id:
-                # التحقق إذا كانت هذه أول عملية شحن للمحال
-                # الآن نتحقق من عدد عمليات الشحن باستثناء العملية الحالية
-                first_deposit_result = db_manager.execute_query(
-                    "SELECT COUNT(*) as deposit_count FROM transactions "
-                    "WHERE user_id = %s AND type = 'deposit' AND transaction_id != %s",
-                    (str(chat_id), transaction_id if transaction_id else '0')
-                )
-
-                deposit_count = first_deposit_result[0]['deposit_count'] if first_deposit_result else 0
-
-                # ✅ إذا لم يكن هناك أي عمليات شحن سابقة (count = 0)
-                if deposit_count == 0:
-                    first_deposit_bonus = int(settings.get('first_deposit_bonus', 3))
-                    add_loyalty_points(referrer_id, first_deposit_bonus, "مكافأة أول إيداع للمحيل")
-                    logger.info(f"تم إضافة {first_deposit_bonus} نقطة مكافأة للمحيل {referrer_id} لأول إيداع")
-                else:
-                    logger.info(f"المستخدم {chat_id} لديه {deposit_count} عملية شحن سابقة - لا مكافأة أول إيداع")
-
             # إرسال رسالة نجاح للمستخدم
             bot.send_message(
                 chat_id,
@@ -5630,6 +7842,13 @@ def process_deposit_to_account(task):
             )
 
         else:
+            # إعادة المبلغ المحجوز للمحفظة مرة واحدة فقط
+            def refund_amount():
+                update_wallet_balance(chat_id, amount)
+                account_operations_queue.set_step(task, 'completed')
+
+            db_manager.run_in_transaction(refund_amount)
+
             # إرسال رسالة فشل للمستخدم
             bot.send_message(
                 chat_id,
@@ -5656,6 +7875,9 @@ def process_deposit_to_account(task):
             except Exception as e:
                 logger.error(f"خطأ في إرسال إشعار فشل الشحن للإدارة: {str(e)}")
 
+    except JobLeaseLost:
+        # المهمة أصبحت لعامل آخر سيكملها، فلا يبلغ المستخدم بخطأ
+        raise
     except Exception as e:
         error_msg = f"حدث خطأ أثناء الشحن: {str(e)}"
         logger.error(error_msg)
@@ -5677,6 +7899,10 @@ def process_deposit_to_account(task):
         except Exception as admin_error:
             logger.error(f"خطأ في إرسال إشعار الخطأ للإدارة: {str(admin_error)}")
 
+        # أي مرحلة غير مكتملة فعلياً تعاد من الطابور أو تنقل للمهام الميتة، لا تعتبر منتهية
+        if task.get('step') != 'completed':
+            raise
+
 def process_withdraw_from_account(task):
     """معالجة سحب من الحساب"""
     chat_id = task['chat_id']
@@ -5684,42 +7910,56 @@ def process_withdraw_from_account(task):
     player_id = task['player_id']
     
     try:
-        # محاولة السحب مباشرة عبر الوسيط
-        success = withdraw_from_account_via_agent(player_id, amount)
+        if task.get('step') == 'agent_done':
+            # استكمال مهمة نجح سحبها من الوسيط قبل انقطاع العامل
+            success = True
+        else:
+            # محاولة السحب مباشرة عبر الوسيط
+            account_operations_queue.set_step(task, 'agent_called')
+            success = withdraw_from_account_via_agent(player_id, amount)
+            if success:
+                account_operations_queue.set_step(task, 'agent_done')
         
         if success:
-            # إضافة المبلغ إلى المحفظة
-            new_balance = update_wallet_balance(chat_id, amount)
-            
-            # تسجيل معاملة السحب
-            transaction_data = {
-                'user_id': str(chat_id),
-                'type': 'withdraw', 
-                'amount': amount,
-                'description': f'سحب من حساب 55BETS - Player ID: {player_id}'
-            }
-            add_transaction(transaction_data)
-            
-            # ✅ معالجة عمولة الإحالات عند السحب (منطق صحيح)
-            referrer_id = get_referrer(chat_id)
-            if referrer_id:
-                try:
-                    settings = load_referral_settings()
-                    commission_rate = float(settings.get('commission_rate', 0.1))
-                    commission_to_deduct = amount * commission_rate
-                    
-                    # خصم العمولة من العمولات المعلقة
-                    success_deduction = deduct_referral_earning(referrer_id, commission_to_deduct)
-                    
-                    if success_deduction:
-                        # تسجيل في سجل العمولات
-                        log_referral_commission(referrer_id, chat_id, 'withdraw', amount, 0, commission_to_deduct)
-                        logger.info(f"تم خصم عمولة إحالة عند السحب: {commission_to_deduct}")
-                    else:
-                        logger.error(f"فشل في خصم عمولة الإحالة للمحيل: {referrer_id}")
+            def record_withdraw():
+                # إضافة المبلغ إلى المحفظة
+                balance = update_wallet_balance(chat_id, amount)
+                
+                # تسجيل معاملة السحب
+                transaction_data = {
+                    'user_id': str(chat_id),
+                    'type': 'withdraw', 
+                    'amount': amount,
+                    'description': f'سحب من حساب 55BETS - Player ID: {player_id}'
+                }
+                add_transaction(transaction_data)
+                
+                # ✅ معالجة عمولة الإحالات عند السحب (منطق صحيح)
+                referrer_id = get_referrer(chat_id)
+                if referrer_id:
+                    try:
+                        settings = load_referral_settings()
+                        commission_rate = float(settings.get('commission_rate', 0.1))
+                        commission_to_deduct = amount * commission_rate
+                        
+                        # خصم العمولة من العمولات المعلقة
+                        success_deduction = deduct_referral_earning(referrer_id, commission_to_deduct)
                         
-                except Exception as referral_error:
-                    logger.error(f"خطأ في معالجة عمولة السحب: {str(referral_error)}")
+                        if success_deduction:
+                            # تسجيل في سجل العمولات
+                            log_referral_commission(referrer_id, chat_id, 'withdraw', amount, 0, commission_to_deduct)
+                            logger.info(f"تم خصم عمولة إحالة عند السحب: {commission_to_deduct}")
+                        else:
+                            logger.error(f"فشل في خصم عمولة الإحالة للمحيل: {referrer_id}")
+                            
+                    except Exception as referral_error:
+                        logger.error(f"خطأ في معالجة عمولة السحب: {str(referral_error)}")
+                
+                account_operations_queue.set_step(task, 'completed')
+                return balance
+            
+            # إضافة الرصيد وتسجيل العملية والعمولة في معاملة واحدة
+            new_balance = db_manager.run_in_transaction(record_withdraw)
             
             # إرسال رسالة نجاح للمستخدم
             bot.send_message(chat_id, 
@@ -5729,933 +7969,485 @@ def process_withdraw_from_account(task):
                 parse_mode="HTML"
             )
             
+    except JobLeaseLost:
+        # المهمة أصبحت لعامل آخر سيكملها، فلا يبلغ المستخدم بخطأ
+        raise
     except Exception as e:
         error_msg = f"حدث خطأ أثناء السحب: {str(e)}"
         logger.error(error_msg)
         bot.send_message(chat_id, error_msg)
+        # أي مرحلة غير مكتملة فعلياً تعاد من الطابور أو تنقل للمهام الميتة، لا تعتبر منتهية
+        if task.get('step') != 'completed':
+            raise
 
 
 
 def deduct_referral_earning(referrer_id, amount):
     """خصم من العمولات المعلقة"""
-    try:
-        amount_float = float(amount)
-        
-        # ✅ السماح بالعمولة السالبة (دين على المحيل)
-        return db_manager.execute_query(
-            "UPDATE referral_earnings SET pending_commission = pending_commission - %s WHERE referrer_id = %s",
-            (amount_float, str(referrer_id))
-        )
-        
-    except Exception as e:
-        logger.error(f"خطأ في deduct_referral_earning: {str(e)}")
-        return False
-
-# ===============================================================
-# معالجات البوت الرئيسية
-# ===============================================================
-
-@bot.message_handler(commands=['start'])
-def start(message):
-    chat_id = str(message.chat.id)
-    
-
-    # التحقق من وضع الصيانة
-    if is_maintenance_mode() and not is_admin(chat_id):
-        maintenance = load_maintenance()
-        bot.send_message(
-            chat_id, 
-            f"<b>🔧 الصيانة</b>\n\n{maintenance.get('message', 'البوت في حالة صيانة مؤقتة، يرجى التحلي بالصبر.')}",
-            parse_mode="HTML"
-        )
-        return
-    
-    # التحقق من الحظر
-    if is_user_banned(chat_id):
-        bot.send_message(chat_id, "❌ تم حظرك من استخدام البوت.")
-        return
-    
-    # التحقق من الاشتراك في القناة
-    if not is_user_subscribed(message.from_user.id):
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("📢 الاشتراك في القناة", url=CHANNEL_LINK))
-        markup.add(types.InlineKeyboardButton("✅ تم الاشتراك", callback_data="check_subscription"))
-        
-        bot.send_message(
-            chat_id,
-            "<b>عذراً، يجب عليك الاشتراك في قناتنا أولاً</b>",
-            parse_mode="HTML",
-            reply_markup=markup
-        )
-        return
-    
-    if not has_user_title(chat_id):
-        user_data[chat_id] = {'state': 'set_user_title'}
-        bot.send_message(
-            chat_id,
-            "<b>مرحباً بك! 👋</b>\n\n"
-            "قبل البدء، يرجى إدخال لقبك الذي تريد أن نناديك به:\n"
-            "<em>  مرحبا بك مجددا</em>",
-            parse_mode="HTML"
-        )
-        return
-    
-    if len(message.text.split()) > 1:
-        referral_code = message.text.split()[1]
-        if referral_code.startswith('ref_'):
-            referrer_id = referral_code.replace('ref_', '')
-            if referrer_id != chat_id:  # منع الإحالة الذاتية
-               if add_referral(referrer_id, chat_id):
-                    try:
-                        bot.send_message(
-                            referrer_id,
-                            f"🎉 <b>إحالة جديدة!</b>\n\nتم انضمام مستخدم جديد عبر رابط إحالتك: <code>{chat_id}</code>  وحصلت على نقطة امتياز جديدة ⚔️",
-                            parse_mode="HTML"
-                        )
-                        referrer_notified = True
-                    except Exception as e:
-                        logger.error(f"❌ خطأ في إرسال إشعار الإحالة: {e}")
-    
-    
-    accounts = load_accounts()
-    has_account = str(chat_id) in accounts
-    
-    user_title = get_user_title(chat_id)
-    wallet_balance = get_wallet_balance(chat_id)
-    loyalty_points = get_loyalty_points(chat_id)
-    
-    # رسالة الترحيب المحدثة
-    welcome_text = f"""
-<blockquote><b>👋🏻 مرحباً {user_title} في نظام إدارة 55BETS</b></blockquote>
-
-<b>💼 رصيد المحفظة:</b> <code>{wallet_balance:.2f}</code>
-<b>💎 نقاط الامتياز:</b> <code>{loyalty_points}</code>
-
-
-"""
-    
-    accounts = load_accounts()
-    has_account = str(chat_id) in accounts
-
-    bot.send_message(
-        chat_id,
-        welcome_text,
-        parse_mode="HTML",
-        reply_markup=EnhancedKeyboard.create_main_menu(has_account, is_admin(chat_id))
-    )
-
-@bot.callback_query_handler(func=lambda call: True)
-def handle_callbacks(call):
-    chat_id = str(call.message.chat.id)
-    message_id = call.message.message_id
-    
-    # التحقق من وضع الصيانة
-    if is_maintenance_mode() and not is_admin(chat_id):
-        maintenance = load_maintenance()
-        bot.answer_callback_query(call.id, "البوت في حالة صيانة", show_alert=True)
-        bot.edit_message_text(
-            chat_id=chat_id,
-            message_id=message_id,
-            text=f"<b>🔧 الصيانة</b>\n\n{maintenance.get('message')}",
-            parse_mode="HTML"
-        )
-        return
-    
-    try:
-        if call.data == "main_menu":
-            show_main_menu(chat_id, message_id)
-            
-        elif call.data == "check_subscription":
-            handle_subscription_check(call, chat_id, message_id)
-            
-        elif call.data == "account_section":
-            show_account_section(chat_id, message_id)
-            
-        elif call.data == "create_account":
-            start_account_creation(chat_id)
-            
-        elif call.data == "show_account":
-            show_account_info(chat_id, message_id)
-            
-        elif call.data == "deposit_to_account":
-            start_deposit_to_account(chat_id)
-            
-        elif call.data == "withdraw_from_account":
-            start_withdraw_from_account(chat_id)
-            
-        elif call.data == "payment_methods":
-            show_payment_methods(chat_id, message_id)
-            
-        elif call.data == "withdraw_methods":
-            show_withdraw_methods(chat_id, message_id)
-            
-        elif call.data == "balance_history":
-            show_balance_history(chat_id, message_id)
-            
-        elif call.data == "admin_panel":
-            if is_admin(chat_id):
-                show_admin_panel(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية الدخول", show_alert=True)
-                
-        elif call.data == "referral_section":
-            show_referral_section(chat_id, message_id)
-
-        elif call.data == "show_my_referrals":
-            show_my_referrals(chat_id, message_id)
-
-        # معالجات إدارة الإحالات
-        elif call.data == "referral_admin":
-            if is_admin(chat_id):
-                show_referral_admin_panel(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "referral_settings":
-            if is_admin(chat_id):
-                show_referral_settings(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "referral_stats":
-            if is_admin(chat_id):
-                show_referral_stats(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        # معالجات التوزيع
-        elif call.data == "distribute_commissions":
-            if is_admin(chat_id):
-                distribute_commissions_handler(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "delay_commissions_1":
-            if is_admin(chat_id):
-                delay_commissions(1)
-                bot.answer_callback_query(call.id, text="✅ تم التأجيل 24 ساعة")
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "cancel_commissions":
-            if is_admin(chat_id):
-                silent_reset_commissions()
-                bot.answer_callback_query(call.id, text="✅ تم الإلغاء وإعادة التعيين")
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "silent_reset_confirm":
-            if is_admin(chat_id):
-                confirm_silent_reset(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "confirm_silent_reset":
-            if is_admin(chat_id):
-                silent_reset_commissions()
-                bot.answer_callback_query(call.id, text="✅ تم إعادة التعيين الصامت")
-                show_referral_admin_panel(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-        elif call.data == "force_distribute":
-            if is_admin(chat_id):
-                confirm_distribution(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "force_distribute_confirm":
-            if is_admin(chat_id):
-                confirm_distribution_final(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "force_distribute_final":
-            if is_admin(chat_id):
-                report, total = distribute_commissions()
-                if report:
-                    bot.send_message(chat_id, report, parse_mode="HTML")
-                    show_referral_admin_panel(chat_id, message_id)
-                else:
-                    bot.send_message(chat_id, "❌ فشل في توزيع العمولات")
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-        # معالجات إدارة طرق الدفع
-        elif call.data == "manage_payment_methods":
-            if is_admin(chat_id):
-                show_manage_payment_methods(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "add_payment_method":
-            if is_admin(chat_id):
-                start_add_payment_method(chat_id)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data.startswith("edit_payment_method_"):
-            if is_admin(chat_id):
-                method_id = call.data.replace("edit_payment_method_", "")
-                start_edit_payment_method(chat_id, method_id)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data.startswith("delete_payment_method_"):
-            if is_admin(chat_id):
-                method_id = call.data.replace("delete_payment_method_", "")
-                confirm_delete_payment_method(chat_id, message_id, method_id)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data.startswith("confirm_delete_payment_"):
-            if is_admin(chat_id):
-                method_id = call.data.replace("confirm_delete_payment_", "")
-                success, message = payment_system.delete_payment_method(method_id)
-                bot.answer_callback_query(call.id, text=message)
-                show_manage_payment_methods(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        # معالجات إدارة طرق السحب
-        elif call.data == "manage_withdraw_methods":
-            if is_admin(chat_id):
-                show_manage_withdraw_methods(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "add_withdraw_method":
-            if is_admin(chat_id):
-                start_add_withdraw_method(chat_id)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data.startswith("edit_withdraw_method_"):
-            if is_admin(chat_id):
-                method_id = call.data.replace("edit_withdraw_method_", "")
-                start_edit_withdraw_method(chat_id, method_id)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data.startswith("delete_withdraw_method_"):
-            if is_admin(chat_id):
-                method_id = call.data.replace("delete_withdraw_method_", "")
-                confirm_delete_withdraw_method(chat_id, message_id, method_id)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data.startswith("confirm_delete_withdraw_"):
-            if is_admin(chat_id):
-                method_id = call.data.replace("confirm_delete_withdraw_", "")
-                success, message = withdraw_system.delete_withdraw_method(method_id)
-                bot.answer_callback_query(call.id, text=message)
-                show_manage_withdraw_methods(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-                
-        elif call.data.startswith("payment_method_"):
-            method_id = call.data.replace("payment_method_", "")
-            start_payment_process(chat_id, message_id, method_id)
-            
-        elif call.data.startswith("withdraw_method_"):
-            method_id = call.data.replace("withdraw_method_", "")
-            start_withdraw_process(chat_id, method_id)
-            
-        elif call.data == "force_distribute":
-            if is_admin(chat_id):
-                distribute_commissions_handler(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-                
-        elif call.data == "edit_commission_rate":
-            if is_admin(chat_id):
-                start_edit_commission_rate(chat_id)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-                
-        elif call.data == "edit_payout_days":
-            if is_admin(chat_id):
-                start_edit_payout_days(chat_id)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-        
-        elif call.data.startswith("approve_payment_"):
-            handle_approve_payment(call, chat_id, message_id)
-    
-        elif call.data.startswith("reject_payment_"):
-            handle_reject_payment(call, chat_id, message_id)
-    
-        elif call.data.startswith("complete_withdraw_"):
-            handle_complete_withdrawal(call, chat_id, message_id)
-        
-        elif call.data == "loyalty_section":
-            show_loyalty_section(chat_id, message_id)
-
-        elif call.data == "loyalty_leaderboard":
-            show_loyalty_leaderboard(chat_id, message_id)
-
-        elif call.data == "loyalty_redeem":
-            show_loyalty_redeem(chat_id, message_id)
-
-        elif call.data == "loyalty_history":
-            show_loyalty_history(chat_id, message_id)
-
-        elif call.data.startswith("redeem_"):
-            reward_id = call.data.replace("redeem_", "")
-            redemption_id, message_text = create_redemption_request(chat_id, reward_id)
-            bot.answer_callback_query(call.id, text=message_text)
-            if redemption_id:
-                show_loyalty_redeem(chat_id, message_id)
-
-        # معالجات الإدارة
-        elif call.data == "loyalty_admin":
-            if is_admin(chat_id):
-                show_loyalty_admin_panel(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "loyalty_settings":
-            if is_admin(chat_id):
-                show_loyalty_settings_admin(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "loyalty_requests":
-            if is_admin(chat_id):
-                show_pending_redemption_requests(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "loyalty_toggle":
-            if is_admin(chat_id):
-                # تفعيل/تعطيل النظام
-                settings = load_loyalty_settings()
-                current_status = settings.get('redemption_enabled', 'false')
-                new_status = 'true' if current_status == 'false' else 'false'
-                settings['redemption_enabled'] = new_status
-                save_loyalty_settings(settings)
-        
-                status_text = "مفعل" if new_status == 'true' else "معطل"
-                bot.answer_callback_query(call.id, text=f"تم {status_text} نظام الاستبدال")
-                show_loyalty_admin_panel(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        # معالجات تعديل الإعدادات
-        elif call.data == "edit_points_per_10000":
-            if is_admin(chat_id):
-                user_data[chat_id] = {'state': 'edit_points_per_10000'}
-                bot.send_message(chat_id, "أرسل عدد النقاط لكل 10,000:")
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-        
-        # معالجات تعديل الإعدادات المتبقية
-        elif call.data == "edit_referral_points":
-            if is_admin(chat_id):
-                user_data[chat_id] = {'state': 'edit_referral_points'}
-                bot.send_message(chat_id, "أرسل عدد نقاط الإحالة:")
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "edit_deposit_bonus":
-            if is_admin(chat_id):
-                user_data[chat_id] = {'state': 'edit_deposit_bonus'}
-                bot.send_message(chat_id, "أرسل عدد نقاط مكافأة الإيداع الأولى:")
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "edit_min_redemption":
-            if is_admin(chat_id):
-                user_data[chat_id] = {'state': 'edit_min_redemption'}
-                bot.send_message(chat_id, "أرسل الحد الأدنى لنقاط الاستبدال:")
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "edit_reset_days":
-            if is_admin(chat_id):
-                user_data[chat_id] = {'state': 'edit_reset_days'}
-                bot.send_message(chat_id, "أرسل عدد أيام التصفير:")
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        # معالجات إدارة الجوائز
-        elif call.data == "manage_rewards":
-            if is_admin(chat_id):
-                show_rewards_management(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "add_reward":
-            if is_admin(chat_id):
-                user_data[chat_id] = {'state': 'add_reward_name'}
-                bot.send_message(
-                    chat_id,
-                    "<b>إضافة جائزة جديدة</b>\n\nالخطوة 1/4: أرسل اسم الجائزة\nمثال: <em>10$</em>",
-                    parse_mode="HTML",
-                    reply_markup=EnhancedKeyboard.create_back_button("manage_rewards")
-                )
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data.startswith("toggle_reward_"):
-            if is_admin(chat_id):
-                reward_id = call.data.replace('toggle_reward_', '')
-        
-                # جلب الحالة الحالية
-                result = db_manager.execute_query(
-                    "SELECT active FROM loyalty_rewards WHERE reward_id = %s",
-                    (reward_id,)
-                )
-        
-                if result and len(result) > 0:
-                    current_status = result[0]['active']
-                    new_status = not current_status
-            
-                    # تحديث الحالة
-                    success = db_manager.execute_query(
-                        "UPDATE loyalty_rewards SET active = %s WHERE reward_id = %s",
-                        (new_status, reward_id)
-                    )
-            
-                    if success:
-                        status_text = "مفعل" if new_status else "معطل"
-                        bot.answer_callback_query(call.id, text=f"تم {status_text} الجائزة")
-                        show_rewards_management(chat_id, message_id)
-                    else:
-                        bot.answer_callback_query(call.id, text="فشل في تحديث الجائزة", show_alert=True)
-                else:
-                    bot.answer_callback_query(call.id, text="الجائزة غير موجودة", show_alert=True)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data.startswith("edit_reward_"):
-            if is_admin(chat_id):
-                reward_id = call.data.replace('edit_reward_', '')
-                # يمكنك إضافة منطق تعديل الجائزة هنا
-                bot.answer_callback_query(call.id, text="خاصية تعديل الجائزة قيد التطوير", show_alert=True)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        # معالجات إضافية للإدارة
-        elif call.data == "loyalty_stats":
-            if is_admin(chat_id):
-                handle_loyalty_stats(call)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "reset_all_points":
-            if is_admin(chat_id):
-                markup = types.InlineKeyboardMarkup()
-                markup.row(
-                    types.InlineKeyboardButton("✅ نعم، تصفير الكل", callback_data="confirm_reset_all_points"),
-                    types.InlineKeyboardButton("❌ إلغاء", callback_data="loyalty_admin")
-                )
-        
-                bot.edit_message_text(
-                    chat_id=chat_id,
-                    message_id=message_id,
-                    text="<b>⚠️ تأكيد تصفير جميع النقاط</b>\n\nهل أنت متأكد من تصفير جميع نقاط المستخدمين؟ هذا الإجراء لا يمكن التراجع عنه.",
-                    parse_mode="HTML",
-                    reply_markup=markup
-        )
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "confirm_reset_all_points":
-            if is_admin(chat_id):
-                try:
-                    # تصفير جميع النقاط
-                    success = db_manager.execute_query("UPDATE loyalty_points SET points = 0, last_reset = CURRENT_TIMESTAMP")
-            
-                    if success:
-                        # تسجيل في السجل
-                        db_manager.execute_query("""
-                            INSERT INTO loyalty_points_history (user_id, points_change, reason)
-                            SELECT user_id, -points, 'تصفير جماعي من الإدارة'
-                            FROM loyalty_points
-                            WHERE points > 0
-                        """)
-                
-                        bot.answer_callback_query(call.id, text="تم تصفير جميع النقاط بنجاح")
-                        show_loyalty_admin_panel(chat_id, message_id)
-                    else:
-                        bot.answer_callback_query(call.id, text="فشل في تصفير النقاط", show_alert=True)
-        
-                except Exception as e:
-                    logger.error(f"خطأ في تصفير النقاط: {str(e)}")
-                    bot.answer_callback_query(call.id, text="حدث خطأ في التصفير", show_alert=True)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "export_points_data":
-            if is_admin(chat_id):
-                try:
-                    # جلب بيانات النقاط
-                    result = db_manager.execute_query("""
-                        SELECT user_id, points, last_reset, updated_at
-                        FROM loyalty_points 
-                        WHERE points > 0 
-                        ORDER BY points DESC
-                    """)
-            
-                    if result:
-                        # إنشاء ملف نصي
-                        csv_data = "User ID,Points,Last Reset,Last Update\n"
-                        for row in result:
-                            csv_data += f"{row['user_id']},{row['points']},{row['last_reset']},{row['updated_at']}\n"
-                
-                        # إرسال كملف
-                        bot.send_document(
-                            chat_id,
-                            ('loyalty_points.csv', csv_data.encode('utf-8')),
-                            caption="<b>📊 تصدير بيانات نقاط الامتياز</b>",
-                            parse_mode="HTML"
-                        )
-                        bot.answer_callback_query(call.id, text="تم تصدير البيانات")
-                    else:
-                        bot.answer_callback_query(call.id, text="لا توجد بيانات للتصدير", show_alert=True)
-        
-                except Exception as e:
-                    logger.error(f"خطأ في تصدير البيانات: {str(e)}")
-                    bot.answer_callback_query(call.id, text="حدث خطأ في التصدير", show_alert=True)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الدخول", show_alert=True)
-
-        # معالجات طلبات الاستبدال
-        elif call.data.startswith("approve_redemption_"):
-            if is_admin(chat_id):
-                handle_approve_redemption(call)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الموافقة", show_alert=True)
-
-        elif call.data.startswith("reject_redemption_"):
-            if is_admin(chat_id):
-                handle_reject_redemption(call)
-            else:
-                bot.answer_callback_query(call.id, text="ليس لديك صلاحية الرفض", show_alert=True)
-        
-        elif call.data == "compensation_section":
-            show_compensation_section(chat_id, message_id)
-
-        elif call.data == "request_compensation":
-            handle_compensation_request(call, chat_id, message_id)
-
-        elif call.data.startswith("approve_compensation_"):
-            handle_approve_compensation(call, chat_id, message_id)
-
-        elif call.data.startswith("reject_compensation_"):
-            handle_reject_compensation(call, chat_id, message_id)
-        
-        elif call.data == "compensation_admin":
-            if is_admin(chat_id):
-                show_compensation_admin_panel(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, text="❌ ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "edit_compensation_rate":
-            if is_admin(chat_id):
-                user_data[chat_id] = {'state': 'edit_compensation_rate'}
-                bot.send_message(chat_id, "🛡️ أرسل نسبة التعويض الجديدة (بدون %):\n\n<em>مثال: 10 (لنسبة 10%)</em>", parse_mode="HTML")
-            else:
-                bot.answer_callback_query(call.id, text="❌ ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "edit_min_loss_amount":
-            if is_admin(chat_id):
-                user_data[chat_id] = {'state': 'edit_min_loss_amount'}
-                bot.send_message(chat_id, "🛡️ أرسل الحد الأدنى للخسارة الجديد (SYP):\n\n<em>مثال: 10000</em>", parse_mode="HTML")
-            else:
-                bot.answer_callback_query(call.id, text="❌ ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "toggle_compensation":
-            if is_admin(chat_id):
-                toggle_compensation_system(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, text="❌ ليس لديك صلاحية الدخول", show_alert=True)
-        
-        elif call.data == "pending_compensations":
-            if is_admin(chat_id):
-                show_pending_compensations(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, text="❌ ليس لديك صلاحية الدخول", show_alert=True)
-        elif call.data == "refund_last_withdrawal":
-            handle_refund_last_withdrawal(call, chat_id, message_id)
-        elif call.data.startswith("confirm_refund_"):
-            withdrawal_id = call.data.replace("confirm_refund_", "")
-            process_withdrawal_refund(call, withdrawal_id)
-        
-        elif call.data == "contact_support":
-            start_contact_support(chat_id)
-        
-        elif call.data.startswith("reply_to_user_"):
-            user_id = call.data.replace("reply_to_user_", "")
-            start_admin_reply(call, user_id)
-
-        elif call.data.startswith("close_support_"):
-            user_id = call.data.replace("close_support_", "")
-            close_support_request(call, user_id)
-        
-        elif call.data == "confirm_support_message":
-            confirm_support_message(call)
-
-        elif call.data == "cancel_support_message":
-            cancel_support_message(call)
-        elif call.data == "show_terms":
-            show_terms_and_conditions(chat_id, message_id)
-        elif call.data == "gift_balance":
-            show_gift_section(chat_id, message_id)
-
-        elif call.data == "start_gift":
-            start_gift_process(chat_id)
-
-        elif call.data == "gift_history":
-            show_gift_history(chat_id, message_id)
-
-        elif call.data == "confirm_gift":
-            process_gift_transaction(chat_id)
-            show_gift_section(chat_id, call.message.message_id)
-
-        elif call.data == "cancel_gift":
-            if chat_id in user_data:
-                del user_data[chat_id]
-            show_gift_section(chat_id, call.message.message_id)
-            bot.answer_callback_query(call.id, "تم إلغاء العملية")
-        
-        # معالجات إدارة الإهداء
-        elif call.data == "gift_admin":
-            if is_admin(chat_id):
-                show_gift_admin_panel(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "gift_detailed_stats":
-            if is_admin(chat_id):
-                show_gift_detailed_stats(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "all_gift_transactions":
-            if is_admin(chat_id):
-                show_all_gift_transactions(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "edit_gift_settings":
-            if is_admin(chat_id):
-                show_edit_gift_settings(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "edit_gift_commission":
-            if is_admin(chat_id):
-                start_edit_gift_commission(chat_id)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "edit_gift_min_amount":
-            if is_admin(chat_id):
-                start_edit_gift_min_amount(chat_id)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "toggle_gift_system":
-            if is_admin(chat_id):
-                toggle_gift_system(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "export_gift_data":
-            if is_admin(chat_id):
-                export_gift_data(chat_id)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية الدخول", show_alert=True)
-        
-        elif call.data == "gift_code":
-            start_gift_code_input(chat_id)
-
-        elif call.data == "gift_code_admin":
-            if is_admin(chat_id):
-                start_create_gift_code(chat_id)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية", show_alert=True)
-        
-        elif call.data == "gift_code_manage":
-            if is_admin(chat_id):
-                show_gift_code_management(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية", show_alert=True)
-
-        elif call.data.startswith("revoke_gift_"):
-            if is_admin(chat_id):
-                usage_id = call.data.replace("revoke_gift_", "")
-                handle_revoke_gift_code(call, usage_id)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية", show_alert=True)
-        
-        # في قسم handle_callbacks - إضافة المعالج الجديد
-        elif call.data == "withdraw_history":
-            show_withdraw_history(chat_id, message_id)
-
-        elif call.data == "withdraw_stats":
-            show_withdraw_stats(chat_id, message_id)
+    try:
+        amount_float = float(amount)
         
+        # ✅ السماح بالعمولة السالبة (دين على المحيل)
+        return db_manager.execute_query(
+            "UPDATE referral_earnings SET pending_commission = pending_commission - %s WHERE referrer_id = %s",
+            (amount_float, str(referrer_id))
+        )
         
-        elif call.data == "dice_section":
-            show_dice_section(chat_id, message_id)
-
-        elif call.data == "play_dice":
-            handle_play_dice(call)
-
-        elif call.data == "dice_rewards":
-            show_dice_rewards(chat_id, message_id)
-
-        elif call.data == "dice_stats":
-            show_dice_stats(chat_id, message_id)
+    except Exception as e:
+        logger.error(f"خطأ في deduct_referral_earning: {str(e)}")
+        return False
 
-        elif call.data == "dice_admin":
-            if is_admin(chat_id):
-                show_dice_admin_panel(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية الدخول", show_alert=True)
+# ===============================================================
+# معالجات البوت الرئيسية
+# ===============================================================
 
-        elif call.data == "dice_settings":
-            if is_admin(chat_id):
-                show_dice_settings_admin(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية الدخول", show_alert=True)
+@bot.message_handler(commands=['start'])
+def start(message):
+    chat_id = str(message.chat.id)
+    
+    # ملف المستخدم باستعلام واحد بدلاً من استعلام لكل معلومة
+    profile = user_profiles.get(chat_id)
+    
+    # المستخدم عاد للبوت فيعود لقائمة الإرسال الجماعي، الحذف فقط إذا كان محظوراً فعلاً
+    if profile and profile.broadcast_blocked:
+        db_manager.execute_query('DELETE FROM broadcast_blocked_chats WHERE chat_id = %s', (chat_id,))
+        profile.broadcast_blocked = False
 
-        elif call.data == "toggle_dice_system":
-            if is_admin(chat_id):
-                toggle_dice_system(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية الدخول", show_alert=True)
+    # التحقق من وضع الصيانة
+    if is_maintenance_mode() and not is_admin(chat_id):
+        maintenance = load_maintenance()
+        bot.send_message(
+            chat_id, 
+            f"<b>🔧 الصيانة</b>\n\n{maintenance.get('message', 'البوت في حالة صيانة مؤقتة، يرجى التحلي بالصبر.')}",
+            parse_mode="HTML"
+        )
+        return
+    
+    # التحقق من الحظر
+    if profile.banned if profile else is_user_banned(chat_id):
+        bot.send_message(chat_id, "❌ تم حظرك من استخدام البوت.")
+        return
+    
+    # التحقق من الاشتراك في القناة
+    if not is_user_subscribed(message.from_user.id):
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton("📢 الاشتراك في القناة", url=CHANNEL_LINK))
+        markup.add(types.InlineKeyboardButton("✅ تم الاشتراك", callback_data="check_subscription"))
         
-        elif call.data == "edit_dice_price":
-            if is_admin(chat_id):
-                handle_edit_dice_price(call)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية الدخول", show_alert=True)
+        bot.send_message(
+            chat_id,
+            "<b>عذراً، يجب عليك الاشتراك في قناتنا أولاً</b>",
+            parse_mode="HTML",
+            reply_markup=markup
+        )
+        return
     
-        elif call.data == "edit_dice_cooldown":
-            if is_admin(chat_id):
-                handle_edit_dice_cooldown(call)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية الدخول", show_alert=True)
+    if not (profile.title if profile else has_user_title(chat_id)):
+        user_data[chat_id] = {'state': 'set_user_title'}
+        bot.send_message(
+            chat_id,
+            "<b>مرحباً بك! 👋</b>\n\n"
+            "قبل البدء، يرجى إدخال لقبك الذي تريد أن نناديك به:\n"
+            "<em>  مرحبا بك مجددا</em>",
+            parse_mode="HTML"
+        )
+        return
     
-        elif call.data == "manage_dice_rewards":
-            if is_admin(chat_id):
-                handle_manage_dice_rewards(call)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية الدخول", show_alert=True)
+    if len(message.text.split()) > 1:
+        referral_code = message.text.split()[1]
+        if referral_code.startswith('ref_'):
+            referrer_id = referral_code.replace('ref_', '')
+            if referrer_id != chat_id:  # منع الإحالة الذاتية
+               if add_referral(referrer_id, chat_id):
+                    try:
+                        bot.send_message(
+                            referrer_id,
+                            f"🎉 <b>إحالة جديدة!</b>\n\nتم انضمام مستخدم جديد عبر رابط إحالتك: <code>{chat_id}</code>  وحصلت على نقطة امتياز جديدة ⚔️",
+                            parse_mode="HTML"
+                        )
+                        referrer_notified = True
+                    except Exception as e:
+                        logger.error(f"❌ خطأ في إرسال إشعار الإحالة: {e}")
     
-        elif call.data == "dice_admin_stats":
-            if is_admin(chat_id):
-                handle_dice_admin_stats(call)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية الدخول", show_alert=True)
     
-        elif call.data == "toggle_dice_system":
-            if is_admin(chat_id):
-                toggle_dice_system(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية الدخول", show_alert=True)
-        
-        
-        elif call.data.startswith("edit_dice_reward_"):
-            if is_admin(chat_id):
-                handle_edit_dice_reward(call)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية الدخول", show_alert=True)
+    if profile is None:
+        bot.send_message(chat_id, "❌ حدث خطأ، يرجى المحاولة لاحقاً")
+        return
+    profile.ensure_rows()
+    
+    # رسالة الترحيب المحدثة
+    welcome_text = f"""
+<blockquote><b>👋🏻 مرحباً {profile.title} في نظام إدارة 55BETS</b></blockquote>
 
-        elif call.data.startswith("dice_fixed_"):
-            if is_admin(chat_id):
-                handle_dice_fixed(call)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية الدخول", show_alert=True)
+<b>💼 رصيد المحفظة:</b> <code>{profile.wallet_balance:.2f}</code>
+<b>💎 نقاط الامتياز:</b> <code>{profile.loyalty_points}</code>
 
-        elif call.data.startswith("dice_percentage_"):
-            if is_admin(chat_id):
-                handle_dice_percentage(call)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية الدخول", show_alert=True)
 
-        elif call.data.startswith("dice_bonus_"):
-            if is_admin(chat_id):
-                handle_dice_bonus(call)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية الدخول", show_alert=True)
+"""
 
-        elif call.data.startswith("dice_disable_"):
-            if is_admin(chat_id):
-                handle_dice_disable(call)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية الدخول", show_alert=True)
+    bot.send_message(
+        chat_id,
+        welcome_text,
+        parse_mode="HTML",
+        reply_markup=EnhancedKeyboard.create_main_menu(profile.has_account, is_admin(chat_id))
+    )
 
-        elif call.data.startswith("dice_enable_"):
-            if is_admin(chat_id):
-                handle_dice_enable(call)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية الدخول", show_alert=True)
+# نقطة دخول واحدة لرسائل المحادثات، مسجلة بعد /start حتى تبقى الأوامر لها الأولوية
+@bot.message_handler(func=lambda message: conversation_states.handles(message))
+def handle_conversation_message(message):
+    conversation_states.dispatch(message)
+
+# ===============================================================
+# موجه أزرار الاستجابة
+# ===============================================================
+
+class CallbackRouter:
+    """توجيه الأزرار: قاموس للمطابقة التامة وشجرة بادئات للأزرار ذات المعاملات مثل approve_payment_"""
+    def __init__(self):
+        self.exact = {}
+        self.prefix_tree = {}
+
+    def add(self, data, handler, admin=False, maintenance=True, denied_text="ليس لديك صلاحية الدخول", prefix=False):
+        route = {
+            'handler': handler,
+            'admin': admin,
+            'maintenance': maintenance,
+            'denied_text': denied_text,
+        }
+        if not prefix:
+            self.exact[data] = route
+            return
+        node = self.prefix_tree
+        for char in data:
+            node = node.setdefault(char, {})
+        node[None] = (len(data), route)
+
+    def route(self, data, **options):
+        """مزخرف لتسجيل دالة كمعالج لزر"""
+        def decorator(handler):
+            self.add(data, handler, **options)
+            return handler
+        return decorator
+
+    def match(self, data):
+        """يعيد (المسار، المعامل) بأطول بادئة مطابقة، أو (None, None)"""
+        if data is None:
+            return None, None
+        route = self.exact.get(data)
+        if route is not None:
+            return route, None
+        node = self.prefix_tree
+        found = None
+        for char in data:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                found = node[None]
+        if found is None:
+            return None, None
+        length, route = found
+        return route, data[length:]
+
+    def handles(self, data):
+        return self.match(data)[0] is not None
+
+    def dispatch(self, call):
+        chat_id = str(call.message.chat.id)
+        message_id = call.message.message_id
+        route, param = self.match(call.data)
+        if route is None:
+            return
         
-        elif call.data == "main_menu":
-            show_main_menu(chat_id, message_id)
+        # التحقق من وضع الصيانة
+        if route['maintenance'] and is_maintenance_mode() and not is_admin(chat_id):
+            maintenance = load_maintenance()
+            bot.answer_callback_query(call.id, "البوت في حالة صيانة", show_alert=True)
+            bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=message_id,
+                text=f"<b>🔧 الصيانة</b>\n\n{maintenance.get('message')}",
+                parse_mode="HTML"
+            )
+            return
         
-        elif call.data == "admin_broadcast":
-            if is_admin(chat_id):
-                user_data[chat_id] = {'state': 'admin_broadcast'}
-                bot.edit_message_text(
-                    chat_id=chat_id,
-                    message_id=message_id,
-                    text="📢 <b>الإرسال الجماعي</b>\n\nأرسل الرسالة التي تريد إرسالها لجميع المستخدمين:",
-                    parse_mode="HTML",
-                    reply_markup=EnhancedKeyboard.create_back_button("admin_panel")
-        )
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية الدخول", show_alert=True)
-
-        elif call.data == "admin_private_message":
-            if is_admin(chat_id):
-                user_data[chat_id] = {'state': 'admin_private_user'}
-                bot.edit_message_text(
-                    chat_id=chat_id,
-                    message_id=message_id,
-                    text="👤 <b>إرسال رسالة لمستخدم</b>\n\nأرسل آيدي المستخدم:",
-                    parse_mode="HTML",
-                    reply_markup=EnhancedKeyboard.create_back_button("admin_panel")
-        )
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية الدخول", show_alert=True)
+        if route['admin'] and not is_admin(chat_id):
+            bot.answer_callback_query(call.id, text=route['denied_text'], show_alert=True)
+            return
         
-        elif call.data == "maintenance_settings":
-            if is_admin(chat_id):
-                show_maintenance_settings(chat_id, message_id)
-            else:
-                bot.answer_callback_query(call.id, "ليس لديك صلاحية الدخول", show_alert=True)
+        try:
+            route['handler'](call, chat_id, message_id, param)
+        except Exception as e:
+            logger.error(f"❌ خطأ في المعالجة: {e}")
+            bot.answer_callback_query(call.id, "حدث خطأ", show_alert=True)
+
+callback_router = CallbackRouter()
+
+def prompt_for_state(state, prompt, parse_mode=None):
+    """معالج زر ينقل المشرف لحالة إدخال ويرسل له السؤال"""
+    def handler(call, chat_id, message_id, param):
+        user_data[chat_id] = {'state': state}
+        bot.send_message(chat_id, prompt, parse_mode=parse_mode)
+    return handler
+
+# الأقسام العامة
+callback_router.add("main_menu", lambda call, chat_id, message_id, param: show_main_menu(chat_id, message_id))
+callback_router.add("check_subscription", lambda call, chat_id, message_id, param: handle_subscription_check(call, chat_id, message_id))
+callback_router.add("account_section", lambda call, chat_id, message_id, param: show_account_section(chat_id, message_id))
+callback_router.add("create_account", lambda call, chat_id, message_id, param: start_account_creation(chat_id))
+callback_router.add("show_account", lambda call, chat_id, message_id, param: show_account_info(chat_id, message_id))
+callback_router.add("deposit_to_account", lambda call, chat_id, message_id, param: start_deposit_to_account(chat_id))
+callback_router.add("withdraw_from_account", lambda call, chat_id, message_id, param: start_withdraw_from_account(chat_id))
+callback_router.add("payment_methods", lambda call, chat_id, message_id, param: show_payment_methods(chat_id, message_id))
+callback_router.add("withdraw_methods", lambda call, chat_id, message_id, param: show_withdraw_methods(chat_id, message_id))
+callback_router.add("balance_history", lambda call, chat_id, message_id, param: show_balance_history(chat_id, message_id))
+callback_router.add("admin_panel", lambda call, chat_id, message_id, param: show_admin_panel(chat_id, message_id), admin=True)
+callback_router.add("payment_method_", lambda call, chat_id, message_id, param: start_payment_process(chat_id, message_id, param), prefix=True)
+callback_router.add("withdraw_method_", lambda call, chat_id, message_id, param: start_withdraw_process(chat_id, param), prefix=True)
+
+# الإحالات
+callback_router.add("referral_section", lambda call, chat_id, message_id, param: show_referral_section(chat_id, message_id))
+callback_router.add("show_my_referrals", lambda call, chat_id, message_id, param: show_my_referrals(chat_id, message_id))
+callback_router.add("referral_admin", lambda call, chat_id, message_id, param: show_referral_admin_panel(chat_id, message_id), admin=True)
+callback_router.add("referral_settings", lambda call, chat_id, message_id, param: show_referral_settings(chat_id, message_id), admin=True)
+callback_router.add("referral_stats", lambda call, chat_id, message_id, param: show_referral_stats(chat_id, message_id), admin=True)
+callback_router.add("edit_commission_rate", lambda call, chat_id, message_id, param: start_edit_commission_rate(chat_id), admin=True)
+callback_router.add("edit_payout_days", lambda call, chat_id, message_id, param: start_edit_payout_days(chat_id), admin=True)
+
+# معالجات التوزيع
+callback_router.add("distribute_commissions", lambda call, chat_id, message_id, param: distribute_commissions_handler(chat_id, message_id), admin=True)
+callback_router.add("silent_reset_confirm", lambda call, chat_id, message_id, param: confirm_silent_reset(chat_id, message_id), admin=True)
+callback_router.add("force_distribute", lambda call, chat_id, message_id, param: confirm_distribution(chat_id, message_id), admin=True)
+callback_router.add("force_distribute_confirm", lambda call, chat_id, message_id, param: confirm_distribution_final(chat_id, message_id), admin=True)
+
+@callback_router.route("delay_commissions_1", admin=True)
+def callback_delay_commissions(call, chat_id, message_id, param):
+    delay_commissions(1)
+    bot.answer_callback_query(call.id, text="✅ تم التأجيل 24 ساعة")
+
+@callback_router.route("cancel_commissions", admin=True)
+def callback_cancel_commissions(call, chat_id, message_id, param):
+    silent_reset_commissions()
+    bot.answer_callback_query(call.id, text="✅ تم الإلغاء وإعادة التعيين")
+
+@callback_router.route("confirm_silent_reset", admin=True)
+def callback_confirm_silent_reset(call, chat_id, message_id, param):
+    silent_reset_commissions()
+    bot.answer_callback_query(call.id, text="✅ تم إعادة التعيين الصامت")
+    show_referral_admin_panel(chat_id, message_id)
+
+@callback_router.route("force_distribute_final", admin=True)
+def callback_force_distribute_final(call, chat_id, message_id, param):
+    report, total = distribute_commissions()
+    if report:
+        bot.send_message(chat_id, report, parse_mode="HTML")
+        show_referral_admin_panel(chat_id, message_id)
+    else:
+        bot.send_message(chat_id, "❌ فشل في توزيع العمولات")
+
+# معالجات إدارة طرق الدفع والسحب
+callback_router.add("manage_payment_methods", lambda call, chat_id, message_id, param: show_manage_payment_methods(chat_id, message_id), admin=True)
+callback_router.add("add_payment_method", lambda call, chat_id, message_id, param: start_add_payment_method(chat_id), admin=True)
+callback_router.add("edit_payment_method_", lambda call, chat_id, message_id, param: start_edit_payment_method(chat_id, param), admin=True, prefix=True)
+callback_router.add("delete_payment_method_", lambda call, chat_id, message_id, param: confirm_delete_payment_method(chat_id, message_id, param), admin=True, prefix=True)
+callback_router.add("manage_withdraw_methods", lambda call, chat_id, message_id, param: show_manage_withdraw_methods(chat_id, message_id), admin=True)
+callback_router.add("add_withdraw_method", lambda call, chat_id, message_id, param: start_add_withdraw_method(chat_id), admin=True)
+callback_router.add("edit_withdraw_method_", lambda call, chat_id, message_id, param: start_edit_withdraw_method(chat_id, param), admin=True, prefix=True)
+callback_router.add("delete_withdraw_method_", lambda call, chat_id, message_id, param: confirm_delete_withdraw_method(chat_id, message_id, param), admin=True, prefix=True)
+
+@callback_router.route("confirm_delete_payment_", admin=True, prefix=True)
+def callback_confirm_delete_payment(call, chat_id, message_id, param):
+    success, message = payment_system.delete_payment_method(param)
+    bot.answer_callback_query(call.id, text=message)
+    show_manage_payment_methods(chat_id, message_id)
+
+@callback_router.route("confirm_delete_withdraw_", admin=True, prefix=True)
+def callback_confirm_delete_withdraw(call, chat_id, message_id, param):
+    success, message = withdraw_system.delete_withdraw_method(param)
+    bot.answer_callback_query(call.id, text=message)
+    show_manage_withdraw_methods(chat_id, message_id)
+
+# أزرار مجموعات الطلبات: تعمل أثناء الصيانة حتى تستمر معالجة الطلبات المعلقة
+callback_router.add("approve_payment_", lambda call, chat_id, message_id, param: handle_approve_payment(call, chat_id, message_id), maintenance=False, prefix=True)
+callback_router.add("reject_payment_", lambda call, chat_id, message_id, param: handle_reject_payment(call, chat_id, message_id), maintenance=False, prefix=True)
+callback_router.add("complete_withdraw_", lambda call, chat_id, message_id, param: handle_complete_withdrawal(call, chat_id, message_id), maintenance=False, prefix=True)
+callback_router.add("approve_compensation_", lambda call, chat_id, message_id, param: handle_approve_compensation(call, chat_id, message_id), maintenance=False, prefix=True)
+callback_router.add("reject_compensation_", lambda call, chat_id, message_id, param: handle_reject_compensation(call, chat_id, message_id), maintenance=False, prefix=True)
+callback_router.add("reply_to_user_", lambda call, chat_id, message_id, param: start_admin_reply(call, param), maintenance=False, prefix=True)
+callback_router.add("close_support_", lambda call, chat_id, message_id, param: close_support_request(call, param), maintenance=False, prefix=True)
+
+# نظام الولاء
+callback_router.add("loyalty_section", lambda call, chat_id, message_id, param: show_loyalty_section(chat_id, message_id))
+callback_router.add("loyalty_leaderboard", lambda call, chat_id, message_id, param: show_loyalty_leaderboard(chat_id, message_id))
+callback_router.add("loyalty_redeem", lambda call, chat_id, message_id, param: show_loyalty_redeem(chat_id, message_id))
+callback_router.add("loyalty_history", lambda call, chat_id, message_id, param: show_loyalty_history(chat_id, message_id))
+callback_router.add("loyalty_admin", lambda call, chat_id, message_id, param: show_loyalty_admin_panel(chat_id, message_id), admin=True)
+callback_router.add("loyalty_settings", lambda call, chat_id, message_id, param: show_loyalty_settings_admin(chat_id, message_id), admin=True)
+callback_router.add("loyalty_requests", lambda call, chat_id, message_id, param: show_pending_redemption_requests(chat_id, message_id), admin=True)
+callback_router.add("loyalty_stats", lambda call, chat_id, message_id, param: handle_loyalty_stats(call), admin=True)
+callback_router.add("edit_points_per_10000", prompt_for_state('edit_points_per_10000', "أرسل عدد النقاط لكل 10,000:"), admin=True)
+callback_router.add("edit_referral_points", prompt_for_state('edit_referral_points', "أرسل عدد نقاط الإحالة:"), admin=True)
+callback_router.add("edit_deposit_bonus", prompt_for_state('edit_deposit_bonus', "أرسل عدد نقاط مكافأة الإيداع الأولى:"), admin=True)
+callback_router.add("edit_min_redemption", prompt_for_state('edit_min_redemption', "أرسل الحد الأدنى لنقاط الاستبدال:"), admin=True)
+callback_router.add("edit_reset_days", prompt_for_state('edit_reset_days', "أرسل عدد أيام التصفير:"), admin=True)
+callback_router.add("manage_rewards", lambda call, chat_id, message_id, param: show_rewards_management(chat_id, message_id), admin=True)
+callback_router.add("add_reward", lambda call, chat_id, message_id, param: handle_add_reward(call), admin=True)
+callback_router.add("toggle_reward_", lambda call, chat_id, message_id, param: handle_toggle_reward(call), admin=True, prefix=True)
+callback_router.add("reset_all_points", lambda call, chat_id, message_id, param: handle_reset_all_points(call), admin=True)
+callback_router.add("confirm_reset_all_points", lambda call, chat_id, message_id, param: handle_confirm_reset_all_points(call), admin=True)
+callback_router.add("export_points_data", lambda call, chat_id, message_id, param: handle_export_points_data(call), admin=True)
+callback_router.add("approve_redemption_", lambda call, chat_id, message_id, param: handle_approve_redemption(call), admin=True, denied_text="ليس لديك صلاحية الموافقة", prefix=True)
+callback_router.add("reject_redemption_", lambda call, chat_id, message_id, param: handle_reject_redemption(call), admin=True, denied_text="ليس لديك صلاحية الرفض", prefix=True)
+
+@callback_router.route("redeem_", prefix=True)
+def callback_redeem(call, chat_id, message_id, param):
+    redemption_id, message_text = create_redemption_request(chat_id, param)
+    bot.answer_callback_query(call.id, text=message_text)
+    if redemption_id:
+        show_loyalty_redeem(chat_id, message_id)
+
+@callback_router.route("loyalty_toggle", admin=True)
+def callback_loyalty_toggle(call, chat_id, message_id, param):
+    # تفعيل/تعطيل النظام
+    settings = load_loyalty_settings()
+    current_status = settings.get('redemption_enabled', 'false')
+    new_status = 'true' if current_status == 'false' else 'false'
+    settings['redemption_enabled'] = new_status
+    save_loyalty_settings(settings)
+    
+    status_text = "مفعل" if new_status == 'true' else "معطل"
+    bot.answer_callback_query(call.id, text=f"تم {status_text} نظام الاستبدال")
+    show_loyalty_admin_panel(chat_id, message_id)
+
+@callback_router.route("edit_reward_", admin=True, prefix=True)
+def callback_edit_reward(call, chat_id, message_id, param):
+    bot.answer_callback_query(call.id, text="خاصية تعديل الجائزة قيد التطوير", show_alert=True)
+
+# نظام التعويض
+callback_router.add("compensation_section", lambda call, chat_id, message_id, param: show_compensation_section(chat_id, message_id))
+callback_router.add("request_compensation", lambda call, chat_id, message_id, param: handle_compensation_request(call, chat_id, message_id))
+callback_router.add("compensation_admin", lambda call, chat_id, message_id, param: show_compensation_admin_panel(chat_id, message_id), admin=True, denied_text="❌ ليس لديك صلاحية الدخول")
+callback_router.add("edit_compensation_rate", prompt_for_state('edit_compensation_rate', "🛡️ أرسل نسبة التعويض الجديدة (بدون %):\n\n<em>مثال: 10 (لنسبة 10%)</em>", "HTML"), admin=True, denied_text="❌ ليس لديك صلاحية الدخول")
+callback_router.add("edit_min_loss_amount", prompt_for_state('edit_min_loss_amount', "🛡️ أرسل الحد الأدنى للخسارة الجديد (SYP):\n\n<em>مثال: 10000</em>", "HTML"), admin=True, denied_text="❌ ليس لديك صلاحية الدخول")
+callback_router.add("toggle_compensation", lambda call, chat_id, message_id, param: toggle_compensation_system(chat_id, message_id), admin=True, denied_text="❌ ليس لديك صلاحية الدخول")
+callback_router.add("pending_compensations", lambda call, chat_id, message_id, param: show_pending_compensations(chat_id, message_id), admin=True, denied_text="❌ ليس لديك صلاحية الدخول")
+callback_router.add("refund_last_withdrawal", lambda call, chat_id, message_id, param: handle_refund_last_withdrawal(call, chat_id, message_id))
+callback_router.add("confirm_refund_", lambda call, chat_id, message_id, param: process_withdrawal_refund(call, param), prefix=True)
+
+# الدعم والشروط
+callback_router.add("contact_support", lambda call, chat_id, message_id, param: start_contact_support(chat_id))
+callback_router.add("confirm_support_message", lambda call, chat_id, message_id, param: confirm_support_message(call))
+callback_router.add("cancel_support_message", lambda call, chat_id, message_id, param: cancel_support_message(call))
+callback_router.add("show_terms", lambda call, chat_id, message_id, param: show_terms_and_conditions(chat_id, message_id))
+
+# نظام الإهداء
+callback_router.add("gift_balance", lambda call, chat_id, message_id, param: show_gift_section(chat_id, message_id))
+callback_router.add("start_gift", lambda call, chat_id, message_id, param: start_gift_process(chat_id))
+callback_router.add("gift_history", lambda call, chat_id, message_id, param: show_gift_history(chat_id, message_id))
+callback_router.add("gift_code", lambda call, chat_id, message_id, param: start_gift_code_input(chat_id))
+callback_router.add("gift_admin", lambda call, chat_id, message_id, param: show_gift_admin_panel(chat_id, message_id), admin=True)
+callback_router.add("gift_detailed_stats", lambda call, chat_id, message_id, param: show_gift_detailed_stats(chat_id, message_id), admin=True)
+callback_router.add("all_gift_transactions", lambda call, chat_id, message_id, param: show_all_gift_transactions(chat_id, message_id), admin=True)
+callback_router.add("edit_gift_settings", lambda call, chat_id, message_id, param: show_edit_gift_settings(chat_id, message_id), admin=True)
+callback_router.add("edit_gift_commission", lambda call, chat_id, message_id, param: start_edit_gift_commission(chat_id), admin=True)
+callback_router.add("edit_gift_min_amount", lambda call, chat_id, message_id, param: start_edit_gift_min_amount(chat_id), admin=True)
+callback_router.add("toggle_gift_system", lambda call, chat_id, message_id, param: toggle_gift_system(chat_id, message_id), admin=True)
+callback_router.add("export_gift_data", lambda call, chat_id, message_id, param: export_gift_data(chat_id), admin=True)
+callback_router.add("export_gift_data_", lambda call, chat_id, message_id, param: export_gift_data(chat_id, start_date=export_start_from_days(param)), admin=True, prefix=True)
+callback_router.add("gift_code_admin", lambda call, chat_id, message_id, param: start_create_gift_code(chat_id), admin=True, denied_text="ليس لديك صلاحية")
+callback_router.add("gift_code_manage", lambda call, chat_id, message_id, param: show_gift_code_management(chat_id, message_id), admin=True, denied_text="ليس لديك صلاحية")
+callback_router.add("revoke_gift_", lambda call, chat_id, message_id, param: handle_revoke_gift_code(call, param), admin=True, denied_text="ليس لديك صلاحية", prefix=True)
+
+@callback_router.route("confirm_gift")
+def callback_confirm_gift(call, chat_id, message_id, param):
+    process_gift_transaction(chat_id)
+    show_gift_section(chat_id, message_id)
+
+@callback_router.route("cancel_gift")
+def callback_cancel_gift(call, chat_id, message_id, param):
+    if chat_id in user_data:
+        del user_data[chat_id]
+    show_gift_section(chat_id, message_id)
+    bot.answer_callback_query(call.id, "تم إلغاء العملية")
+
+# سجل السحب
+callback_router.add("withdraw_history", lambda call, chat_id, message_id, param: show_withdraw_history(chat_id, message_id))
+callback_router.add("withdraw_stats", lambda call, chat_id, message_id, param: show_withdraw_stats(chat_id, message_id))
+
+@callback_router.route("export_withdraw_history_", prefix=True)
+def callback_export_withdraw_history(call, chat_id, message_id, param):
+    success, result_text = export_withdraw_history(chat_id, start_date=export_start_from_days(param))
+    bot.answer_callback_query(call.id, result_text, show_alert=not success)
+
+# نظام النرد
+callback_router.add("dice_section", lambda call, chat_id, message_id, param: show_dice_section(chat_id, message_id))
+callback_router.add("play_dice", lambda call, chat_id, message_id, param: handle_play_dice(call))
+callback_router.add("dice_rewards", lambda call, chat_id, message_id, param: show_dice_rewards(chat_id, message_id))
+callback_router.add("dice_stats", lambda call, chat_id, message_id, param: show_dice_stats(chat_id, message_id))
+callback_router.add("dice_admin", lambda call, chat_id, message_id, param: show_dice_admin_panel(chat_id, message_id), admin=True)
+callback_router.add("dice_settings", lambda call, chat_id, message_id, param: show_dice_settings_admin(chat_id, message_id), admin=True)
+callback_router.add("toggle_dice_system", lambda call, chat_id, message_id, param: toggle_dice_system(chat_id, message_id), admin=True)
+callback_router.add("edit_dice_price", lambda call, chat_id, message_id, param: handle_edit_dice_price(call), admin=True)
+callback_router.add("edit_dice_cooldown", lambda call, chat_id, message_id, param: handle_edit_dice_cooldown(call), admin=True)
+callback_router.add("manage_dice_rewards", lambda call, chat_id, message_id, param: handle_manage_dice_rewards(call), admin=True)
+callback_router.add("dice_admin_stats", lambda call, chat_id, message_id, param: handle_dice_admin_stats(call), admin=True)
+callback_router.add("add_dice_reward", lambda call, chat_id, message_id, param: handle_add_dice_reward(call), admin=True)
+callback_router.add("edit_dice_reward_", lambda call, chat_id, message_id, param: handle_edit_dice_reward(call), admin=True, prefix=True)
+callback_router.add("dice_fixed_", lambda call, chat_id, message_id, param: handle_dice_fixed(call), admin=True, prefix=True)
+callback_router.add("dice_percentage_", lambda call, chat_id, message_id, param: handle_dice_percentage(call), admin=True, prefix=True)
+callback_router.add("dice_bonus_", lambda call, chat_id, message_id, param: handle_dice_bonus(call), admin=True, prefix=True)
+callback_router.add("dice_disable_", lambda call, chat_id, message_id, param: handle_dice_disable(call), admin=True, prefix=True)
+callback_router.add("dice_enable_", lambda call, chat_id, message_id, param: handle_dice_enable(call), admin=True, prefix=True)
+
+# أدوات الإدارة
+callback_router.add("maintenance_settings", lambda call, chat_id, message_id, param: show_maintenance_settings(chat_id, message_id), admin=True)
+callback_router.add("account_queue_stats", lambda call, chat_id, message_id, param: show_account_operations_stats(chat_id, message_id), admin=True)
+
+@callback_router.route("admin_broadcast", admin=True)
+def callback_admin_broadcast(call, chat_id, message_id, param):
+    user_data[chat_id] = {'state': 'admin_broadcast'}
+    bot.edit_message_text(
+        chat_id=chat_id,
+        message_id=message_id,
+        text="📢 <b>الإرسال الجماعي</b>\n\nأرسل الرسالة التي تريد إرسالها لجميع المستخدمين:",
+        parse_mode="HTML",
+        reply_markup=EnhancedKeyboard.create_back_button("admin_panel")
+    )
 
+@callback_router.route("admin_private_message", admin=True)
+def callback_admin_private_message(call, chat_id, message_id, param):
+    user_data[chat_id] = {'state': 'admin_private_user'}
+    bot.edit_message_text(
+        chat_id=chat_id,
+        message_id=message_id,
+        text="👤 <b>إرسال رسالة لمستخدم</b>\n\nأرسل آيدي المستخدم:",
+        parse_mode="HTML",
+        reply_markup=EnhancedKeyboard.create_back_button("admin_panel")
+    )
 
+# معالجات تفعيل/تعطيل الصيانة
+@callback_router.route("enable_maintenance", admin=True)
+def callback_enable_maintenance(call, chat_id, message_id, param):
+    maintenance_data = {'active': True, 'message': 'البوت في حالة صيانة مؤقتة'}
+    save_maintenance(maintenance_data)
+    bot.answer_callback_query(call.id, "✅ تم تفعيل وضع الصيانة")
+    show_maintenance_settings(chat_id, message_id)
 
-        # معالجات تفعيل/تعطيل الصيانة
-        elif call.data == "enable_maintenance":
-            if is_admin(chat_id):
-                maintenance_data = {'active': True, 'message': 'البوت في حالة صيانة مؤقتة'}
-                save_maintenance(maintenance_data)
-                bot.answer_callback_query(call.id, "✅ تم تفعيل وضع الصيانة")
-                show_maintenance_settings(chat_id, message_id)
+@callback_router.route("disable_maintenance", admin=True)
+def callback_disable_maintenance(call, chat_id, message_id, param):
+    maintenance_data = {'active': False, 'message': 'البوت في حالة صيانة مؤقتة'}
+    save_maintenance(maintenance_data)
+    bot.answer_callback_query(call.id, "❌ تم تعطيل وضع الصيانة")
+    show_maintenance_settings(chat_id, message_id)
 
-        elif call.data == "disable_maintenance":
-            if is_admin(chat_id):
-                maintenance_data = {'active': False, 'message': 'البوت في حالة صيانة مؤقتة'}
-                save_maintenance(maintenance_data)
-                bot.answer_callback_query(call.id, "❌ تم تعطيل وضع الصيانة")
-                show_maintenance_settings(chat_id, message_id)
-        
-        
-        
-        
-    except Exception as e:
-        logger.error(f"❌ خطأ في المعالجة: {e}")
-        bot.answer_callback_query(call.id, "حدث خطأ", show_alert=True)
+# الأزرار غير المسجلة تمر لمعالجاتها الخاصة المسجلة بعد هذا المعالج
+@bot.callback_query_handler(func=lambda call: callback_router.handles(call.data))
+def handle_callbacks(call):
+    callback_router.dispatch(call)
 
 
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'edit_points_per_10000')
+@conversation_states.on('edit_points_per_10000')
 def handle_edit_points_per_10000(message):
     chat_id = str(message.chat.id)
     try:
@@ -6680,7 +8472,7 @@ def handle_edit_points_per_10000(message):
     except ValueError:
         bot.send_message(chat_id, "يرجى إدخال رقم صحيح")
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'edit_referral_points')
+@conversation_states.on('edit_referral_points')
 def handle_edit_referral_points(message):
     chat_id = str(message.chat.id)
     try:
@@ -6703,7 +8495,7 @@ def handle_edit_referral_points(message):
     except ValueError:
         bot.send_message(chat_id, "يرجى إدخال رقم صحيح")
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'edit_deposit_bonus')
+@conversation_states.on('edit_deposit_bonus')
 def handle_edit_deposit_bonus(message):
     chat_id = str(message.chat.id)
     try:
@@ -6726,7 +8518,7 @@ def handle_edit_deposit_bonus(message):
     except ValueError:
         bot.send_message(chat_id, "يرجى إدخال رقم صحيح")
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'edit_min_redemption')
+@conversation_states.on('edit_min_redemption')
 def handle_edit_min_redemption(message):
     chat_id = str(message.chat.id)
     try:
@@ -6749,7 +8541,7 @@ def handle_edit_min_redemption(message):
     except ValueError:
         bot.send_message(chat_id, "يرجى إدخال رقم صحيح")
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'edit_reset_days')
+@conversation_states.on('edit_reset_days')
 def handle_edit_reset_days(message):
     chat_id = str(message.chat.id)
     try:
@@ -6863,12 +8655,20 @@ def handle_reject_redemption(call):
             reward_name = result[0]['reward_name']
             
             # استرجاع النقاط للمستخدم
-            db_manager.execute_query("""
+            refunded = db_manager.execute_query("""
                 UPDATE loyalty_points 
                 SET points = points + %s 
                 WHERE user_id = %s
+                RETURNING points
             """, (points_cost, user_id))
             
+            # تحديث الذاكرة بعد حفظ المعاملة الجارية فقط
+            def apply_to_memory():
+                user_profiles.invalidate(user_id)
+                if refunded:
+                    leaderboard.update(user_id, refunded[0]['points'])
+            db_manager.on_commit(apply_to_memory)
+            
             # تسجيل في السجل
             db_manager.execute_query("""
                 INSERT INTO loyalty_points_history 
@@ -6923,17 +8723,19 @@ def handle_loyalty_stats(call):
     
     try:
         # إحصائيات عامة
-        total_users_result = db_manager.execute_query("SELECT COUNT(*) as count FROM loyalty_points WHERE points > 0")
-        total_users = total_users_result[0]['count'] if total_users_result else 0
-        
-        total_points_result = db_manager.execute_query("SELECT SUM(points) as total FROM loyalty_points")
-        total_points = total_points_result[0]['total'] if total_points_result and total_points_result[0]['total'] else 0
-        
-        pending_requests_result = db_manager.execute_query("SELECT COUNT(*) as count FROM loyalty_redemptions WHERE status = 'pending'")
-        pending_requests = pending_requests_result[0]['count'] if pending_requests_result else 0
-        
-        completed_requests_result = db_manager.execute_query("SELECT COUNT(*) as count FROM loyalty_redemptions WHERE status = 'approved'")
-        completed_requests = completed_requests_result[0]['count'] if completed_requests_result else 0
+        leaderboard_stats = leaderboard.get_stats()
+        total_users = leaderboard_stats['holders']
+        total_points = leaderboard_stats['total_points']
+        
+        # أعداد الطلبات حالة تشغيلية تقرأ مباشرة، والمجاميع التاريخية من اللقطة
+        redemptions = db_manager.execute_query("""
+            SELECT COUNT(*) FILTER (WHERE status = 'pending') AS pending,
+                   COUNT(*) FILTER (WHERE status = 'approved') AS approved
+            FROM loyalty_redemptions
+        """)
+        pending_requests = redemptions[0]['pending'] if redemptions else 0
+        completed_requests = redemptions[0]['approved'] if redemptions else 0
+        stats, computed_at = stats_rollup.snapshot('loyalty')
         
         # أفضل 5 مستخدمين
         top_users = get_top_users_by_points(5)
@@ -6957,17 +8759,11 @@ def handle_loyalty_stats(call):
         else:
             text += "لا توجد بيانات\n"
         
-        # إحصائيات الشهر الحالي
-        current_month = datetime.now().strftime('%Y-%m')
-        monthly_points_result = db_manager.execute_query("""
-            SELECT SUM(points_change) as total 
-            FROM loyalty_points_history 
-            WHERE EXTRACT(YEAR_MONTH FROM created_at) = %s AND points_change > 0
-        """, (current_month.replace('-', ''),))
-        
-        monthly_points = monthly_points_result[0]['total'] if monthly_points_result and monthly_points_result[0]['total'] else 0
+        # إحصائيات الشهر الحالي من المجاميع اليومية
+        monthly_points = stats.get('monthly_points', 0)
         
         text += f"\n📈 <b>نقاط الشهر الحالي:</b> {monthly_points}♞"
+        text += stats_rollup.format_computed_at(computed_at)
         
         markup = types.InlineKeyboardMarkup()
         markup.add(types.InlineKeyboardButton("🔄 تحديث", callback_data="loyalty_stats"))
@@ -7096,7 +8892,7 @@ def handle_add_reward(call):
         reply_markup=EnhancedKeyboard.create_back_button("manage_rewards")
     )
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'add_reward_name')
+@conversation_states.on('add_reward_name', next_states=('add_reward_description',))
 def handle_add_reward_name(message):
     chat_id = str(message.chat.id)
     name = message.text.strip()
@@ -7114,7 +8910,7 @@ def handle_add_reward_name(message):
         parse_mode="HTML"
     )
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'add_reward_description')
+@conversation_states.on('add_reward_description', next_states=('add_reward_points',))
 def handle_add_reward_description(message):
     chat_id = str(message.chat.id)
     description = message.text.strip()
@@ -7128,7 +8924,7 @@ def handle_add_reward_description(message):
         parse_mode="HTML"
     )
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'add_reward_points')
+@conversation_states.on('add_reward_points', next_states=('add_reward_discount',))
 def handle_add_reward_points(message):
     chat_id = str(message.chat.id)
     
@@ -7150,7 +8946,7 @@ def handle_add_reward_points(message):
     except ValueError:
         bot.send_message(chat_id, "يرجى إدخال رقم صحيح")
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'add_reward_discount')
+@conversation_states.on('add_reward_discount')
 def handle_add_reward_discount(message):
     chat_id = str(message.chat.id)
     
@@ -7222,6 +9018,8 @@ def handle_confirm_reset_all_points(call):
         success = db_manager.execute_query("UPDATE loyalty_points SET points = 0, last_reset = CURRENT_TIMESTAMP")
         
         if success:
+            user_profiles.clear()
+            leaderboard.reset()
             # تسجيل في السجل
             db_manager.execute_query("""
                 INSERT INTO loyalty_points_history (user_id, points_change, reason)
@@ -7248,27 +9046,23 @@ def handle_export_points_data(call):
         return
     
     try:
-        # جلب بيانات النقاط
-        result = db_manager.execute_query("""
+        # بيانات النقاط تكتب مباشرة من المؤشر إلى الملف
+        exported = send_csv_export(
+            chat_id,
+            'loyalty_points.csv',
+            ['User ID', 'Points', 'Last Reset', 'Last Update'],
+            """
             SELECT user_id, points, last_reset, updated_at
             FROM loyalty_points 
             WHERE points > 0 
             ORDER BY points DESC
-        """)
+            """,
+            None,
+            lambda row: [row['user_id'], row['points'], row['last_reset'], row['updated_at']],
+            "<b>📊 تصدير بيانات نقاط الامتياز</b>"
+        )
         
-        if result:
-            # إنشاء ملف نصي
-            csv_data = "User ID,Points,Last Reset,Last Update\n"
-            for row in result:
-                csv_data += f"{row['user_id']},{row['points']},{row['last_reset']},{row['updated_at']}\n"
-            
-            # إرسال كملف
-            bot.send_document(
-                chat_id,
-                ('loyalty_points.csv', csv_data.encode('utf-8')),
-                caption="<b>📊 تصدير بيانات نقاط الامتياز</b>",
-                parse_mode="HTML"
-            )
+        if exported:
             bot.answer_callback_query(call.id, text="تم تصدير البيانات")
         else:
             bot.answer_callback_query(call.id, text="لا توجد بيانات للتصدير", show_alert=True)
@@ -7290,23 +9084,21 @@ def handle_export_points_data(call):
 def show_main_menu(chat_id, message_id=None):
     """عرض القائمة الرئيسية المحدثة"""
     try:
-        # جلب بيانات المستخدم
-        user_title = get_user_title(chat_id)
-        wallet_balance = get_wallet_balance(chat_id)
-        loyalty_points = get_loyalty_points(chat_id)
+        # جلب بيانات المستخدم باستعلام واحد
+        profile = user_profiles.get(chat_id)
+        if profile is None:
+            raise RuntimeError("تعذر تحميل ملف المستخدم")
+        profile.ensure_rows()
         
         # نص الترحيب المحدث
         welcome_text = (
-            f"<b> <blockquote>👋 اهلا بك {user_title}</b> </blockquote>\n\n"
-            f"💰 <b>رصيدك في البوت:</b> {wallet_balance:.2f}\n"
-            f"💎 <b>نقاط الامتياز:</b> {loyalty_points}\n\n"
+            f"<b> <blockquote>👋 اهلا بك {profile.title}</b> </blockquote>\n\n"
+            f"💰 <b>رصيدك في البوت:</b> {profile.wallet_balance:.2f}\n"
+            f"💎 <b>نقاط الامتياز:</b> {profile.loyalty_points}\n\n"
             f"<b>اختر من القائمة:</b>"
         )
         
-        accounts = load_accounts()
-        has_account = str(chat_id) in accounts
-        
-        markup = EnhancedKeyboard.create_main_menu(has_account, is_admin(chat_id))
+        markup = EnhancedKeyboard.create_main_menu(profile.has_account, is_admin(chat_id))
         
         if message_id:
             bot.edit_message_text(
@@ -7347,13 +9139,12 @@ def show_main_menu(chat_id, message_id=None):
             pass
 
 def show_account_section(chat_id, message_id):
-    accounts = load_accounts()
-    has_account = str(chat_id) in accounts
+    account = account_repository.get(chat_id)
+    has_account = account is not None
     
     text = "<b>⚡ قسم حساب 55BETS</b>\n\n"
     
     if has_account:
-        account = accounts[str(chat_id)]
         player_id = account.get("playerId")
         account_balance = get_player_balance_via_agent(player_id) if player_id else 'غير متوفر'
         wallet_balance = get_wallet_balance(chat_id)
@@ -7386,9 +9177,9 @@ def show_account_section(chat_id, message_id):
 
 
 def handle_subscription_check(call, chat_id, message_id):
-    if is_user_subscribed(call.from_user.id):
-        accounts = load_accounts()
-        has_account = str(chat_id) in accounts
+    # المستخدم ضغط "تم الاشتراك" للتو فلا نعتمد على نتيجة سلبية مخزنة
+    if is_user_subscribed(call.from_user.id, force=True):
+        has_account = account_repository.exists(chat_id)
         
         bot.edit_message_text(
             chat_id=chat_id,
@@ -7416,7 +9207,7 @@ def start_account_creation(chat_id):
         reply_markup=EnhancedKeyboard.create_back_button("account_section")
     )
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'awaiting_username')
+@conversation_states.on('awaiting_username', next_states=('awaiting_password',))
 def handle_username_input(message):
     chat_id = str(message.chat.id)
     username = message.text.strip()
@@ -7438,7 +9229,7 @@ def handle_username_input(message):
         parse_mode="HTML"
     )
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'awaiting_password')
+@conversation_states.on('awaiting_password')
 def handle_password_input(message):
     chat_id = str(message.chat.id)
     password = message.text.strip()
@@ -7456,7 +9247,9 @@ def handle_password_input(message):
         'username': username,
         'password': password
     }
-    account_operations_queue.put(task)
+    if not account_operations_queue.put(task, f"create_account:{chat_id}:{message.message_id}"):
+        bot.send_message(chat_id, "❌ حدث خطأ أثناء المعالجة. يرجى المحاولة لاحقاً.")
+        return
     
     # تنظيف البيانات المؤقتة
     if chat_id in user_data:
@@ -7473,8 +9266,7 @@ def handle_password_input(message):
     )
 
 def show_account_info(chat_id, message_id):
-    accounts = load_accounts()
-    account = accounts.get(str(chat_id))
+    account = account_repository.get(chat_id)
     
     if account:
         player_id = account.get("playerId")
@@ -7520,8 +9312,7 @@ def show_account_info(chat_id, message_id):
 
 
 def start_deposit_to_account(chat_id):
-    accounts = load_accounts()
-    account = accounts.get(str(chat_id))
+    account = account_repository.get(chat_id)
     
     if not account:
         bot.send_message(chat_id, "❌ لا يوجد حساب مرتبط بك")
@@ -7547,7 +9338,7 @@ def start_deposit_to_account(chat_id):
         reply_markup=EnhancedKeyboard.create_back_button("account_section")
     )
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'deposit_to_account_amount')
+@conversation_states.on('deposit_to_account_amount')
 def handle_deposit_to_account_amount(message):
     chat_id = str(message.chat.id)
     
@@ -7569,6 +9360,12 @@ def handle_deposit_to_account_amount(message):
             bot.send_message(chat_id, f"❌ رصيدك غير كافي. رصيدك الحالي: {wallet_balance}")
             return
         
+        # فحص مسبق من الرصيد المخزن فقط، والتحقق النهائي يتم عند تنفيذ المهمة
+        cashier_balance = cashier_balance_cache.peek()
+        if cashier_balance is not None and cashier_balance < amount:
+            bot.send_message(chat_id, "❌ رصيد الكاشير غير كافي حالياً. يرجى المحاولة لاحقاً.")
+            return
+        
         player_id = user_data[chat_id]['player_id']
         
         task = {
@@ -7577,7 +9374,9 @@ def handle_deposit_to_account_amount(message):
             'amount': amount,
             'player_id': player_id
         }
-        account_operations_queue.put(task)
+        if not account_operations_queue.put(task, f"deposit_to_account:{chat_id}:{message.message_id}"):
+            bot.send_message(chat_id, "❌ حدث خطأ أثناء المعالجة. يرجى المحاولة لاحقاً.")
+            return
         
         if chat_id in user_data:
             del user_data[chat_id]
@@ -7592,8 +9391,7 @@ def handle_deposit_to_account_amount(message):
         bot.send_message(chat_id, "❌ يرجى إدخال مبلغ صحيح")
 
 def start_withdraw_from_account(chat_id):
-    accounts = load_accounts()
-    account = accounts.get(str(chat_id))
+    account = account_repository.get(chat_id)
     
     if not account:
         bot.send_message(chat_id, "❌ لا يوجد حساب مرتبط بك")
@@ -7622,7 +9420,7 @@ def start_withdraw_from_account(chat_id):
         reply_markup=EnhancedKeyboard.create_back_button("account_section")
     )
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'withdraw_from_account_amount')
+@conversation_states.on('withdraw_from_account_amount')
 def handle_withdraw_from_account_amount(message):
     chat_id = str(message.chat.id)
     
@@ -7653,7 +9451,9 @@ def handle_withdraw_from_account_amount(message):
             'amount': amount,
             'player_id': player_id
         }
-        account_operations_queue.put(task)
+        if not account_operations_queue.put(task, f"withdraw_from_account:{chat_id}:{message.message_id}"):
+            bot.send_message(chat_id, "❌ حدث خطأ أثناء المعالجة. يرجى المحاولة لاحقاً.")
+            return
         
         if chat_id in user_data:
             del user_data[chat_id]
@@ -7721,8 +9521,7 @@ def show_withdraw_methods(chat_id, message_id):
 
 def show_balance_history(chat_id, message_id):
     wallet_balance = get_wallet_balance(chat_id)
-    accounts = load_accounts()
-    account = accounts.get(str(chat_id))
+    account = account_repository.get(chat_id)
     
     account_balance = 0
     if account and account.get('playerId'):
@@ -7776,7 +9575,7 @@ def start_payment_process(chat_id, message_id, method_id):
         parse_mode="HTML"
     )
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'payment_transaction_id')
+@conversation_states.on('payment_transaction_id', next_states=('payment_amount',))
 def handle_payment_transaction_id(message):
     chat_id = str(message.chat.id)
     transaction_id = message.text.strip()
@@ -7814,7 +9613,7 @@ def handle_payment_transaction_id(message):
         parse_mode="HTML"
     )
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'payment_amount')
+@conversation_states.on('payment_amount')
 def handle_payment_amount(message):
     chat_id = str(message.chat.id)
     
@@ -7912,7 +9711,7 @@ def start_withdraw_process(chat_id, method_id):
         parse_mode="HTML"
     )
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'withdraw_amount')
+@conversation_states.on('withdraw_amount', next_states=('withdraw_address',))
 def handle_withdraw_amount(message):
     chat_id = str(message.chat.id)
     
@@ -7960,7 +9759,7 @@ def handle_withdraw_amount(message):
     except ValueError:
         bot.send_message(chat_id, "❌ يرجى إدخال مبلغ صحيح")
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'withdraw_address')
+@conversation_states.on('withdraw_address')
 def handle_withdraw_address(message):
     chat_id = str(message.chat.id)
     address = message.text.strip()
@@ -7975,10 +9774,8 @@ def handle_withdraw_address(message):
     method_id = user_data[chat_id]['withdraw_method']
     method = withdraw_system.methods.get(method_id)
     
-    current_balance = get_wallet_balance(chat_id)
-    if current_balance >= amount:
-        new_balance = update_wallet_balance(chat_id, -amount)
-        
+    new_balance = debit_wallet_balance(chat_id, amount)
+    if new_balance is not None:
         request_text = f"""
 <b>💸 طلب سحب جديد</b>
 
@@ -8072,7 +9869,7 @@ def show_loyalty_leaderboard(chat_id, message_id):
     """عرض ترتيب أفضل 10"""
     top_users = get_top_users_by_points(10)
     user_points = get_loyalty_points(chat_id)
-    user_rank = "غير محدد"
+    user_rank = leaderboard.rank_of(chat_id) or "غير محدد"
     
     text = f"""
 <b>🏆 ترتيب أفضل 10 في نقاط الامتياز</b>
@@ -8084,9 +9881,6 @@ def show_loyalty_leaderboard(chat_id, message_id):
             user_id = user['user_id']
             points = user['points']
             text += f"{i}. 👤 {user_id[:8]}... - {points}♞\n"
-            
-            if user_id == str(chat_id):
-                user_rank = i
     else:
         text += "لا توجد نقاط مسجلة بعد\n"
     
@@ -8303,37 +10097,10 @@ def show_compensation_section(chat_id, message_id):
     compensation_rate = float(settings.get('compensation_rate', 0.1)) * 100
     min_loss_amount = float(settings.get('min_loss_amount', 10000))
     
-    # حساب الخسارة الإجمالية (بدون استبعاد التعويضات السابقة)
-    def get_gross_net_loss(user_id):
-        """حساب صافي الخسارة الإجمالية بدون استبعاد التعويضات"""
-        try:
-            # حساب إجمالي الإيداعات
-            deposit_result = db_manager.execute_query(
-                "SELECT COALESCE(SUM(amount), 0) as total_deposits FROM transactions "
-                "WHERE user_id = %s AND type = 'deposit' AND created_at >= NOW() - INTERVAL '24 hours'",
-                (str(user_id),)
-            )
-            total_deposits = float(deposit_result[0]['total_deposits']) if deposit_result else 0
-            
-            # حساب إجمالي السحوبات
-            withdraw_result = db_manager.execute_query(
-                "SELECT COALESCE(SUM(amount), 0) as total_withdrawals FROM transactions "
-                "WHERE user_id = %s AND type = 'withdraw' AND created_at >= NOW() - INTERVAL '24 hours'",
-                (str(user_id),)
-            )
-            total_withdrawals = float(withdraw_result[0]['total_withdrawals']) if withdraw_result else 0
-            
-            # صافي الخسارة الإجمالية = الإيداعات - السحوبات
-            gross_net_loss = total_deposits - total_withdrawals
-            return max(0, gross_net_loss)
-            
-        except Exception as e:
-            logger.error(f"❌ خطأ في حساب الخسارة الإجمالية: {str(e)}")
-            return 0
-    
-    # حساب الخسارة المتاحة للتعويض (باستبعاد التعويضات السابقة)
-    available_net_loss = get_user_net_loss_24h(chat_id)
-    gross_net_loss = get_gross_net_loss(chat_id)
+    # الخسارة الإجمالية والمتاحة للتعويض وآخر تعويض من مجاميع الساعات في قراءة واحدة
+    summary = transaction_buckets.loss_summary(chat_id) or {}
+    available_net_loss = summary.get('net_loss', 0)
+    gross_net_loss = summary.get('gross_net_loss', 0)
     
     # التحقق من الأهلية
     eligible = available_net_loss >= min_loss_amount
@@ -8341,22 +10108,15 @@ def show_compensation_section(chat_id, message_id):
     # حساب مبلغ التعويض المتوقع
     expected_compensation = available_net_loss * (float(settings.get('compensation_rate', 0.1)))
     
-    # الحصول على آخر تعويض
-    last_compensation = db_manager.execute_query(
-        "SELECT last_compensation_loss, last_compensation_date FROM compensation_tracking "
-        "WHERE user_id = %s AND last_compensation_date >= NOW() - INTERVAL '24 hours'",
-        (str(chat_id),)
-    )
-    
     text = f"""
 ❇️ الشرط: تعويض {compensation_rate}% عند خسارة SYP {min_loss_amount:,.0f}
  على الاقل خلال 24 ساعة.يحصل كل مستخدم على التعويض بشكل فردي ولا يوجد موعد محدد للتوزيع، يتم اضافة قيمة التعويض بعد الاحتساب بشكل فردي بعد التحقق من الشروط حان موعد الحصول على التعويض، قم بالنقر على الزر ادناه ✅>
 """
 
     # إضافة معلومات عن آخر تعويض إذا وجد
-    if last_compensation and len(last_compensation) > 0:
-        last_loss = last_compensation[0]['last_compensation_loss']
-        last_date = last_compensation[0]['last_compensation_date'].strftime('%Y-%m-%d %H:%M')
+    if summary.get('last_compensation_date'):
+        last_loss = summary['compensated_loss']
+        last_date = summary['last_compensation_date'].strftime('%Y-%m-%d %H:%M')
         text += f"""
 • آخر تعويض: <b>{last_loss:,.0f} SYP</b> في {last_date}
 """
@@ -8614,16 +10374,14 @@ def show_compensation_admin_panel(chat_id, message_id):
     min_loss_amount = float(settings.get('min_loss_amount', 10000))
     enabled = settings.get('compensation_enabled', 'true') == 'true'
     
-    # إحصائيات الطلبات
-    pending_requests = db_manager.execute_query(
-        "SELECT COUNT(*) as count FROM compensation_requests WHERE status = 'pending'"
-    )
-    pending_count = pending_requests[0]['count'] if pending_requests else 0
-    
-    approved_requests = db_manager.execute_query(
-        "SELECT COUNT(*) as count FROM compensation_requests WHERE status = 'approved'"
-    )
-    approved_count = approved_requests[0]['count'] if approved_requests else 0
+    # إحصائيات الطلبات تقرأ مباشرة لأنها قائمة عمل تتغير مع كل موافقة أو رفض
+    requests_result = db_manager.execute_query("""
+        SELECT COUNT(*) FILTER (WHERE status = 'pending') AS pending,
+               COUNT(*) FILTER (WHERE status = 'approved') AS approved
+        FROM compensation_requests
+    """)
+    pending_count = requests_result[0]['pending'] if requests_result else 0
+    approved_count = requests_result[0]['approved'] if requests_result else 0
     
     text = f"""
 🛡️ <b>إدارة نظام التعويض</b>
@@ -8786,7 +10544,7 @@ def start_add_payment_method(chat_id):
         reply_markup=EnhancedKeyboard.create_back_button("manage_payment_methods")
     )
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'add_payment_name')
+@conversation_states.on('add_payment_name', next_states=('add_payment_address',))
 def handle_payment_name(message):
     chat_id = str(message.chat.id)
     name = message.text.strip()
@@ -8805,7 +10563,7 @@ def handle_payment_name(message):
         parse_mode="HTML"
     )
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'add_payment_address')
+@conversation_states.on('add_payment_address', next_states=('add_payment_min_amount',))
 def handle_payment_address(message):
     chat_id = str(message.chat.id)
     address = message.text.strip()
@@ -8824,7 +10582,7 @@ def handle_payment_address(message):
         parse_mode="HTML"
     )
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'add_payment_min_amount')
+@conversation_states.on('add_payment_min_amount', next_states=('add_payment_exchange_rate',))
 def handle_payment_min_amount(message):
     chat_id = str(message.chat.id)
     
@@ -8847,7 +10605,7 @@ def handle_payment_min_amount(message):
     except ValueError:
         bot.send_message(chat_id, "❌ يرجى إدخال رقم صحيح")
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'add_payment_exchange_rate')
+@conversation_states.on('add_payment_exchange_rate')
 def handle_payment_exchange_rate(message):
     chat_id = str(message.chat.id)
     
@@ -8962,7 +10720,7 @@ def start_add_withdraw_method(chat_id):
         reply_markup=EnhancedKeyboard.create_back_button("manage_withdraw_methods")
     )
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'add_withdraw_name')
+@conversation_states.on('add_withdraw_name', next_states=('add_withdraw_commission',))
 def handle_withdraw_name(message):
     chat_id = str(message.chat.id)
     name = message.text.strip()
@@ -8981,7 +10739,7 @@ def handle_withdraw_name(message):
         parse_mode="HTML"
     )
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'add_withdraw_commission')
+@conversation_states.on('add_withdraw_commission')
 def handle_withdraw_commission(message):
     chat_id = str(message.chat.id)
     
@@ -9062,8 +10820,9 @@ def show_admin_panel(chat_id, message_id):
 
 def show_referral_stats(chat_id, message_id):
     """عرض إحصائيات الإحالات"""
+    # المستحقات المعلقة تقرأ مباشرة حتى لا تظهر بعد صرفها فتتكرر الدفعة
     pending_commissions = get_pending_commissions()
-    total_pending = sum(commission['total_pending'] for commission in pending_commissions)
+    total_pending = sum(float(commission['total_pending']) for commission in pending_commissions)
     
     text = f"""
 <b>📈 إحصائيات الإحالات</b>
@@ -9101,7 +10860,7 @@ def start_edit_commission_rate(chat_id):
         reply_markup=EnhancedKeyboard.create_back_button("referral_settings")
     )
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'edit_commission_rate')
+@conversation_states.on('edit_commission_rate')
 def handle_edit_commission_rate(message):
     chat_id = str(message.chat.id)
     
@@ -9147,7 +10906,7 @@ def start_edit_payout_days(chat_id):
         reply_markup=EnhancedKeyboard.create_back_button("referral_settings")
     )
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'edit_payout_days')
+@conversation_states.on('edit_payout_days')
 def handle_edit_payout_days(message):
     chat_id = str(message.chat.id)
     
@@ -9199,17 +10958,29 @@ def handle_approve_payment(call, chat_id, message_id):
                 bot.answer_callback_query(call.id, "❌ تم معالجة هذا الطلب مسبقاً", show_alert=True)
                 return
             
-            # تحديث رصيد المحفظة
-            current_balance = get_wallet_balance(user_id)
-            new_balance = update_wallet_balance(user_id, amount)
+            def apply_approval():
+                # قفل الطلب حتى لا تتم الموافقة عليه مرتين بالتوازي
+                request_rows = db_manager.execute_query(
+                    "SELECT status FROM payment_requests WHERE user_id = %s AND transaction_id = %s FOR UPDATE",
+                    (user_id, transaction_id)
+                )
+                if request_rows and any(row['status'] != 'pending' for row in request_rows):
+                    return None
+                
+                # تحديث حالة الطلب ورصيد المحفظة معاً
+                db_manager.execute_query(
+                    "UPDATE payment_requests SET status = 'approved', approved_at = CURRENT_TIMESTAMP WHERE user_id = %s AND transaction_id = %s AND status = 'pending'",
+                    (user_id, transaction_id)
+                )
+                return update_wallet_balance(user_id, amount)
             
-            logger.info(f"💰 تحديث الرصيد: المستخدم {user_id}, المبلغ {amount}, الرصيد الجديد {new_balance}")
+            new_balance = db_manager.run_in_transaction(apply_approval)
+            if new_balance is None:
+                bot.answer_callback_query(call.id, "❌ تم معالجة هذا الطلب مسبقاً", show_alert=True)
+                return
+            current_balance = new_balance - amount
             
-            # تحديث حالة الطلب في قاعدة البيانات
-            db_manager.execute_query(
-                "UPDATE payment_requests SET status = 'approved', approved_at = CURRENT_TIMESTAMP WHERE user_id = %s AND transaction_id = %s AND status = 'pending'",
-                (user_id, transaction_id)
-            )
+            logger.info(f"💰 تحديث الرصيد: المستخدم {user_id}, المبلغ {amount}, الرصيد الجديد {new_balance}")
             
             # إرسال إشعار للمستخدم
             try:
@@ -9533,8 +11304,7 @@ def show_pending_redemption_requests(chat_id, message_id):
     )
 
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and 
-                    user_data[str(message.chat.id)].get('state') == 'edit_compensation_rate')
+@conversation_states.on('edit_compensation_rate')
 def handle_edit_compensation_rate(message):
     """معالجة تعديل نسبة التعويض"""
     chat_id = str(message.chat.id)
@@ -9564,8 +11334,7 @@ def handle_edit_compensation_rate(message):
     except ValueError:
         bot.send_message(chat_id, "❌ يرجى إدخال رقم صحيح")
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and 
-                    user_data[str(message.chat.id)].get('state') == 'edit_min_loss_amount')
+@conversation_states.on('edit_min_loss_amount')
 def handle_edit_min_loss_amount(message):
     """معالجة تعديل الحد الأدنى للخسارة"""
     chat_id = str(message.chat.id)
@@ -9856,14 +11625,12 @@ def close_support_request(call, user_id):
         logger.error(f"خطأ في إغلاق طلب الدعم: {str(e)}")
         bot.answer_callback_query(call.id, "❌ فشل في إغلاق الطلب")
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and 
-                    user_data[str(message.chat.id)].get('state') == 'awaiting_support_message')
+@conversation_states.on('awaiting_support_message', next_states=('support_message_received',))
 def handle_support_message_input(message):
     """معالجة رسالة الدعم"""
     handle_support_message(message)
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and 
-                    user_data[str(message.chat.id)].get('state') == 'admin_reply_message')
+@conversation_states.on('admin_reply_message')
 def handle_admin_reply_input(message):
     """معالجة رد الإدارة"""
     handle_admin_reply(message)
@@ -9876,19 +11643,19 @@ def handle_support_photo_input(message):
         handle_support_photo(message)
 
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'gift_user_id')
+@conversation_states.on('gift_user_id', next_states=('gift_amount',))
 def handle_gift_user_id_input(message):
     handle_gift_user_id(message)
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'gift_amount')
+@conversation_states.on('gift_amount', next_states=('gift_confirm',))
 def handle_gift_amount_input(message):
     handle_gift_amount(message)
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'edit_gift_commission')
+@conversation_states.on('edit_gift_commission')
 def handle_edit_gift_commission_input(message):
     handle_edit_gift_commission(message)
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and user_data[str(message.chat.id)].get('state') == 'edit_gift_min_amount')
+@conversation_states.on('edit_gift_min_amount')
 def handle_edit_gift_min_amount_input(message):
     handle_edit_gift_min_amount(message)
 
@@ -9908,8 +11675,7 @@ def handle_add_dice_reward(call):
         parse_mode="HTML",
         reply_markup=EnhancedKeyboard.create_back_button("manage_dice_rewards")
     )
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and 
-                   user_data[str(message.chat.id)].get('state') == 'add_dice_reward_number')
+@conversation_states.on('add_dice_reward_number', next_states=('add_dice_reward_type',))
 def handle_add_dice_reward_number(message):
     chat_id = str(message.chat.id)
     try:
@@ -9933,8 +11699,7 @@ def handle_add_dice_reward_number(message):
     except ValueError:
         bot.send_message(chat_id, "يرجى إدخال رقم صحيح بين 1 و 6")
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and 
-                   user_data[str(message.chat.id)].get('state') == 'add_dice_reward_type')
+@conversation_states.on('add_dice_reward_type', next_states=('add_dice_reward_value',))
 def handle_add_dice_reward_type(message):
     chat_id = str(message.chat.id)
     reward_type = message.text.strip().lower()
@@ -9955,8 +11720,7 @@ def handle_add_dice_reward_type(message):
         parse_mode="HTML"
     )
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and 
-                   user_data[str(message.chat.id)].get('state') == 'add_dice_reward_value')
+@conversation_states.on('add_dice_reward_value', next_states=('add_dice_reward_description',))
 def handle_add_dice_reward_value(message):
     chat_id = str(message.chat.id)
     try:
@@ -9974,8 +11738,7 @@ def handle_add_dice_reward_value(message):
     except ValueError:
         bot.send_message(chat_id, "يرجى إدخال رقم صحيح")
 
-@bot.message_handler(func=lambda message: str(message.chat.id) in user_data and 
-                   user_data[str(message.chat.id)].get('state') == 'add_dice_reward_description')
+@conversation_states.on('add_dice_reward_description')
 def handle_add_dice_reward_description(message):
     chat_id = str(message.chat.id)
     description = message.text.strip()
@@ -10020,6 +11783,128 @@ def start_referral_reminder():
 # تشغيل النظام المحسن
 # ===============================================================
 
+# ===============================================================
+# خادم Webhook
+# ===============================================================
+
+def update_partition_key(update):
+    """معرف المحادثة الذي يحدد قسم التحديث للحفاظ على ترتيب رسائل كل مستخدم"""
+    for field in ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'my_chat_member', 'chat_member', 'chat_join_request'):
+        item = getattr(update, field, None)
+        if item is not None and getattr(item, 'chat', None) is not None:
+            return item.chat.id
+    if update.callback_query is not None:
+        if update.callback_query.message is not None:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    for field in ('inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query'):
+        item = getattr(update, field, None)
+        if item is not None:
+            return item.from_user.id
+    return update.update_id
+
+class UpdateDispatcher:
+    """توزيع تحديثات Webhook على عمال مقسمين حسب المحادثة مع طوابير محدودة"""
+    def __init__(self, worker_count, queue_size):
+        self.worker_count = max(worker_count, 1)
+        self.queues = [Queue(maxsize=queue_size) for _ in range(self.worker_count)]
+        self.rejected = 0
+
+    def start(self):
+        # المعالجات تعمل داخل عامل القسم نفسه وليس في مجمع خيوط البوت حتى يبقى الترتيب محفوظاً
+        bot.threaded = False
+        for index, update_queue in enumerate(self.queues):
+            threading.Thread(target=self.worker_loop, args=(update_queue,), daemon=True, name=f"update-worker-{index}").start()
+
+    def submit(self, update):
+        """إضافة تحديث لقسمه، يعيد False عند امتلاء الطابور"""
+        update_queue = self.queues[hash(update_partition_key(update)) % self.worker_count]
+        try:
+            update_queue.put(update, timeout=WEBHOOK_ENQUEUE_TIMEOUT)
+            return True
+        except Full:
+            self.rejected += 1
+            return False
+
+    def worker_loop(self, update_queue):
+        while True:
+            update = update_queue.get()
+            try:
+                bot.process_new_updates([update])
+            except Exception as e:
+                logger.error(f"❌ خطأ في معالجة التحديث {update.update_id}: {e}")
+            finally:
+                update_queue.task_done()
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    dispatcher = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        # فحص الصحة لمنصة الاستضافة
+        self.respond(200, b'ok')
+
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self.respond(404)
+            return
+        if WEBHOOK_SECRET and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            self.respond(403)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            update = types.Update.de_json(self.rfile.read(length).decode('utf-8'))
+        except Exception as e:
+            logger.error(f"❌ تحديث غير صالح: {e}")
+            self.respond(400)
+            return
+        
+        # عند امتلاء الطابور نرد 503 فيعيد تيليجرام الإرسال لاحقاً (ضغط عكسي)
+        if self.dispatcher.submit(update):
+            self.respond(200)
+        else:
+            logger.warning("⚠️ طابور التحديثات ممتلئ، تم تأجيل تحديث")
+            self.respond(503)
+
+def run_webhook_server():
+    """تشغيل البوت بوضع Webhook، يعيد False إن تعذر ذلك للرجوع للاستطلاع"""
+    try:
+        dispatcher = UpdateDispatcher(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+        WebhookRequestHandler.dispatcher = dispatcher
+        server = ThreadingHTTPServer(('0.0.0.0', WEBHOOK_PORT), WebhookRequestHandler)
+        server.daemon_threads = True
+        
+        bot.remove_webhook()
+        webhook_options = {
+            'url': f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            'max_connections': WEBHOOK_WORKERS * 5,
+            # chat_member لا يرسل إلا إذا طلب صراحة
+            'allowed_updates': telebot.util.update_types
+        }
+        if WEBHOOK_SECRET:
+            webhook_options['secret_token'] = WEBHOOK_SECRET
+        if not bot.set_webhook(**webhook_options):
+            logger.error("❌ فشل تعيين Webhook")
+            server.server_close()
+            return False
+        
+        dispatcher.start()
+        logger.info(f"🌐 وضع Webhook يعمل على المنفذ {WEBHOOK_PORT} ({dispatcher.worker_count} عمال)")
+        server.serve_forever()
+        return True
+    except Exception as e:
+        logger.error(f"❌ خطأ في تشغيل Webhook: {e}")
+        return False
+
 def start_system():
     """تشغيل جميع أنظمة البوت"""
     logger.info("🚀 بدء تشغيل النظام...")
@@ -10027,10 +11912,27 @@ def start_system():
     # انتظار بسيط لضمان اكتمال إنشاء الجداول
     time.sleep(2)
     
-    # بدء معالجة الطابور
-    queue_thread = threading.Thread(target=process_account_operations, daemon=True)
-    queue_thread.start()
-    logger.info("✅ تم بدء معالجة الطابور")
+    # بدء عمال معالجة الطابور
+    account_operations_queue.start()
+    logger.info(f"✅ تم بدء معالجة الطابور ({account_operations_queue.worker_count} عمال)")
+    
+    # استئناف الإرسالات الجماعية المنقطعة، ودورياً لإرسالات النسخ المتوقفة
+    broadcast_engine.start_resumer()
+    
+    # مزامنة ذاكرة الإعدادات بين نسخ البوت
+    settings_cache.start_listener()
+    
+    # إلغاء المحادثات المتروكة
+    conversation_states.start_sweeper()
+    
+    # حذف مجاميع المعاملات القديمة
+    transaction_buckets.start_pruner()
+    
+    # المسح الكامل الدوري لدليل لاعبي الوكيل
+    player_directory.start_full_sync_scheduler()
+    
+    # ضغط المقاييس اليومية لإحصائيات الإدارة في الخلفية
+    stats_rollup.start_compactor()
     
     # بدء نظام التذكير بالإحالات
     start_referral_reminder()
@@ -10044,9 +11946,20 @@ def start_system():
     
     logger.info("🤖 البوت يعمل واستقبال الرسائل...")
     
+    if WEBHOOK_URL:
+        run_webhook_server()
+        logger.warning("⚠️ الرجوع لوضع الاستطلاع (polling)")
+        bot.threaded = True
+    
+    # الاستطلاع لا يعمل مع وجود Webhook مسجل
+    try:
+        bot.remove_webhook()
+    except Exception as e:
+        logger.error(f"❌ خطأ في إزالة Webhook: {e}")
+    
     while True:
         try:
-            bot.polling(none_stop=True, timeout=60, skip_pending=True)
+            bot.polling(none_stop=True, timeout=60, skip_pending=True, allowed_updates=telebot.util.update_types)
         except Exception as e:
             logger.error(f"❌ خطأ في تشغيل البوت: {e}")
             logger.info("🔄 إعادة المحاولة بعد 10 ثواني...")
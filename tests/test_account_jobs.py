@@ -0,0 +1,92 @@
+import json
+import os
+import uuid
+
+import pytest
+
+pytest.importorskip("telebot")
+pytest.importorskip("psycopg2")
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+if not TEST_DATABASE_URL:
+    pytest.skip("TEST_DATABASE_URL غير محدد", allow_module_level=True)
+
+os.environ["DATABASE_URL"] = TEST_DATABASE_URL
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:TEST")
+
+import bot  # noqa: E402
+
+
+@pytest.fixture
+def deposit_job(monkeypatch):
+    """مهمة شحن حقيقية في account_jobs مع وسيط ناجح ورسائل تيليجرام معطلة"""
+    monkeypatch.setattr(bot.bot, "send_message", lambda *args, **kwargs: None)
+    monkeypatch.setattr(bot, "check_cashier_balance_sufficient", lambda amount: True)
+    monkeypatch.setattr(bot, "deposit_to_account_via_agent", lambda player_id, amount: True)
+
+    chat_id = f"test-{uuid.uuid4().hex[:12]}"
+    bot.update_wallet_balance(chat_id, 50000)
+    task = {"type": "deposit_to_account", "chat_id": chat_id, "amount": 10000, "player_id": "42"}
+    key = f"test:{chat_id}"
+    assert bot.account_operations_queue.put(task, key)
+
+    rows = bot.db_manager.execute_query(
+        "UPDATE account_jobs SET status = 'running', attempts = attempts + 1, locked_by = %s, "
+        "locked_until = NOW() + INTERVAL '5 minutes' "
+        "WHERE idempotency_key = %s "
+        "RETURNING job_id, task_type, chat_id, payload, step, attempts, max_attempts, locked_by",
+        (f"test:{uuid.uuid4().hex[:12]}", key),
+    )
+    job = dict(rows[0])
+    if isinstance(job["payload"], str):
+        job["payload"] = json.loads(job["payload"])
+    yield job
+
+    bot.db_manager.execute_query("DELETE FROM account_jobs WHERE job_id = %s", (job["job_id"],))
+    bot.db_manager.execute_query("DELETE FROM wallets WHERE chat_id = %s", (chat_id,))
+    for table in ("transactions", "transaction_hourly_totals", "loyalty_points", "loyalty_points_history"):
+        bot.db_manager.execute_query(f"DELETE FROM {table} WHERE user_id = %s", (chat_id,))
+
+
+def job_row(job_id):
+    return bot.db_manager.execute_query(
+        "SELECT status, step FROM account_jobs WHERE job_id = %s", (job_id,)
+    )[0]
+
+
+def test_failed_statement_in_record_deposit_is_not_completed(monkeypatch, deposit_job):
+    """فشل استعلام داخل معاملة تسجيل الشحن يجب أن يعيد المهمة للطابور لا أن ينهيها"""
+    def failing_add_transaction(transaction_data):
+        # استعلام فاشل داخل المعاملة: execute_in_transaction يبتلع الخطأ ويستمر التنفيذ
+        bot.db_manager.execute_query("INSERT INTO table_that_does_not_exist VALUES (1)")
+        return None
+
+    monkeypatch.setattr(bot, "add_transaction", failing_add_transaction)
+
+    bot.account_operations_queue.run_job(deposit_job)
+
+    row = job_row(deposit_job["job_id"])
+    assert row["status"] in ("pending", "dead")
+    assert row["step"] == "agent_done"
+
+
+def test_successful_deposit_is_completed(deposit_job):
+    bot.account_operations_queue.run_job(deposit_job)
+
+    row = job_row(deposit_job["job_id"])
+    assert row["status"] == "done"
+    assert row["step"] == "completed"
+
+
+def test_worker_that_lost_its_lease_cannot_change_the_job(deposit_job):
+    """عامل انتهى حجزه واستلم المهمة عامل آخر لا يكتب فوق حالتها"""
+    bot.db_manager.execute_query(
+        "UPDATE account_jobs SET locked_by = 'other-worker' WHERE job_id = %s",
+        (deposit_job["job_id"],),
+    )
+
+    bot.account_operations_queue.run_job(deposit_job)
+
+    row = job_row(deposit_job["job_id"])
+    assert row["status"] == "running"
+    assert row["step"] is None
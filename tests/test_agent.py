@@ -0,0 +1,141 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("telebot")
+pytest.importorskip("psycopg2")
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+if not TEST_DATABASE_URL:
+    pytest.skip("TEST_DATABASE_URL غير محدد", allow_module_level=True)
+
+os.environ["DATABASE_URL"] = TEST_DATABASE_URL
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:TEST")
+
+import bot  # noqa: E402
+
+
+class FakeAgentServer(ThreadingHTTPServer):
+    """خادم وكيل محلي يسجل الطلبات ويعيد ردوداً مبرمجة مسبقاً لكل نقطة نهاية"""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeAgentHandler)
+        self.lock = threading.Lock()
+        self.calls = {}
+        # ردود مؤقتة لكل نقطة نهاية تستهلك بالترتيب قبل الرد الناجح: رمز حالة أو ("sleep", ثواني)
+        self.scripted = {}
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def handle_error(self, request, client_address):
+        # العميل يغلق الاتصال عند انتهاء المهلة قبل أن يرد الخادم البطيء
+        pass
+
+    def next_response(self, path):
+        with self.lock:
+            self.calls[path] = self.calls.get(path, 0) + 1
+            queue = self.scripted.get(path)
+            return queue.pop(0) if queue else None
+
+
+class FakeAgentHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=None):
+        data = json.dumps(body or {}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        scripted = self.server.next_response(self.path)
+        if isinstance(scripted, tuple) and scripted[0] == "sleep":
+            time.sleep(scripted[1])
+        elif scripted is not None:
+            self.reply(scripted)
+            return
+
+        if self.path == "/global/api/User/signIn":
+            self.reply(200, {"status": True, "result": {"message": "dashboard", "expiresIn": 300}})
+        else:
+            self.reply(200, {"status": True, "result": {}})
+
+
+@pytest.fixture
+def fake_agent(monkeypatch):
+    server = FakeAgentServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(bot, "AGENT_RETRY_BASE_DELAY", 0.01)
+    # كل اختبار يبدأ بجلسة منتهية حتى يمر بتسجيل الدخول
+    bot.agent_session.invalidate(bot.agent_session.generation)
+
+    agent = bot.IChancyAgent()
+    agent.BASE_URL = server.url
+    yield server, agent
+
+    server.shutdown()
+    server.server_close()
+    bot.agent_session.invalidate(bot.agent_session.generation)
+
+
+DEPOSIT = "/global/api/Player/depositToPlayer"
+SIGN_IN = "/global/api/User/signIn"
+
+
+def test_deposit_logs_in_again_after_401(fake_agent):
+    server, agent = fake_agent
+    server.scripted[DEPOSIT] = [401]
+
+    assert agent.deposit_to_player("42", 10000) is True
+    assert server.calls[SIGN_IN] == 2
+    assert server.calls[DEPOSIT] == 2
+
+
+def test_transient_server_error_is_retried(fake_agent):
+    server, agent = fake_agent
+    server.scripted[DEPOSIT] = [500, 502]
+
+    assert agent.deposit_to_player("42", 10000) is True
+    assert server.calls[DEPOSIT] == 3
+
+
+def test_request_gives_up_after_retries(fake_agent):
+    server, agent = fake_agent
+    server.scripted[DEPOSIT] = [500] * bot.AGENT_REQUEST_RETRIES
+
+    assert agent.deposit_to_player("42", 10000) is False
+    assert server.calls[DEPOSIT] == bot.AGENT_REQUEST_RETRIES
+
+
+def test_slow_endpoint_times_out(monkeypatch, fake_agent):
+    server, agent = fake_agent
+    monkeypatch.setitem(bot.AGENT_ENDPOINT_TIMEOUTS, DEPOSIT, 0.2)
+    server.scripted[DEPOSIT] = [("sleep", 1)] * bot.AGENT_REQUEST_RETRIES
+
+    started = time.time()
+    assert agent.deposit_to_player("42", 10000) is False
+    assert time.time() - started < 1.5 * bot.AGENT_REQUEST_RETRIES
+
+
+def test_concurrent_deposits_share_one_login(fake_agent):
+    server, agent = fake_agent
+
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        results = list(executor.map(lambda i: agent.deposit_to_player(str(i), 10000), range(20)))
+
+    assert all(results)
+    assert server.calls[SIGN_IN] == 1
+    assert server.calls[DEPOSIT] == 20